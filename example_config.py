@@ -112,6 +112,29 @@ commands = {
     'P': lazy.open_from_clipboard(),
 }
 
+# bindings for other modes, which take priority over typing into the page.
+# Sequences of keys are written with spaces between them, e.g. 'C-x C-s'.
+keymaps = {
+    Mode.Insert: {
+        'C-e': lazy.javascript('document.activeElement.blur();'),
+    },
+}
+
+# milliseconds to wait for more keys when what's been typed so far is both a
+# binding and the start of a longer one.
+key_timeout = 1000
+
+# apply changes to this file as soon as it's saved, rather than only when
+# :reload-config is run. Changing which extensions are enabled still needs a
+# restart.
+reload_config_on_change = False
+
+# extra commands for the : prompt, each called with the browser and any
+# arguments given.
+custom_commands = {
+    'contextual-follow': contextual_follow,
+}
+
 
 def should_open_popup(uri):
     print("Yeah I'm going going to open this popup", uri)
@@ -177,6 +200,62 @@ dpi = Gdk.Screen.get_default().props.resolution
 # scale default zoom to account for the dpi, for my HiDPI monitor. Based on a default of 96 dpi.
 default_zoom = dpi / 96.0 * 100
 
+# lock the password manager after this many seconds without use.
+password_manager_timeout = 10 * 60
+
+# only keep this many back/forward entries per tab in the saved session.
+session_max_history = 50
+
+# after restoring a session, load this many of the most recently used tabs in
+# the background, a few at a time and only while you're not typing.
+session_warmup_tabs = 3
+session_warmup_concurrency = 1
+session_warmup_idle = 2
+
+# unload tabs you haven't looked at for this many seconds, and the least
+# recently used tabs beyond max_live_tabs. Use :pin-tab to keep a tab loaded.
+tab_discard_timeout = 30 * 60
+max_live_tabs = 15
+
+# when web processes use more than this much memory in total, or less than
+# memory_pressure_ratio of the system's memory is available, unload the
+# largest idle tabs. Checked every memory_monitor_interval seconds.
+max_web_process_memory = 4 * 1024 ** 3
+memory_pressure_ratio = 0.1
+memory_monitor_interval = 30
+
+# how many closed tabs to remember for undo_close and :closed-tabs.
+closed_tabs_history = 100
+
+# queue, throttle and pause downloads. This fetches them again with roland's
+# own downloader instead of WebKit's, so WebKit's proxy settings, TLS
+# exceptions and HSTS don't apply to them, and links that only work once
+# fail.
+download_scheduler = True
+
+# run at most this many downloads at once, and limit downloads to this many
+# bytes per second in total and each. None means no limit.
+download_max_active = 3
+download_rate_limit = 2 * 1024 * 1024
+download_rate_limit_per_download = None
+
+# fetch files of at least download_segment_min_size bytes over this many
+# connections at once, from servers that support it.
+download_segments = 4
+download_segment_min_size = 16 * 1024 * 1024
+
+# what to do with finished downloads, on download_post_process_workers
+# threads. 'hash' shows their SHA-256, 'verify' checks them against a
+# .sha256 file next to them (:download-checksum checks against a checksum
+# you give it either way), 'extract' unpacks archives next to them, and
+# 'open' opens them, or what was extracted, with the default application.
+download_post_process = ['verify']
+download_post_process_workers = 2
+
+# extensions read their files on this many threads at startup, and those
+# not needed before the first page loads are set up once the window shows.
+extension_setup_workers = 4
+
 spell_checking_enabled = True
 spell_checking_languages = ['en_AU']
 
@@ -7,12 +7,13 @@ class _Lazy:
     def __getattr__(self, name):
         class lazy_command:
             def __init__(self, *args, **kwargs):
+                self.name = name
                 self.args = args
                 self.kwargs = kwargs
 
-            def __call__(self, browser):
+            def __call__(self, browser, **kwargs):
                 for_real_this_time = getattr(browser, name)
-                return for_real_this_time(*self.args, **self.kwargs)
+                return for_real_this_time(*self.args, **dict(self.kwargs, **kwargs))
 
             def __str__(self):
                 return '{}({}, {})'.format(name, self.args, self.kwargs)
@@ -22,7 +23,7 @@ class _Lazy:
         return lazy_command
 
 
-def dbus_execute(method, *args, profile, **kwargs):
+def dbus_execute(method, *args, profile=None, **kwargs):
     import dbus
     bus = dbus.SessionBus()
     roland_service = bus.get_object(
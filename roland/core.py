@@ -1,8 +1,7 @@
 #!/usr/bin/env python3
 
-import base64
-import code
 import collections
+import concurrent.futures
 import datetime
 import faulthandler
 import functools
@@ -13,17 +12,23 @@ import pathlib
 import random
 import shlex
 import threading
+import time
+import types
 from urllib import parse as urlparse
 
 import logbook
-import msgpack
 
 from gi.repository import GObject, Gdk, Gio, Gtk, Pango, GLib, WebKit2, GdkPixbuf
 
+from . import pages, profiling, storage
+from .downloads import ACTIVE, PAUSED, QUEUED
+from .keys import MATCH, PENDING, KeyDispatcher, accepts_count, compile_keymap, compile_keymaps
+from .postprocess import parse_checksum
 from .api import Mode
 from .utils import (
-    cache_path, config_path, runtime_path, get_keyname, get_pretty_size,
-    init_logging, RolandConfigBase)
+    blocking_wait, cache_path, config_path, config_settings, dependencies_settled,
+    diff_config, runtime_path, get_keyname, init_logging, load_config,
+    web_process_settings, RolandConfigBase)
 
 
 faulthandler.enable()
@@ -31,6 +36,10 @@ log = logbook.Logger('roland')
 
 HTMLNotification = collections.namedtuple('HTMLNotification', 'id title body')
 
+# attribute is the BrowserView method that runs the command, or None for
+# commands registered with register_command, which run func(browser, *args).
+Command = collections.namedtuple('Command', 'name attribute func help extensions private')
+
 DEFAULT_STYLE = b'''
     GtkEntry, GtkLabel {
         background: black;
@@ -38,6 +47,14 @@ DEFAULT_STYLE = b'''
     }
 '''
 
+# config used by BrowserView.apply_settings, applied to open tabs on reload
+WEBVIEW_SETTINGS = {
+    'default_user_agent',
+    'enable_frame_flattening',
+    'enable_webgl',
+    'enable_accelerated_2d_canvas',
+}
+
 
 def rename(name):
     def callable(func):
@@ -62,12 +79,15 @@ def private(func):
 
 
 request_counter = itertools.count(1)
+tab_counter = itertools.count(1)
 
 
 def message_webprocess(command, *, page_id, callback, **kwargs):
     # FIXME: make this whole thing asyncio friendly, getting rid of callback
     # and everything..
 
+    import msgpack
+
     request_id = next(request_counter)
     p = runtime_path('webprocess.{}.sock'.format(page_id))
     addr = Gio.UnixSocketAddress.new(p)
@@ -103,6 +123,9 @@ def message_webprocess(command, *, page_id, callback, **kwargs):
 
 
 class BrowserCommands:
+    # command name -> Command, see build_commands
+    commands = {}
+
     def font(self, *font):
         self.roland.change_font(' '.join(font))
 
@@ -234,6 +257,13 @@ class BrowserCommands:
             callback=display_choices,
         )
 
+    @requires('PasswordManagerExtension')
+    @rename('password-lock')
+    def password_lock(self):
+        """Lock the password manager, forgetting the master password."""
+        self.roland.get_extension('PasswordManagerExtension').lock()
+        self.roland.notify('Password manager locked')
+
     @requires('PasswordManagerExtension')
     @rename('form-fill')
     def form_fill(self):
@@ -328,6 +358,27 @@ class BrowserCommands:
             self.webview.load_uri(url)
         return True
 
+    @rename('pin-tab')
+    def pin_tab(self):
+        """Toggle whether the current tab is pinned. Pinned tabs are never
+        discarded."""
+        self.pinned = not self.pinned
+        self.roland.notify('Tab pinned' if self.pinned else 'Tab unpinned')
+
+    @requires('TabDiscarder')
+    @rename('discard-tabs')
+    def discard_tabs(self):
+        """Unload every background tab that isn't pinned or playing audio.
+        They're loaded again when next shown."""
+        count = self.roland.get_extension('TabDiscarder').discard_all()
+        self.roland.notify('Discarded {} tabs'.format(count))
+
+    @requires('TaskManager')
+    def tasks(self, sort='pss'):
+        """Show each tab's web process, memory and CPU use, and how much it
+        has loaded. Sort by title, pid, rss, pss, cpu, requests or bytes."""
+        self.roland.new_window('roland://tasks/?sort={}'.format(urlparse.quote(sort)))
+
     @requires('SessionManager')
     @rename('save-session')
     def save_session(self):
@@ -416,9 +467,15 @@ class BrowserCommands:
             return
 
         if self.webview is None:
+            if self.lazy and self.lazy_uri is not None:
+                session = self.lazy_session
+                if session is not None and not isinstance(session, bytes):
+                    session = session.load()
+                self.roland.add_close_history(self.lazy_uri, session, title=self.get_title())
             return
 
-        self.roland.add_close_history(self.webview.get_uri(), self.get_serialised_session_state())
+        self.roland.add_close_history(
+            self.webview.get_uri(), self.get_serialised_session_state(), title=self.get_title())
 
     @private
     def change_user_agent(self):
@@ -438,17 +495,29 @@ class BrowserCommands:
         self.open(url=url, new_window=new_window, background=background)
         return True
 
-    def back(self):
+    def back(self, count=1):
         """Go backward in navigation history."""
-        self.webview.go_back()
+        self.go_back_or_forward(-count)
 
-    def forward(self):
+    def forward(self, count=1):
         """Go forward in navigation history."""
-        self.webview.go_forward()
+        self.go_back_or_forward(count)
 
-    def javascript(self, script):
+    @private
+    def go_back_or_forward(self, steps):
+        # as far as history goes, if it doesn't go far enough
+        history = self.webview.get_back_forward_list()
+        direction = 1 if steps > 0 else -1
+        while steps:
+            item = history.get_nth_item(steps)
+            if item is not None:
+                self.webview.go_to_back_forward_list_item(item)
+                return
+            steps -= direction
+
+    def javascript(self, script, count=1):
         """Execute given JavaScript."""
-        self.webview.run_javascript(script, None, None, None)
+        self.webview.run_javascript(';\n'.join([script] * count), None, None, None)
 
     @rename('view-source')
     def view_source(self):
@@ -579,25 +648,25 @@ class BrowserCommands:
         return True
 
     @private
-    def next_search_result(self, forwards=True):
+    def next_search_result(self, forwards=True, count=1):
         finder = self.webview.get_find_controller()
 
-        if forwards == self.search_forwards:
-            finder.search_next()
-        else:
-            finder.search_previous()
+        for i in range(count):
+            if forwards == self.search_forwards:
+                finder.search_next()
+            else:
+                finder.search_previous()
 
     @private
-    def zoom_in(self):
-        self.webview.set_zoom_level(self.webview.get_zoom_level() + 0.1)
+    def zoom_in(self, count=1):
+        self.webview.set_zoom_level(self.webview.get_zoom_level() + 0.1 * count)
         # binding for C-Up scrolls, this stops that
         return True
 
     @private
-    def zoom_out(self):
-        zoom_level = self.webview.get_zoom_level() - 0.1
-        if zoom_level >= 0.1:
-            self.webview.set_zoom_level(zoom_level)
+    def zoom_out(self, count=1):
+        zoom_level = max(0.1, self.webview.get_zoom_level() - 0.1 * count)
+        self.webview.set_zoom_level(zoom_level)
         # binding for C-Down scrolls, this stops that
         return True
 
@@ -614,11 +683,13 @@ class BrowserCommands:
         self.webview.stop_loading()
 
     @private
-    def move(self, x=0, y=0):
-        self.javascript('window.scrollBy(%d, %d);' % (x*30, y*30))
+    def move(self, x=0, y=0, count=1):
+        self.javascript('window.scrollBy(%d, %d);' % (x*30*count, y*30*count))
 
     def shell(self):
         """Open a Python REPL on stdout."""
+        import code
+
         self.roland.notify('Starting shell...')
         locals = {
             'config': self.roland.config,
@@ -703,6 +774,67 @@ class BrowserCommands:
 
         return True
 
+    @private
+    def choose_scheduled_download(self, prompt, state=None):
+        downloads = {
+            location: download for (location, download) in self.roland.downloads.items()
+            if hasattr(download, 'state') and (state is None or download.state in state)
+        }
+        if not downloads:
+            self.roland.notify("No downloads to {}".format(prompt.lower()))
+            return None
+
+        key = self.entry_line.blocking_prompt(
+            prompt=prompt, force_match=True, suggestions=list(downloads))
+        return downloads.get(key)
+
+    @requires('DownloadManager')
+    @rename('pause-download')
+    def pause_download(self):
+        """Pause a download, or stop a queued one from starting."""
+        download = self.choose_scheduled_download('Pause', state=(QUEUED, ACTIVE))
+        if download is not None:
+            download.pause()
+
+    @requires('DownloadManager')
+    @rename('resume-download')
+    def resume_download(self):
+        """Resume a paused download."""
+        download = self.choose_scheduled_download('Resume', state=(PAUSED,))
+        if download is not None:
+            self.roland.get_extension('DownloadManager').resume(download)
+
+    @requires('DownloadManager')
+    @rename('download-priority')
+    def download_priority(self, priority):
+        """Set a download's priority. Higher priority downloads start
+        first."""
+        download = self.choose_scheduled_download('Prioritise')
+        if download is not None:
+            download.scheduler.set_priority(download, int(priority))
+
+    @requires('DownloadManager')
+    @rename('download-checksum')
+    def download_checksum(self, *checksum):
+        """Check a download against a SHA-256 checksum, or a line of
+        sha256sum output, once it finishes."""
+        checksum = ' '.join(checksum)
+        expected = parse_checksum(checksum)
+        if expected is None:
+            self.roland.notify("Not a SHA-256 checksum: {}".format(checksum))
+            return
+
+        if not self.roland.downloads:
+            self.roland.notify("No downloads in progress")
+            return
+
+        location = self.entry_line.blocking_prompt(
+            prompt="Verify download", force_match=True,
+            suggestions=list(self.roland.downloads.keys()))
+
+        if location in self.roland.downloads:
+            self.roland.get_extension('DownloadManager').expect_checksum(location, expected)
+
     @rename('inspector-show')
     def inspector_show(self):
         self.webview.get_inspector().show()
@@ -712,8 +844,25 @@ class BrowserCommands:
         self.webview.get_inspector().close()
 
     @private
-    def undo_close(self):
-        self.roland.undo_close()
+    def undo_close(self, count=1):
+        for i in range(count):
+            self.roland.undo_close()
+
+    @requires('ClosedTabs')
+    @rename('closed-tabs')
+    def closed_tabs(self):
+        """Reopen a recently closed tab."""
+        ext = self.roland.get_extension('ClosedTabs')
+
+        choices = {}
+        for row_id, title, uri in blocking_wait(ext.entries()):
+            choices['{}: {} - {}'.format(row_id, title, uri)] = row_id
+
+        selected = self.entry_line.blocking_prompt(
+            prompt='Closed tab', force_match=True, suggestions=list(choices))
+
+        if selected in choices:
+            self.roland.undo_close(choices[selected])
 
     @private
     def open_from_clipboard(self):
@@ -724,16 +873,21 @@ class BrowserCommands:
     @requires('DownloadManager')
     @private
     def list_downloads(self):
-        if not self.roland.downloads:
-            self.roland.notify("No downloads in progress")
-            return
+        self.downloads()
+
+    @rename('reload-config')
+    def reload_config(self):
+        """Run config.py again and apply what changed, without restarting."""
+        changed = self.roland.reload_config()
+        if changed:
+            self.roland.notify("Reloaded config: {}".format(', '.join(sorted(changed))))
+        else:
+            self.roland.notify("Config hasn't changed")
 
-        for location, download in self.roland.downloads.items():
-            if download.get_progress() == 1.0:
-                continue  # completed while we were doing this
-            progress = get_pretty_size(download.get_current_size())
-            total = get_pretty_size(download.get_total_size())
-            self.roland.notify('%s - %s out of %s' % (location, progress, total))
+    @requires('DownloadManager')
+    def downloads(self):
+        """Show the progress, rate and time left of each download."""
+        self.roland.new_window('roland://downloads/')
 
     @private
     def get_certificate_info(self, certificate=None):
@@ -797,6 +951,29 @@ class BrowserCommands:
             self.roland.notify("No certificate information available")
 
 
+def build_commands(cls):
+    """Find every command defined on cls, once, so running or listing them
+    doesn't need to look through the class each time."""
+    commands = {}
+    for attribute, func in sorted(vars(cls).items()):
+        if attribute.startswith('_') or not isinstance(func, types.FunctionType):
+            continue
+
+        name = func.__name__
+        commands[name] = Command(
+            name=name,
+            attribute=attribute,
+            func=func,
+            help=func.__doc__,
+            extensions=tuple(getattr(func, 'extensions', ())),
+            private=getattr(func, 'private', False),
+        )
+    return commands
+
+
+BrowserCommands.commands = build_commands(BrowserCommands)
+
+
 class EntryLine(Gtk.VBox):
     def __init__(self, status_line, browser):
         Gtk.VBox.__init__(self)
@@ -980,6 +1157,9 @@ class StatusLine(Gtk.HBox):
         self.info_text = text
         self.update_right()
 
+    def set_downloads_text(self, text):
+        self.middle.set_text(text)
+
     def update_right(self):
         text = []
         if self.info_text:
@@ -1008,11 +1188,10 @@ class BrowserTitle:
 
 class BrowserView(BrowserCommands):
     pem_certificate = None
+    pinned = False
 
     def get_serialised_session_state(self):
-        session = self.webview.get_session_state().serialize().get_data()
-        session = base64.b64encode(session).decode('utf8')
-        return session
+        return self.webview.get_session_state().serialize().get_data()
 
     def on_decide_policy(self, webview, decision, decision_type):
         if decision_type == WebKit2.PolicyDecisionType.NAVIGATION_ACTION:
@@ -1060,7 +1239,19 @@ class BrowserView(BrowserCommands):
         self.title = BrowserTitle()
         self.webview = None
         self.sub_commands = None
+        # position in the current mode's keymap, see keys.py
+        self.keys = KeyDispatcher()
+        self.key_timeout_source = None
         self.lazy = lazy
+        self.tab_id = next(tab_counter)
+        # when the tab was last started or visible, for prioritising session
+        # restore and discarding idle tabs
+        self.last_active = 0
+        self.key_press_handler = None
+        self.main_ui_box = None
+        # resources loaded by the tab, for the task manager
+        self.requests = 0
+        self.bytes_received = 0
 
     @classmethod
     def from_webview(cls, browser, roland):
@@ -1069,13 +1260,7 @@ class BrowserView(BrowserCommands):
         self.webview.connect('ready-to-show', lambda *args: self.start())
         return self
 
-    def start(self, url=None, session=None):
-        self.connect('key-press-event', self.on_key_press_event)
-
-        # will already be initialised for popups
-        if self.webview is None:
-            self.webview = self.roland.new_webview()
-
+    def apply_settings(self):
         settings = self.webview.get_settings()
         settings.props.user_agent = self.roland.config.default_user_agent
         settings.props.enable_frame_flattening = getattr(self.roland.config, 'enable_frame_flattening', False)
@@ -1083,6 +1268,20 @@ class BrowserView(BrowserCommands):
         settings.props.enable_accelerated_2d_canvas = getattr(self.roland.config, 'enable_accelerated_2d_canvas', False)
         settings.props.enable_developer_extras = True
 
+    def start(self, url=None, session=None):
+        # until the first commit, see on_load_status
+        profiling.begin('first tab')
+
+        # discarded tabs are started again, and are already connected
+        if self.key_press_handler is None:
+            self.key_press_handler = self.connect('key-press-event', self.on_key_press_event)
+
+        # will already be initialised for popups
+        if self.webview is None:
+            self.webview = self.roland.new_webview()
+
+        self.apply_settings()
+
         self.status_line = StatusLine()
         self.entry_line = EntryLine(self.status_line, self)
 
@@ -1124,6 +1323,7 @@ class BrowserView(BrowserCommands):
         main_ui_box.pack_end(self.status_line, False, False, 0)
         overlay.add_overlay(self.entry_line)
 
+        self.main_ui_box = main_ui_box
         self.add(main_ui_box)
         self.show_all()
         self.entry_line.hide_input()
@@ -1132,7 +1332,9 @@ class BrowserView(BrowserCommands):
         url = url or getattr(self, 'lazy_uri', None)
 
         if session is not None:
-            session = base64.b64decode(session.encode('utf8'))
+            if not isinstance(session, bytes):
+                # stored session state, only read now the tab is needed
+                session = session.load()
             session = WebKit2.WebViewSessionState(GLib.Bytes(session))
             self.webview.restore_session_state(session)
 
@@ -1141,6 +1343,7 @@ class BrowserView(BrowserCommands):
             self.open_or_search(text=url)
 
         self.lazy = False
+        self.last_active = time.time()
 
     def update_uri(self, webview, event):
         self.status_line.set_uri(webview.get_uri())
@@ -1248,7 +1451,18 @@ class BrowserView(BrowserCommands):
     def on_load_status(self, webview, load_status):
         if self.webview != webview:
             return
+
+        if load_status in (WebKit2.LoadEvent.COMMITTED, WebKit2.LoadEvent.FINISHED):
+            session_manager = self.roland.get_extension('SessionManager')
+            if session_manager is not None:
+                session_manager.tab_changed(self)
+                if load_status == WebKit2.LoadEvent.FINISHED:
+                    session_manager.tab_loaded(self)
+
         if load_status == WebKit2.LoadEvent.COMMITTED:
+            profiling.end('first tab')
+            self.roland.finish_profiling()
+
             is_https, certificate, flags = webview.get_tls_info()
 
             if is_https and certificate is not None:
@@ -1282,22 +1496,19 @@ class BrowserView(BrowserCommands):
         return False
 
     def on_resource_load_started(self, webview, resource, request):
-        def finished(resource, *ignored):
-            response = resource.get_response()
+        self.requests += 1
 
-            if response is None:
-                return
-            headers = response.get_http_headers()
+        # nothing to do when it finishes unless something wants to know
+        if self.roland.has_hook('resource_finished'):
+            resource.connect('finished', self.on_resource_finished)
+        if self.roland.has_hook('resource_started'):
+            self.roland.broadcast('resource_started', self, resource)
 
-            if headers is None:
-                return
-            hsts = headers.get_one('Strict-Transport-Security')
+    def on_resource_finished(self, resource, *ignored):
+        response = resource.get_response()
 
-            if hsts is not None and self.roland.is_enabled('HSTSExtension'):
-                ext = self.roland.get_extension('HSTSExtension')
-                ext.add_entry(response.get_uri(), hsts)
-
-        resource.connect('finished', finished)
+        if response is not None:
+            self.roland.broadcast('resource_finished', self, response)
 
     def on_script_dialog(self, webview, dialog):
         if dialog.get_dialog_type() == WebKit2.ScriptDialogType.ALERT:
@@ -1387,24 +1598,19 @@ class BrowserView(BrowserCommands):
             return
 
         if self.mode in (Mode.Normal, Mode.SubCommand):
-            available_commands = {
-                Mode.Normal: self.roland.config.commands,
-                Mode.SubCommand: self.sub_commands,
-            }[self.mode]
+            if self.mode == Mode.SubCommand:
+                keymap = self.sub_commands
+            else:
+                keymap = self.roland.keymaps[Mode.Normal]
 
             orig_mode = self.mode
+            result = self.feed_key(keymap, keyname)
+            if result.status == PENDING:
+                self.run_key_command(result, keyname)
+                return True
 
             try:
-                command = available_commands[keyname]
-            except KeyError:
-                pass
-            else:
-                log.info('running command "{}"', command)
-                try:
-                    return command(self)
-                except Exception as e:
-                    self.roland.notify("Error invoking command '{}': {}'".format(keyname, e))
-                    log.exception("Error invoking command '{}'", keyname)
+                return self.run_key_command(result, keyname)
             finally:
                 if orig_mode == Mode.SubCommand and self.mode != Mode.Prompt:
                     self.set_mode(Mode.Normal)
@@ -1429,7 +1635,14 @@ class BrowserView(BrowserCommands):
                 self.entry_line.completion(forward=True)
                 return True
             return False
-        elif self.mode == Mode.PassThrough:
+        elif self.mode in (Mode.PassThrough, Mode.Insert) and self.roland.keymaps[self.mode].children:
+            # bindings of their own go before anything else in these modes
+            result = self.feed_key(self.roland.keymaps[self.mode], keyname)
+            self.run_key_command(result, keyname)
+            if result.status in (PENDING, MATCH):
+                return True
+
+        if self.mode == Mode.PassThrough:
             # FIXME: would be great if this was configurable :/
             if keyname == 'Insert':
                 self.set_mode(Mode.Normal)
@@ -1439,10 +1652,65 @@ class BrowserView(BrowserCommands):
             if keyname == 'Escape':
                 self.set_mode(Mode.Normal)
 
+    def feed_key(self, keymap, keyname):
+        self.cancel_key_timeout()
+
+        was_pending = self.keys.pending
+        result = self.keys.feed(keymap, keyname)
+
+        if result.status == PENDING:
+            self.status_line.set_info_text(html.escape(self.keys.pending_text()))
+            if self.keys.node.command is not None:
+                # could be this or something longer, wait and see
+                self.key_timeout_source = GLib.timeout_add(
+                    getattr(self.roland.config, 'key_timeout', 1000), self.on_key_timeout)
+        elif was_pending:
+            self.status_line.set_info_text('')
+        return result
+
+    def on_key_timeout(self):
+        self.key_timeout_source = None
+        self.status_line.set_info_text('')
+        self.run_key_command(self.keys.timeout(), 'timeout')
+        return False
+
+    def cancel_key_timeout(self):
+        if self.key_timeout_source is not None:
+            GLib.source_remove(self.key_timeout_source)
+            self.key_timeout_source = None
+
+    def run_key_command(self, result, keyname):
+        if result.previous is not None:
+            self.run_key_command(result.previous, keyname)
+
+        if result.status != MATCH:
+            return None
+
+        log.info('running command "{}" with count {}', result.command, result.count)
+        try:
+            # only commands that know what a count means get one, running
+            # e.g. close five times would close the same tab five times
+            if result.count > 1 and self.accepts_count(result.command):
+                return result.command(self, count=result.count)
+            return result.command(self)
+        except Exception as e:
+            self.roland.notify("Error invoking command '{}': {}'".format(keyname, e))
+            log.exception("Error invoking command '{}'", keyname)
+
+    def accepts_count(self, command):
+        if hasattr(command, 'args') and hasattr(command, 'name'):
+            # lazy commands call the method they're named after
+            command = getattr(self, command.name, None)
+        return accepts_count(command)
+
     def set_mode(self, mode, *args):
         assert mode in Mode
         self.mode = mode
 
+        # a half typed key sequence is for the mode being left
+        self.cancel_key_timeout()
+        self.keys.reset()
+
         log.info("Setting mode to {}", mode)
 
         if mode == Mode.Normal:
@@ -1451,7 +1719,8 @@ class BrowserView(BrowserCommands):
             self.status_line.set_mode('<b>NORMAL</b>', name='NormalMode')
             self.status_line.set_info_text('')
         elif mode == Mode.SubCommand:
-            command, self.sub_commands = args
+            command, sub_commands = args
+            self.sub_commands = compile_keymap(sub_commands)
 
             self.webview.set_can_focus(False)
             self.set_focus(None)
@@ -1489,17 +1758,17 @@ class BrowserView(BrowserCommands):
 
     def run_command(self, name, *args):
         log.info('Running "{}" command', name)
-        try:
-            command = getattr(self, name)
-        except AttributeError:
-            for command in dir(BrowserCommands):
-                func = getattr(self, command)
-                if getattr(func, '__name__', None) == name:
-                    command = func
-                    break
-            else:
+        registered = self.commands.get(name)
+        if registered is None:
+            # any other method can be run by its own name
+            command = getattr(self, name, None)
+            if command is None:
                 self.roland.notify("No such command '{}'".format(name))
                 return
+        elif registered.attribute is None:
+            command = functools.partial(registered.func, self)
+        else:
+            command = getattr(self, registered.attribute)
 
         try:
             command(*args)
@@ -1534,6 +1803,16 @@ class MultiTabBrowserWindow(Gtk.Window):
         if page.lazy:
             page.start()
 
+        # the page being left was visible until now
+        previous = notebook.get_nth_page(notebook.get_current_page())
+        if previous is not None and previous is not page:
+            previous.last_active = time.time()
+
+        page.last_active = time.time()
+        session_manager = self.roland.get_extension('SessionManager')
+        if session_manager is not None:
+            session_manager.tab_changed(page)
+
         for browser in self.roland.get_browsers():
             browser.tab_title.get_style_context().remove_class('active-page')
 
@@ -1542,6 +1821,10 @@ class MultiTabBrowserWindow(Gtk.Window):
         self.roland.window.set_title(page.get_title())
 
     def on_key_press_event(self, widget, event):
+        session_manager = self.roland.get_extension('SessionManager')
+        if session_manager is not None:
+            session_manager.user_interacted()
+
         i = self.notebook.get_current_page()
         page = self.notebook.get_nth_page(i)
         assert isinstance(page, BrowserTab), type(page)
@@ -1607,6 +1890,12 @@ class BrowserTab(BrowserView, Gtk.VBox):
                 icon.scale_simple(size, size, GdkPixbuf.InterpType.HYPER))
 
     def set_focus(self, widget):
+        # tabs started in the background mustn't take focus from the
+        # current one.
+        notebook = self.roland.window.notebook
+        if notebook.get_nth_page(notebook.get_current_page()) is not self:
+            return
+
         win = self.get_ancestor(Gtk.Window)
         if win is not None:
             win.set_focus(widget)
@@ -1617,8 +1906,49 @@ class BrowserTab(BrowserView, Gtk.VBox):
         notebook = self.roland.window.notebook
         notebook.set_current_page(notebook.page_num(self))
 
+    def is_discardable(self):
+        """Return True if the tab can be discarded without the user noticing
+        anything but a reload."""
+        if self.lazy or self.pinned:
+            return False
+
+        notebook = self.roland.window.notebook
+        if notebook.get_nth_page(notebook.get_current_page()) is self:
+            return False
+
+        uri = self.webview.get_uri()
+        if uri in (None, 'about:blank'):
+            return False
+
+        return not (self.webview.is_loading() or self.webview.props.is_playing_audio)
+
+    def discard(self):
+        """Destroy the tab's WebView, and with it the page's memory, returning
+        the tab to the lazy state restored tabs start in."""
+        if self.lazy:
+            return
+
+        title = self.get_title()
+        self.lazy_uri = self.webview.get_uri()
+        self.lazy_session = self.get_serialised_session_state()
+
+        self.lazy = True
+        self.remove(self.main_ui_box)
+        self.main_ui_box.destroy()
+        self.main_ui_box = None
+        self.webview = None
+        self.set_title('(unloaded) {}'.format(title))
+
     def close(self):
+        # closing the last tab quits, and that tab should stay in the session
+        quitting = len(self.roland.get_browsers()) == 1
+
         super().close()
+
+        session_manager = self.roland.get_extension('SessionManager')
+        if session_manager is not None and not quitting:
+            session_manager.tab_closed(self)
+
         notebook = self.roland.window.notebook
         notebook.remove_page(notebook.page_num(self))
         self.destroy()
@@ -1626,7 +1956,7 @@ class BrowserTab(BrowserView, Gtk.VBox):
 
 class Roland(RolandConfigBase, Gtk.Application):
     __gsignals__ = {
-        'new_browser': (GObject.SIGNAL_RUN_LAST, None, (str, str, str, bool, bool, str, str)),
+        'new_browser': (GObject.SIGNAL_RUN_LAST, None, (str, str, str, bool, bool, str, object)),
     }
 
     browser_view = BrowserTab
@@ -1639,8 +1969,15 @@ class Roland(RolandConfigBase, Gtk.Application):
         self.setup_run = False
         self.connect('command-line', self.on_command_line)
 
-        self.previous_sessions = []
-        self.load_config()
+        # roland:// page name -> handler
+        self.pages = {}
+        # names of the commands that can be run, see get_commands
+        self.available_commands = None
+
+        # closed tabs, when the ClosedTabs extension isn't enabled
+        self.previous_sessions = collections.deque(maxlen=10)
+        with profiling.phase('load_config'):
+            self.load_config()
         self.before_run()
 
     def get_browsers(self):
@@ -1704,7 +2041,8 @@ class Roland(RolandConfigBase, Gtk.Application):
 
     def before_run(self):
         for ext in self.extensions:
-            ext.before_run()
+            with profiling.phase('{}.before_run'.format(ext.name)):
+                ext.before_run()
 
     def find_browser(self, page_id):
         for browser in self.get_browsers():
@@ -1743,56 +2081,187 @@ class Roland(RolandConfigBase, Gtk.Application):
         else:
             super().add_window(window)
 
-    def add_close_history(self, uri, session):
+    def add_close_history(self, uri, session, title=None):
         if uri == 'about:blank':
             return
-        self.previous_sessions.append((uri, session))
 
-    def undo_close(self):
+        closed_tabs = self.get_extension('ClosedTabs')
+        if closed_tabs is not None:
+            closed_tabs.add(uri, title, session)
+        else:
+            self.previous_sessions.append((uri, session))
+
+    def undo_close(self, row_id=None):
+        """Reopen the most recently closed tab, or the given one from the
+        ClosedTabs history."""
+        closed_tabs = self.get_extension('ClosedTabs')
+        if closed_tabs is not None:
+            future = closed_tabs.pop(row_id)
+            future.add_done_callback(lambda future: GLib.idle_add(self.reopen_closed_tab, future))
+            return
+
         try:
-            previous_uri, previous_session = self.previous_sessions.pop()
+            previous = self.previous_sessions.pop()
         except IndexError:
             pass
         else:
+            self.reopen_closed_tab(storage.completed(previous))
+
+    def reopen_closed_tab(self, future):
+        try:
+            closed = future.result()
+        except Exception as e:
+            log.exception("Error reopening closed tab: {}", e)
+            return False
+
+        if closed is not None:
+            previous_uri, previous_session = closed
             if previous_uri != 'about:blank':
                 self.new_window(previous_uri, session=previous_session)
+        return False
 
     def load_config(self):
-        super().load_config()
-        init_logging()
+        with profiling.phase('config.py'):
+            super().load_config()
+        with profiling.phase('init_logging'):
+            init_logging()
 
-        if not hasattr(self.config, 'default_user_agent') or self.config.default_user_agent is None:
-            self.config.default_user_agent = WebKit2.Settings().props.user_agent
-        if not hasattr(self.config, 'enable_disk_cache'):
-            self.config.enable_disk_cache = False
+        self.set_config_defaults(self.config)
 
         self.browser_view = getattr(self.config, 'browser_view', self.browser_view)
+        self.keymaps = compile_keymaps(self.config)
 
+        self.register_custom_commands()
         self.set_disk_cache()
 
-        font = getattr(self.config, 'font', '')
-
-        style_text = getattr(self.config, 'style', DEFAULT_STYLE)
-        if not isinstance(style_text, bytes):
-            style_text = style_text.encode('utf8')
         self.style_provider = Gtk.CssProvider()
-        self.style_provider.load_from_data(style_text)
         Gtk.StyleContext.add_provider_for_screen(
             Gdk.Screen.get_default(), self.style_provider,
             Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION)
+        self.set_style()
 
         self.font_style_provider = Gtk.CssProvider()
         Gtk.StyleContext.add_provider_for_screen(
             Gdk.Screen.get_default(), self.font_style_provider,
             Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION)
 
-        self.change_font(font)
+        self.change_font(getattr(self.config, 'font', ''))
+        self.set_spell_checking()
 
+        self.extensions = sorted([ext(self) for ext in self.config.extensions], key=lambda ext: ext.sort_order)
+        self.index_extensions()
+
+    def set_config_defaults(self, config):
+        if not hasattr(config, 'default_user_agent') or config.default_user_agent is None:
+            config.default_user_agent = WebKit2.Settings().props.user_agent
+        if not hasattr(config, 'enable_disk_cache'):
+            config.enable_disk_cache = False
+
+    def register_custom_commands(self):
+        # name -> the command it replaced, if any, to put back on reload
+        self.custom_commands = {}
+        for name, func in getattr(self.config, 'custom_commands', {}).items():
+            self.custom_commands[name] = BrowserCommands.commands.get(name)
+            self.register_command(name, func)
+        self.available_commands = None
+
+    def set_style(self):
+        style_text = getattr(self.config, 'style', DEFAULT_STYLE)
+        if not isinstance(style_text, bytes):
+            style_text = style_text.encode('utf8')
+        self.style_provider.load_from_data(style_text)
+
+    def set_spell_checking(self):
         context = WebKit2.WebContext.get_default()
         context.set_spell_checking_enabled(getattr(self.config, 'spell_checking_enabled', False))
         context.set_spell_checking_languages(getattr(self.config, 'spell_checking_languages', []))
 
-        self.extensions = sorted([ext(self) for ext in self.config.extensions], key=lambda ext: ext.sort_order)
+    def reload_config(self):
+        """Run config.py again, and apply whatever changed to the running
+        browser, without restarting. Returns the names of the settings that
+        changed."""
+        old = config_settings(self.config)
+        try:
+            config = load_config()
+        except Exception as e:
+            log.exception("Error reloading config: {}", e)
+            self.notify("Error reloading config: {}".format(e), critical=True)
+            return set()
+
+        self.set_config_defaults(config)
+        changed = diff_config(old, config_settings(config))
+
+        if 'extensions' in changed:
+            # extensions hold state, like open databases, so they stay
+            self.notify("Restart roland to change which extensions are enabled")
+            changed.discard('extensions')
+        config.extensions = self.config.extensions
+
+        self.config = config
+        self.apply_config(changed)
+        return changed
+
+    def apply_config(self, changed):
+        """Apply the settings named in changed to the running browser.
+        Anything only read when needed, like most extension settings, is
+        picked up from the new config without any help."""
+        if not changed:
+            return
+
+        # functions in config.py see the new module's globals, which may have
+        # changed even if the functions haven't, so hooks, keymaps and
+        # commands always point at the new ones. All are cheap to rebuild.
+        # Dispatchers start again from the new keymap on the next key.
+        self.index_extensions()
+        self.keymaps = compile_keymaps(self.config)
+
+        for name, replaced in self.custom_commands.items():
+            if replaced is None:
+                del BrowserCommands.commands[name]
+            else:
+                BrowserCommands.commands[name] = replaced
+        self.register_custom_commands()
+
+        if 'browser_view' in changed:
+            self.browser_view = getattr(self.config, 'browser_view', BrowserTab)
+
+        if 'style' in changed:
+            self.set_style()
+        if 'font' in changed:
+            self.change_font(getattr(self.config, 'font', ''))
+        if changed & {'spell_checking_enabled', 'spell_checking_languages'}:
+            self.set_spell_checking()
+        if 'tab_bar_position' in changed:
+            self.set_tab_position(getattr(self.config, 'tab_bar_position', 'left'))
+
+        if changed & WEBVIEW_SETTINGS:
+            # lazy tabs get theirs when they start
+            for browser in self.get_browsers():
+                if not browser.lazy:
+                    browser.apply_settings()
+
+    def watch_config(self):
+        """Reload config whenever config.py is saved."""
+        self.config_reload_source = None
+        self.config_monitor = Gio.File.new_for_path(config_path('config.py')).monitor_file(
+            Gio.FileMonitorFlags.NONE, None)
+        self.config_monitor.connect('changed', self.on_config_changed)
+
+    def on_config_changed(self, monitor, file, other_file, event):
+        if event not in (Gio.FileMonitorEvent.CHANGES_DONE_HINT, Gio.FileMonitorEvent.CREATED):
+            return
+
+        # editors often write more than once when saving
+        if self.config_reload_source is not None:
+            GLib.source_remove(self.config_reload_source)
+        self.config_reload_source = GLib.timeout_add(200, self.on_config_reload_timeout)
+
+    def on_config_reload_timeout(self):
+        self.config_reload_source = None
+        changed = self.reload_config()
+        if changed:
+            self.notify("Reloaded config: {}".format(', '.join(sorted(changed))))
+        return False
 
     def change_font(self, font, size="8pt"):
         if not font:
@@ -1821,6 +2290,10 @@ class Roland(RolandConfigBase, Gtk.Application):
 
     def set_web_extensions_info(self, context):
         context.set_web_extensions_directory(config_path('webextensions/'))
+        # so web processes don't need to load config.py themselves
+        settings = web_process_settings(self.extensions, self.config)
+        if settings is not None:
+            context.set_web_extensions_initialization_user_data(GLib.Variant('s', settings))
 
     def setup(self):
         if self.setup_run:
@@ -1832,23 +2305,184 @@ class Roland(RolandConfigBase, Gtk.Application):
         WebKit2.WebContext.get_default().set_process_model(
             WebKit2.ProcessModel.MULTIPLE_SECONDARY_PROCESSES)
 
+        # roland:// pages may only be opened by roland, not linked to or
+        # framed by websites.
+        WebKit2.WebContext.get_default().register_uri_scheme('roland', self.on_roland_uri)
+        WebKit2.WebContext.get_default().get_security_manager().register_uri_scheme_as_local('roland')
+
         try:
             import setproctitle
             setproctitle.setproctitle('roland')
         except Exception:
             pass
 
-        self.window = MultiTabBrowserWindow(self)
-        self.set_tab_position(getattr(self.config, 'tab_bar_position', 'left'))
-        self.window.show_all()
-        self.add_window(self.window)
+        self.connect('shutdown', self.on_shutdown)
+
+        with profiling.phase('MultiTabBrowserWindow'):
+            self.window = MultiTabBrowserWindow(self)
+            self.set_tab_position(getattr(self.config, 'tab_bar_position', 'left'))
+            self.window.show_all()
+            self.add_window(self.window)
+
+        self.setup_extensions()
+
+        if getattr(self.config, 'reload_config_on_change', False):
+            self.watch_config()
+
+    def setup_extensions(self):
+        """Prepare every extension concurrently, then set up the critical
+        ones in order. Deferred ones are set up from the main loop as they
+        finish preparing, once the extensions they depend on have been."""
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=getattr(self.config, 'extension_setup_workers', 4),
+            thread_name_prefix='roland-setup')
+
+        def prepare(ext):
+            with profiling.phase('{}.prepare'.format(ext.name)):
+                ext.prepare()
+
+        self.deferred_setups = []
+        # names of extensions whose setup has been attempted
+        self.settled = set()
+
+        prepared = [(ext, storage.submit(executor, prepare, ext)) for ext in self.extensions]
+        executor.shutdown(wait=False)
+
+        for ext, future in prepared:
+            if ext.deferred:
+                self.deferred_setups.append((ext, future))
+                future.add_done_callback(lambda f: GLib.idle_add(self.setup_deferred))
+            else:
+                self.setup_extension(ext, future)
+
+    def setup_extension(self, ext, future):
+        self.settled.add(ext.name)
+        try:
+            future.result()
+            with profiling.phase('{}.setup'.format(ext.name)):
+                ext.setup()
+        except Exception as e:
+            log.exception("Failure setting up {}: {}".format(ext.name, e))
+            self.notify("Failure setting up {}: {}".format(ext.name, e), critical=True)
+        else:
+            ext.ready = True
+            if ext.deferred:
+                self.add_hooks(ext)
+                # commands needing it are available now
+                self.available_commands = None
+
+    def setup_deferred(self):
+        enabled = {ext.name for ext in self.extensions}
+
+        progress = True
+        while progress:
+            progress = False
+            for ext, future in list(self.deferred_setups):
+                if future.done() and dependencies_settled(ext, self.settled, enabled):
+                    self.deferred_setups.remove((ext, future))
+                    self.setup_extension(ext, future)
+                    progress = True
+
+        if self.deferred_setups and all(future.done() for ext, future in self.deferred_setups):
+            # nothing left is waiting to prepare, so they depend on each other
+            log.error("Circular dependencies between {}, setting them up in order",
+                      ', '.join(ext.name for ext, future in self.deferred_setups))
+            for ext, future in self.deferred_setups:
+                self.setup_extension(ext, future)
+            self.deferred_setups = []
+        return False
+
+    def on_shutdown(self, app):
+        self.finish_profiling()
 
         for ext in self.extensions:
+            if ext.deferred and not ext.ready:
+                continue
             try:
-                ext.setup()
+                ext.shutdown()
             except Exception as e:
-                log.exception("Failure setting up {}: {}".format(ext.name, e))
-                self.notify("Failure setting up {}: {}".format(ext.name, e), critical=True)
+                log.exception("Failure shutting down {}: {}".format(ext.name, e))
+
+        # let any queued writes finish before the process goes away
+        storage.close_all()
+
+    def finish_profiling(self):
+        paths = profiling.finish(cache_path(''))
+        if paths is not None:
+            log.info("Startup profile:\n{}", profiling.profiler.table())
+            log.info("Startup profile written to {}", ', '.join(paths))
+
+    def register_page(self, name, handler, title=None):
+        """Serve roland://name/ from handler(query), which returns the page's
+        content as HTML, or a Future of it."""
+        self.pages[name] = (title or name, handler)
+
+    def render_page(self, name, query):
+        """Return a Future of the content of roland://name/?query."""
+        title, handler = self.pages[name]
+        try:
+            content = handler(query)
+        except Exception as e:
+            content = storage.Future()
+            content.set_exception(e)
+
+        if not isinstance(content, concurrent.futures.Future):
+            content = storage.completed(content)
+        return content
+
+    def page_query(self, uri):
+        return {k: v[-1] for (k, v) in urlparse.parse_qs(uri.query).items()}
+
+    def on_roland_uri(self, request):
+        uri = urlparse.urlparse(request.get_uri())
+
+        if uri.netloc not in self.pages:
+            request.finish_error(GLib.Error.new_literal(
+                Gio.io_error_quark(), 'No such page: {}'.format(uri.netloc), int(Gio.IOErrorEnum.NOT_FOUND)))
+            return
+
+        content = self.render_page(uri.netloc, self.page_query(uri))
+        content.add_done_callback(lambda future: GLib.idle_add(self.finish_page, request, uri.netloc, future))
+
+    def finish_page(self, request, name, future):
+        try:
+            content = future.result()
+        except Exception as e:
+            log.exception("Error rendering {}", request.get_uri())
+            content = '<pre>Error rendering {}: {}</pre>'.format(html.escape(request.get_uri()), html.escape(str(e)))
+
+        data = pages.render_page(self.pages[name][0], content).encode('utf8')
+        stream = Gio.MemoryInputStream.new_from_bytes(GLib.Bytes(data))
+        request.finish(stream, len(data), 'text/html')
+        return False
+
+    def update_pages(self, name):
+        """Render every open roland://name/ page again and replace its content
+        in place, without reloading it. Returns how many are open."""
+        prefix = 'roland://{}/'.format(name)
+
+        count = 0
+        for browser in self.get_browsers():
+            uri = None if browser.lazy else browser.webview.get_uri()
+            if not uri or not uri.startswith(prefix):
+                continue
+
+            count += 1
+            content = self.render_page(name, self.page_query(urlparse.urlparse(uri)))
+            content.add_done_callback(
+                lambda future, browser=browser: GLib.idle_add(self.replace_page_content, browser, future))
+        return count
+
+    def replace_page_content(self, browser, future):
+        try:
+            content = future.result()
+        except Exception:
+            log.exception("Error updating {}", browser.webview.get_uri())
+            return False
+
+        if not browser.lazy:
+            browser.webview.run_javascript(pages.replace_content_script(content), None, None, None)
+        return False
 
     def on_command_line(self, roland, command_line):
         if not command_line.get_is_remote():
@@ -1872,49 +2506,38 @@ class Roland(RolandConfigBase, Gtk.Application):
     def new_window(self, url, text='', html='', background=False, lazy=False, title=None, session=None):
         self.emit('new-browser', url, text, html, background, lazy, title, session)
 
+    def register_command(self, name, func, help=None, requires=(), private=False):
+        """Add a command that runs func(browser, *args), for config and
+        extensions to add their own."""
+        BrowserCommands.commands[name] = Command(
+            name=name, attribute=None, func=func, help=help or func.__doc__,
+            extensions=tuple(requires), private=private)
+        self.available_commands = None
+
     def get_help(self, name):
-        command = getattr(BrowserCommands, name, None)
-
-        if command is None:
-            # renamed function
-            for func in dir(BrowserCommands):
-                func = getattr(BrowserCommands, func)
-                if getattr(func, '__name__', None) == name:
-                    command = func
-                    break
-        help = getattr(command, '__doc__', None) or 'No help available'
-        return help
+        command = BrowserCommands.commands.get(name)
+        return (command is not None and command.help) or 'No help available'
 
     def get_commands(self):
-        def name(f):
-            func = getattr(BrowserCommands, f)
-            return getattr(func, '__name__', f)
-
-        def is_private(name):
-            if name.startswith('__'):
-                return True
-            attr = getattr(BrowserCommands, name)
-            return getattr(attr, 'private', False)
-
-        def meets_requirements(f):
-            func = getattr(BrowserCommands, f)
-            extensions = getattr(func, 'extensions', [])
-            return all(self.is_enabled(ext) for ext in extensions)
-
-        return [name(f) for f in dir(BrowserCommands) if not is_private(f) and
-                meets_requirements(f)]
+        # extensions don't change once loaded, so neither does this
+        if self.available_commands is None:
+            self.available_commands = [
+                command.name for command in BrowserCommands.commands.values()
+                if not command.private and all(self.is_enabled(ext) for ext in command.extensions)
+            ]
+        return self.available_commands
 
     def most_popular_urls(self):
         if not self.is_enabled('HistoryManager'):
             return []
         return self.get_extension('HistoryManager').most_popular_urls()
 
-    def hooks(self, name, *args, default=None):
-        return getattr(self.config, name, lambda *args: default)(*args)
-
     def quit(self):
-        if self.is_enabled('DownloadManager') and self.downloads:
-            self.notify("Not quitting, {} downloads in progress.".format(len(self.downloads)))
-            return
+        if self.is_enabled('DownloadManager'):
+            # paused downloads can be picked up again after restarting
+            in_progress = [d for d in self.downloads.values() if getattr(d, 'state', None) != PAUSED]
+            if in_progress:
+                self.notify("Not quitting, {} downloads in progress.".format(len(in_progress)))
+                return
 
         Gtk.Application.quit(self)
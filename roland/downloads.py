@@ -0,0 +1,568 @@
+"""Roland's own download engine.
+
+WebKit starts every download as soon as it's requested and runs them all at
+full speed, with no way to queue, pause or throttle them. With the
+download_scheduler setting, plain GET downloads are instead handed over to a
+DownloadScheduler, which runs at most max_active of them at once, highest
+priority first, and limits each one and all of them together to a configured
+rate. It requests them again itself, outside of WebKit, so it's opt-in.
+
+Files on servers that support Range requests can be split into segments
+fetched over separate connections into a preallocated file. Progress is
+kept in a sidecar state file next to the download, so a partial download can
+be picked up again after roland restarts.
+
+Every download's final name is reserved up front by creating it empty with
+O_EXCL, so concurrent downloads never pick the same one, and the data goes to
+a .part file next to it that's renamed over the reservation once complete.
+
+Transfers run on worker threads. Download objects mimic the parts of
+WebKit2.Download that the rest of roland uses, so both kinds can sit in
+roland.downloads together.
+"""
+
+import itertools
+import json
+import os
+import threading
+import time
+
+QUEUED = 'queued'
+ACTIVE = 'active'
+PAUSED = 'paused'
+FINISHED = 'finished'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+STATE_SUFFIX = '.roland-download'
+# request headers kept in state files, which sit in the downloads folder, so
+# never anything like Authorization or Cookie
+PERSISTED_HEADERS = ('user-agent',)
+PART_SUFFIX = '.part'
+
+download_counter = itertools.count()
+
+
+class DownloadError(Exception):
+    pass
+
+
+def split_ranges(total, count):
+    """Split total bytes into at most count contiguous [start, end) ranges."""
+    size = max(1, -(-total // count))
+    return [(start, min(start + size, total)) for start in range(0, total, size)]
+
+
+def parse_content_range(value):
+    """Return the complete length from a Content-Range header, or None if
+    it's missing or unknown."""
+    if not value or not value.startswith('bytes '):
+        return None
+
+    total = value.rpartition('/')[2]
+    return int(total) if total.isdigit() else None
+
+
+def preallocate(f, size):
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except (AttributeError, OSError):
+        # not supported by the platform or filesystem
+        f.truncate(size)
+
+
+def part_path(path):
+    return path + PART_SUFFIX
+
+
+class Reservations:
+    """Hands out unused file names, trying filename, then filename.1,
+    filename.2 and so on.
+
+    Each name is claimed by creating it with O_EXCL, so it can't be taken by
+    another download in the meantime. The next suffix to try is remembered
+    for each name, so downloading many files with the same name doesn't
+    check every earlier one again.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def reserve(self, directory, filename):
+        base = os.path.join(directory, filename)
+
+        with self.lock:
+            i = self.counters.get(base, 0)
+            created_directory = False
+            while True:
+                path = base if i == 0 else '{}.{}'.format(base, i)
+                try:
+                    fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+                except FileExistsError:
+                    i += 1
+                    continue
+                except FileNotFoundError:
+                    # only once, so a directory that keeps going away or can't
+                    # hold the file doesn't keep us here
+                    if created_directory:
+                        raise
+                    os.makedirs(directory, exist_ok=True)
+                    created_directory = True
+                    continue
+
+                os.close(fd)
+                self.counters[base] = i + 1
+                return path
+
+
+def release(path):
+    """Remove a reserved download and anything left from fetching it."""
+    for p in (path, part_path(path), path + STATE_SUFFIX):
+        try:
+            os.unlink(p)
+        except FileNotFoundError:
+            pass
+
+
+def move_into_place(path):
+    """Move a finished download's data into its reserved name."""
+    os.replace(part_path(path), path)
+
+
+class TokenBucket:
+    """Limits throughput to rate bytes per second, allowing bursts of up to
+    burst bytes. Safe to share between threads."""
+
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.clock = clock
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        """Take amount bytes from the bucket, returning how many seconds to
+        wait before sending them."""
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            # going into debt means the next caller waits for it too
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+
+class Download:
+    def __init__(self, scheduler, url, path, headers=None, cookies=None, priority=0, rate=None):
+        self.scheduler = scheduler
+        self.url = url
+        self.path = path
+        self.part_path = part_path(path)
+        self.headers = dict(headers or {})
+        # only sent to the original host, never after a redirect
+        self.cookies = cookies
+        self.priority = priority
+        self.limiter = TokenBucket(rate) if rate else None
+
+        self.state = QUEUED
+        self.current_size = 0
+        self.total_size = 0
+        self.error = None
+
+        # [start, end, position] for each byte range of a ranged download
+        self.segments = []
+        self.lock = threading.Lock()
+        self.state_saved = 0
+
+        # position in the queue among downloads of the same priority
+        self.order = next(download_counter)
+        # set to interrupt the current transfer, a new one for each transfer
+        self.stop = None
+        self.running = False
+
+    def __repr__(self):
+        return '<Download {} {} {}>'.format(self.state, self.url, self.path)
+
+    # the parts of WebKit2.Download roland uses
+
+    def get_destination(self):
+        return 'file://' + self.path
+
+    def get_current_size(self):
+        return self.current_size
+
+    def get_total_size(self):
+        return self.total_size
+
+    def get_progress(self):
+        if self.state == FINISHED:
+            return 1.0
+        if not self.total_size:
+            return 0.0
+        return self.current_size / self.total_size
+
+    def cancel(self):
+        self.scheduler.cancel(self)
+
+    def pause(self):
+        self.scheduler.pause(self)
+
+    def resume(self):
+        self.scheduler.resume(self)
+
+
+class DownloadScheduler:
+    """Queue of downloads, at most max_active of which run at once.
+
+    Downloads of at least segment_min_size bytes are split into segments
+    fetched concurrently.
+
+    callback(download) is called from whichever thread the download
+    finished, failed or was cancelled on.
+    """
+    chunk_size = 64 * 1024
+    # seconds between writes of a download's state file
+    state_interval = 1
+
+    def __init__(self, max_active=3, rate=None, per_download_rate=None, callback=None, opener=None, timeout=60,
+                 segments=1, segment_min_size=16 * 1024 * 1024):
+        self.max_active = max_active
+        self.limiter = TokenBucket(rate) if rate else None
+        self.per_download_rate = per_download_rate
+        self.segments = segments
+        self.segment_min_size = segment_min_size
+        self.callback = callback
+        # built on first use, urllib.request being slow to import
+        self.opener = opener
+        self.timeout = timeout
+
+        self.lock = threading.RLock()
+        self.downloads = []
+
+    def add(self, url, path, headers=None, cookies=None, priority=0, rate=None, paused=False):
+        download = Download(
+            self, url, path, headers=headers, cookies=cookies, priority=priority,
+            rate=rate or self.per_download_rate)
+        if paused:
+            download.state = PAUSED
+
+        with self.lock:
+            self.downloads.append(download)
+        self.schedule()
+        return download
+
+    def active(self):
+        with self.lock:
+            return [d for d in self.downloads if d.running]
+
+    def queued(self):
+        """Return queued downloads in the order they'll start."""
+        with self.lock:
+            queued = [d for d in self.downloads if d.state == QUEUED and not d.running]
+        return sorted(queued, key=lambda d: (-d.priority, d.order))
+
+    def schedule(self):
+        with self.lock:
+            slots = self.max_active - len(self.active())
+            for download in self.queued()[:max(0, slots)]:
+                download.state = ACTIVE
+                download.running = True
+                download.stop = threading.Event()
+                threading.Thread(
+                    target=self.run, args=(download, download.stop),
+                    name='roland-download-{}'.format(download.order), daemon=True,
+                ).start()
+
+    def set_priority(self, download, priority):
+        with self.lock:
+            download.priority = priority
+        self.schedule()
+
+    def pause(self, download):
+        """Stop a download, or keep a queued one from starting, until it's
+        resumed."""
+        with self.lock:
+            if download.state in (QUEUED, ACTIVE):
+                download.state = PAUSED
+                if download.stop is not None:
+                    download.stop.set()
+        self.schedule()
+
+    def resume(self, download):
+        with self.lock:
+            if download.state == PAUSED:
+                download.state = QUEUED
+        self.schedule()
+
+    def cancel(self, download):
+        with self.lock:
+            if download.state in (FINISHED, FAILED, CANCELLED):
+                return
+
+            download.state = CANCELLED
+            if download.running:
+                # the transfer cleans up after itself
+                download.stop.set()
+                return
+
+            self.downloads.remove(download)
+
+        self.remove_partial(download)
+        self.done(download)
+
+    def remove_partial(self, download):
+        release(download.path)
+
+    def done(self, download):
+        if self.callback is not None:
+            self.callback(download)
+
+    def run(self, download, stop):
+        complete = False
+        error = None
+        try:
+            complete = self.transfer(download, stop)
+            if complete and download.state != CANCELLED:
+                move_into_place(download.path)
+        except Exception as e:
+            complete = False
+            error = e
+
+        with self.lock:
+            download.running = False
+
+            if download.state == CANCELLED:
+                finished = True
+                self.remove_partial(download)
+            elif complete:
+                # even if it was paused just as it finished
+                finished = True
+                download.state = FINISHED
+            elif download.state == PAUSED:
+                # picked up again on resume
+                finished = False
+            else:
+                finished = True
+                download.state = FAILED
+                download.error = error
+
+            if finished:
+                self.downloads.remove(download)
+
+        self.schedule()
+        if finished:
+            self.done(download)
+
+    def open(self, request):
+        if self.opener is None:
+            import urllib.request
+            self.opener = urllib.request.build_opener()
+        return self.opener.open(request, timeout=self.timeout)
+
+    def request(self, download, start=None, end=None):
+        import urllib.request
+
+        request = urllib.request.Request(download.url, headers=download.headers)
+        if download.cookies:
+            request.add_unredirected_header('Cookie', download.cookies)
+        if start is not None:
+            request.add_header('Range', 'bytes={}-{}'.format(start, '' if end is None else end - 1))
+        return request
+
+    def transfer(self, download, stop):
+        """Fetch the download, returning True if it was all fetched, or False
+        if it was stopped part way."""
+        response = None
+        if not self.load_state(download):
+            # asking for a range finds out whether the server supports them
+            response = self.open(self.request(download, 0))
+            total = parse_content_range(response.headers.get('Content-Range')) if response.status == 206 else None
+
+            if total is None:
+                with response:
+                    return self.transfer_whole(download, response, stop)
+
+            count = self.segments if total >= self.segment_min_size else 1
+            download.total_size = total
+            download.segments = [[start, end, start] for (start, end) in split_ranges(total, count)]
+            with open(download.part_path, 'wb') as f:
+                preallocate(f, total)
+            self.save_state(download, force=True)
+
+        try:
+            return self.transfer_segments(download, stop, response)
+        finally:
+            if response is not None:
+                response.close()
+
+    def transfer_whole(self, download, response, stop):
+        """Fetch a download from a server that doesn't support ranges, which
+        can only ever start from the beginning."""
+        length = response.headers.get('Content-Length')
+        download.total_size = int(length) if length else 0
+        download.current_size = 0
+
+        with open(download.part_path, 'wb') as f:
+            while not stop.is_set():
+                chunk = response.read(self.chunk_size)
+                if not chunk:
+                    return True
+
+                self.throttle(download, len(chunk), stop)
+                f.write(chunk)
+                download.current_size += len(chunk)
+
+        return False
+
+    def transfer_segments(self, download, stop, response=None):
+        """Fetch the remaining parts of each segment concurrently. response
+        is an already open response from the start of the file."""
+        errors = []
+        failed = threading.Event()
+
+        def run(segment, response):
+            try:
+                self.transfer_segment(download, f, segment, response, stop, failed)
+            except Exception as e:
+                errors.append(e)
+                failed.set()
+
+        with open(download.part_path, 'r+b') as f:
+            threads = []
+            for segment in download.segments:
+                if segment[2] >= segment[1]:
+                    continue
+
+                if response is not None and segment[2] == 0:
+                    segment_response, response = response, None
+                else:
+                    segment_response = None
+
+                threads.append(threading.Thread(
+                    target=run, args=(segment, segment_response),
+                    name='roland-download-{}-{}'.format(download.order, segment[0]), daemon=True))
+
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.save_state(download, force=True)
+
+            if errors:
+                raise errors[0]
+            if stop.is_set():
+                return False
+
+            # every segment says it's complete, make sure the file agrees
+            size = os.fstat(f.fileno()).st_size
+            if size != download.total_size or any(position < end for (start, end, position) in download.segments):
+                raise DownloadError('Expected {} bytes, got {}'.format(download.total_size, size))
+
+        self.remove_state(download)
+        return True
+
+    def transfer_segment(self, download, f, segment, response, stop, failed):
+        start, end, position = segment
+
+        if response is None:
+            response = self.open(self.request(download, position, end))
+            if response.status != 206:
+                response.close()
+                raise DownloadError('Server ignored the range request for bytes {}-{}'.format(position, end - 1))
+
+        with response:
+            while segment[2] < end and not (stop.is_set() or failed.is_set()):
+                chunk = response.read(min(self.chunk_size, end - segment[2]))
+                if not chunk:
+                    raise DownloadError('Connection closed at byte {}'.format(segment[2]))
+
+                self.throttle(download, len(chunk), stop)
+                os.pwrite(f.fileno(), chunk, segment[2])
+
+                with download.lock:
+                    segment[2] += len(chunk)
+                    download.current_size += len(chunk)
+                self.save_state(download)
+
+    def state_path(self, download):
+        return download.path + STATE_SUFFIX
+
+    def load_state(self, download):
+        """Pick up a ranged download from its state file, returning False if
+        there isn't one for this download."""
+        try:
+            with open(self.state_path(download), 'r') as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return False
+
+        if state.get('url') != download.url or not os.path.exists(download.part_path):
+            return False
+
+        download.total_size = state['total']
+        download.segments = state['segments']
+        download.current_size = sum(position - start for (start, end, position) in download.segments)
+        return True
+
+    def save_state(self, download, force=False):
+        with download.lock:
+            now = time.monotonic()
+            if not force and now - download.state_saved < self.state_interval:
+                return
+            download.state_saved = now
+
+            state = {
+                'url': download.url,
+                'headers': persisted_headers(download.headers),
+                'total': download.total_size,
+                'segments': download.segments,
+            }
+
+            path = self.state_path(download)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.replace(path + '.tmp', path)
+
+    def remove_state(self, download):
+        try:
+            os.unlink(self.state_path(download))
+        except FileNotFoundError:
+            pass
+
+    def throttle(self, download, amount, stop):
+        wait = 0
+        for limiter in (self.limiter, download.limiter):
+            if limiter is not None:
+                wait = max(wait, limiter.reserve(amount))
+        if wait:
+            stop.wait(wait)
+
+
+def persisted_headers(headers):
+    return {name: value for (name, value) in headers.items() if name.lower() in PERSISTED_HEADERS}
+
+
+def find_partial_downloads(directory):
+    """Return (url, path, headers) for each download in directory with a
+    state file left behind, e.g. by restarting part way through."""
+    partial = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(STATE_SUFFIX):
+            continue
+
+        path = os.path.join(directory, name[:-len(STATE_SUFFIX)])
+        try:
+            with open(os.path.join(directory, name), 'r') as f:
+                state = json.load(f)
+        except ValueError:
+            continue
+
+        if os.path.exists(part_path(path)):
+            partial.append((state['url'], path, persisted_headers(state.get('headers', {}))))
+    return partial
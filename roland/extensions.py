@@ -1,33 +1,63 @@
 import base64
+import concurrent.futures
 import datetime
 import hashlib
+import hmac
 import itertools
-import json
 import os
-import re
-import sqlite3
-from collections import namedtuple
-from urllib import request, parse as urlparse
+import threading
+import time
+import zlib
+from collections import Counter, deque, namedtuple
+from urllib import parse as urlparse
 
 import logbook
-import msgpack
-from Crypto import Random
-from Crypto.Cipher import AES
-from gi.repository import Gio, WebKit2
-from werkzeug import parse_dict_header
-
-from .utils import config_path
+from gi.repository import Gio, GLib, WebKit2
+
+from . import profiling
+from .downloads import (CANCELLED, FINISHED, PART_SUFFIX, DownloadScheduler, Reservations,
+                        find_partial_downloads, move_into_place, part_path, release)
+from .hsts import CHROMIUM_PRELOAD_URL, DEFAULT_PRELOAD_PATH, PreloadList, build_preload_list
+from .memory import choose_reclaim, memory_excess, process_cpu_time, process_memory, system_memory
+from .postprocess import ChecksumMismatch, process_download
+from .progress import ProgressSampler, render_downloads_page, status_text
+from .session import (InlineBlob, RestoreScheduler, SessionJournal, tabs_to_discard,
+                      truncate_back_forward_list)
+from .storage import completed, open_database, submit
+from .tasks import Task, cpu_percent, render_tasks_page
+from .utils import blocking_wait, cache_path, config_path
 
 log = logbook.Logger('roland.extensions')
 
 
 class Extension:
     sort_order = 0
+    # names of the hooks this extension has methods for, see
+    # RolandConfigBase.hooks
+    handles = ()
+    # whether web processes run this extension too, and the config it needs
+    # there, see utils.web_process_settings
+    web_process = False
+    web_process_config = ()
+    # deferred extensions are set up after the window is shown, once the
+    # extensions named in depends have been, instead of before anything
+    # loads. Until ready is set, when setup has succeeded, get_extension
+    # doesn't return them.
+    deferred = False
+    depends = ()
+    ready = False
 
     def __init__(self, roland):
         self.roland = roland
         self.name = self.__class__.__name__
 
+    def prepare(self):
+        """Slow setup that doesn't need GTK or WebKit, like reading files.
+        Runs on a worker thread, at the same time as other extensions'
+        prepare, and always before setup.
+        """
+        pass
+
     def setup(self):
         """Setup method, for setting any state in the extension.
 
@@ -40,8 +70,15 @@ class Extension:
         typically be used."""
         pass
 
+    def shutdown(self):
+        """Called when Roland is shutting down, for flushing any state the
+        extension has buffered."""
+        pass
+
 
 class ClipboardManager(Extension):
+    web_process = True
+
     def set_text(self, text):
         from gi.repository import Gdk, Gtk
         primary = Gtk.Clipboard.get(Gdk.SELECTION_PRIMARY)
@@ -56,6 +93,7 @@ class ClipboardManager(Extension):
 class NotificationManager(Extension):
     # allow other things to notify
     sort_order = -1
+    web_process = True
 
     def setup(self):
         from gi.repository import Notify
@@ -74,86 +112,282 @@ class NotificationManager(Extension):
 
 
 class HistoryManager(Extension):
-    def setup(self):
-        self.create_history_db()
+    web_process = True
+    deferred = True
 
-    def create_history_db(self):
-        conn = self.get_history_db()
-
-        cursor = conn.cursor()
-        cursor.execute('create table if not exists history '
-                       '(url text, view_count integer)')
-        conn.commit()
-        conn.close()
-
-    def get_history_db(self):
-        return sqlite3.connect(config_path('history.db'))
+    def setup(self):
+        self.popular_urls = []
+        self.db = open_database('history.db', schema=[
+            'create table if not exists history '
+            '(url text, view_count integer)',
+        ])
+        self.refresh_popular_urls()
 
     def update(self, url):
-        if url == 'about:blank':
+        if url == 'about:blank' or url.startswith('roland://'):
             return False
 
-        conn = self.get_history_db()
-        cursor = conn.cursor()
+        self.db.batch([
+            ('update history set view_count = view_count + 1 '
+             'where url = ?', (url,)),
+            ('insert into history (url, view_count) '
+             'select ?, 1 where changes() = 0', (url,)),
+        ])
 
-        cursor.execute('select url from history where url = ?', (url,))
-        rec = cursor.fetchone()
+        return False
 
-        if rec is None:
-            cursor.execute('insert into history (url, view_count)'
-                           'values (?, 1)', (url,))
-        else:
-            cursor.execute('update history set view_count = view_count + 1 '
-                           'where url = ?', (url,))
-        conn.commit()
-        conn.close()
+    def refresh_popular_urls(self):
+        def done(future):
+            if future.exception() is None:
+                self.popular_urls = [url for (url,) in future.result()]
 
-        return False
+        future = self.db.fetchall('select url from history order by view_count desc limit 500')
+        future.add_done_callback(done)
+        return future
 
     def most_popular_urls(self):
-        conn = self.get_history_db()
-        cursor = conn.cursor()
-        cursor.execute('select url from history order by view_count desc limit 500')
-        urls = [url for (url,) in cursor.fetchall()]
-        conn.close()
-        return urls
+        # Return what we have straight away rather than waiting on the
+        # database, and refresh it for next time.
+        self.refresh_popular_urls()
+        return self.popular_urls
 
 
 class DownloadManager(Extension):
     save_location = os.path.expanduser('~/Downloads/')
+    scheduler = None
+    # seconds between samples of download progress
+    progress_interval = 1
+
+    def __init__(self, roland):
+        super().__init__(roland)
+        self.reservations = Reservations()
+        self.sampler = ProgressSampler()
+        self.statuses = []
+        self.progress_source = None
+        # location -> SHA-256 the user expects the download to have
+        self.expected_checksums = {}
+        # locations of downloads restored from state files, which have no
+        # cookies until they're resumed
+        self.restored = set()
 
     def setup(self):
         self.roland.downloads = {}
+        self.roland.register_page('downloads', self.downloads_page, 'Downloads')
+
+        # any of 'hash', 'verify', 'extract' and 'open', see
+        # postprocess.process_download
+        self.post_process_steps = getattr(self.roland.config, 'download_post_process', ['verify'])
+        self.post_process_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=getattr(self.roland.config, 'download_post_process_workers', 2),
+            thread_name_prefix='roland-post-download')
+
+        # off by default: scheduled downloads are fetched again with urllib,
+        # which doesn't use WebKit's proxy settings, TLS exceptions or HSTS,
+        # and breaks links that only work once.
+        if getattr(self.roland.config, 'download_scheduler', False):
+            self.scheduler = DownloadScheduler(
+                max_active=getattr(self.roland.config, 'download_max_active', 3),
+                rate=getattr(self.roland.config, 'download_rate_limit', None),
+                per_download_rate=getattr(self.roland.config, 'download_rate_limit_per_download', None),
+                callback=lambda download: GLib.idle_add(self.scheduled_download_done, download),
+                segments=getattr(self.roland.config, 'download_segments', 1),
+                segment_min_size=getattr(self.roland.config, 'download_segment_min_size', 16 * 1024 * 1024),
+            )
+            self.restore_partial_downloads()
 
         context = WebKit2.WebContext.get_default()
         context.connect('download-started', self.download_started)
 
+    def restore_partial_downloads(self):
+        """Add downloads left part way through last time as paused, to be
+        picked up with resume-download."""
+        try:
+            partial = find_partial_downloads(self.save_location)
+        except FileNotFoundError:
+            return
+
+        for uri, path, headers in partial:
+            self.roland.downloads[path] = self.scheduler.add(uri, path, headers=headers, paused=True)
+            self.restored.add(path)
+        self.watch_progress()
+
+        if partial:
+            self.roland.notify('{} unfinished downloads, use resume-download to continue them'.format(len(partial)))
+
     def download_started(self, webcontext, download):
-        download.connect('failed', self.failed)
-        download.connect('finished', self.finished)
         download.connect('decide-destination', self.decide_destination)
-        download.connect('created-destination', self.created_destination)
 
     def created_destination(self, download, destination):
         self.roland.notify("Downloading {}".format(destination))
 
     def decide_destination(self, download, suggested_filename):
-        save_path = os.path.join(
-            self.save_location, suggested_filename)
+        save_path = self.reservations.reserve(self.save_location, suggested_filename)
 
-        orig_save_path = save_path
-        for i in itertools.count(1):
-            if os.path.exists(save_path):
-                save_path = orig_save_path + ('.%d' % i)
-            else:
-                break
+        if self.should_schedule(download):
+            # fetch it ourselves, so it can be queued and throttled
+            request = download.get_request()
+            download.cancel()
+            self.schedule(request.get_uri(), save_path, self.request_headers(request))
+            return True
+
+        download.connect('failed', self.failed)
+        download.connect('finished', self.finished)
+        download.connect('created-destination', self.created_destination)
 
-        download.set_destination('file://' + save_path)
+        download.set_destination('file://' + part_path(save_path))
         self.roland.downloads[save_path] = download
+        self.watch_progress()
         return True
 
-    def failed(self, download, error):
+    def should_schedule(self, download):
+        if self.scheduler is None:
+            return False
+
+        request = download.get_request()
+        method = request.get_http_method() or 'GET'
+        return method == 'GET' and urlparse.urlparse(request.get_uri()).scheme in ('http', 'https')
+
+    def request_headers(self, request):
+        headers = {'User-Agent': self.roland.config.default_user_agent}
+
+        def add_header(name, value):
+            if name.lower() not in ('cookie', 'range'):
+                headers[name] = value
+
+        http_headers = request.get_http_headers()
+        if http_headers is not None:
+            http_headers.foreach(add_header)
+        return headers
+
+    def get_cookies(self, uri, callback):
+        """Call callback with the Cookie header WebKit would send to uri, or
+        None."""
+        def have_cookies(cookie_manager, result):
+            from gi.repository import Soup
+
+            try:
+                cookies = cookie_manager.get_cookies_finish(result)
+            except Exception as e:
+                log.exception('Error getting cookies for download of {}: {}', uri, e)
+                cookies = []
+
+            callback(Soup.cookies_to_cookie_header(cookies) if cookies else None)
+
+        cookie_manager = WebKit2.WebContext.get_default().get_cookie_manager()
+        cookie_manager.get_cookies(uri, None, have_cookies)
+
+    def schedule(self, uri, path, headers):
+        def have_cookies(cookies):
+            download = self.scheduler.add(uri, path, headers=headers, cookies=cookies)
+            self.roland.downloads[path] = download
+            self.roland.notify("Downloading {}".format(path))
+            self.watch_progress()
+
+        self.get_cookies(uri, have_cookies)
+
+    def resume(self, download):
+        """Resume a paused download, first getting the cookies of one
+        restored from a previous run, as they're never saved with it."""
+        if download.path not in self.restored:
+            download.resume()
+            return
+
+        def have_cookies(cookies):
+            self.restored.discard(download.path)
+            download.cookies = cookies
+            download.resume()
+
+        self.get_cookies(download.url, have_cookies)
+
+    def watch_progress(self):
+        """Sample progress every progress_interval seconds, for as long as
+        there are downloads."""
+        if self.progress_source is None and self.roland.downloads:
+            self.sample_progress()
+            self.progress_source = GLib.timeout_add_seconds(self.progress_interval, self.sample_progress)
+
+    def sample_progress(self):
+        self.statuses = self.sampler.sample(self.roland.downloads)
+
+        text = status_text(self.statuses)
+        for browser in self.roland.get_browsers():
+            status_line = getattr(browser, 'status_line', None)
+            if status_line is not None:
+                status_line.set_downloads_text(text)
+        self.roland.update_pages('downloads')
+
+        if not self.roland.downloads:
+            self.progress_source = None
+            return False
+        return True
+
+    def downloads_page(self, query):
+        return render_downloads_page(self.statuses)
+
+    def shutdown(self):
+        self.post_process_executor.shutdown(wait=False)
+
+    def expect_checksum(self, location, checksum):
+        self.expected_checksums[location] = checksum
+
+    def post_process(self, location):
+        """Run the configured steps on a finished download on a worker
+        thread."""
+        expected = self.expected_checksums.pop(location, None)
+        future = submit(self.post_process_executor, process_download, location, self.post_process_steps, expected)
+        future.add_done_callback(lambda future: GLib.idle_add(self.post_processed, location, future))
+
+    def post_processed(self, location, future):
+        try:
+            result = future.result()
+        except ChecksumMismatch as e:
+            self.roland.notify('Checksum mismatch: {}'.format(e), critical=True)
+            return False
+        except Exception as e:
+            log.exception('Error processing download {}: {}', location, e)
+            self.roland.notify('Error processing download {}: {}'.format(location, e), critical=True)
+            return False
+
+        if result.expected is not None:
+            self.roland.notify('Checksum verified: {}'.format(location))
+        elif result.sha256 is not None:
+            self.roland.notify('SHA-256 of {}: {}'.format(location, result.sha256))
+
+        if result.extracted is not None:
+            self.roland.notify('Extracted {} to {}'.format(location, result.extracted))
+
+        if 'open' in self.post_process_steps:
+            path = result.extracted or location
+            try:
+                Gio.AppInfo.launch_default_for_uri('file://' + path, None)
+            except GLib.Error as e:
+                self.roland.notify('Could not open {}: {}'.format(path, e.message), critical=True)
+        return False
+
+    def scheduled_download_done(self, download):
+        self.roland.downloads.pop(download.path, None)
+
+        if download.state == FINISHED:
+            self.roland.notify('Download finished: %s' % download.path)
+            self.post_process(download.path)
+        else:
+            self.expected_checksums.pop(download.path, None)
+            if download.state == CANCELLED:
+                self.roland.notify('Download cancelled: %s' % download.path)
+            else:
+                self.roland.notify('Download failed: %s (%s)' % (download.path, download.error), critical=True)
+        return False
+
+    def download_location(self, download):
         location = download.get_destination()[len('file://'):]
+        if location.endswith(PART_SUFFIX):
+            location = location[:-len(PART_SUFFIX)]
+        return location
+
+    def failed(self, download, error):
+        location = self.download_location(download)
+        release(location)
+        self.expected_checksums.pop(location, None)
         if error == WebKit2.DownloadError.CANCELLED_BY_USER:
             self.roland.notify('Download cancelled: %s' % location)
             self.roland.downloads.pop(location)
@@ -162,8 +396,19 @@ class DownloadManager(Extension):
             self.roland.downloads.pop(location)
 
     def finished(self, download):
-        location = download.get_destination()[len('file://'):]
-        self.roland.notify('Download finished: %s' % location)
+        location = self.download_location(download)
+        if self.roland.downloads.get(location) is not download:
+            # WebKit emits finished after failed too, and failed has dealt
+            # with it. What's in the .part file is incomplete.
+            return
+
+        try:
+            move_into_place(location)
+        except OSError as e:
+            self.roland.notify('Download failed: %s (%s)' % (location, e), critical=True)
+        else:
+            self.roland.notify('Download finished: %s' % location)
+            self.post_process(location)
         self.roland.downloads.pop(location)
 
 
@@ -184,15 +429,50 @@ class SessionManager(Extension):
     # TLSErrorByPassExtension has setup exclusions.
     sort_order = 1
 
-    def setup(self):
+    # fold the journal into a new snapshot once it has this many records,
+    # checking at most this often (seconds).
+    compact_threshold = 200
+    compact_interval = 60
+
+    # how often to check whether more restored tabs can be warmed up (ms),
+    # and how long to wait for the first tab before starting anyway
+    # (seconds).
+    warmup_poll_interval = 250
+    warmup_delay = 5
+
+    def prepare(self):
+        self.journal = SessionJournal(
+            config_path('session.bin'), config_path('session.journal'),
+            legacy_path=config_path('session.json'))
+        self.session = []
+        self.session_ids = []
+        self.load_error = None
         try:
-            with open(config_path('session.json'), 'r') as f:
-                session = json.load(f)
-        except FileNotFoundError:
-            pass
+            with profiling.phase('session load'):
+                self.session = self.journal.load()
+                self.session_ids = list(self.journal.tabs)
         except Exception as e:
-            self.roland.notify("Error loading session: {}".format(e))
+            self.load_error = e
+
+        # tab ids start again at 1 every run, so the journal keeps its own
+        # ids for tabs, which restored tabs carry on using. Nothing is
+        # journalled until those are known, as opening the restored tabs
+        # reports changes to tabs that aren't mapped yet.
+        self.ids = {}
+        self.next_id = itertools.count(max(self.journal.tabs, default=0) + 1)
+        self.restoring = True
+
+    def setup(self):
+        self.max_history = getattr(self.roland.config, 'session_max_history', None)
+        self.warmup = None
+        self.warmup_started = False
+
+        session = self.session
+        if self.load_error is not None:
+            self.roland.notify("Error loading session: {}".format(self.load_error))
         else:
+            existing = set(self.roland.get_browsers())
+
             lazy = getattr(self.roland.config, 'lazy_tabs', True)
             first = True
             for page in session:
@@ -206,36 +486,504 @@ class SessionManager(Extension):
                 self.roland.new_window(**kwargs)
                 first = False
 
-        self.roland.connect('shutdown', self.on_shutdown)
+            restored = [b for b in self.roland.get_browsers() if b not in existing]
+            for browser, page in zip(restored, session):
+                browser.last_active = max(browser.last_active, page.get('last_active') or 0)
+                browser.pinned = page.get('pinned', False)
+
+            self.ids.update(zip((browser.tab_id for browser in restored), self.session_ids))
+            for session_id in set(self.session_ids) - set(self.ids.values()):
+                self.journal.close_tab(session_id)
+
+            self.schedule_warmup(restored)
+
+        self.restoring = False
+        # tabs opened before the session was restored
+        for browser in self.roland.get_browsers():
+            if browser.tab_id not in self.ids:
+                self.tab_changed(browser)
+
+        self.roland.window.notebook.connect('page-reordered', self.on_page_reordered)
+        GLib.timeout_add_seconds(self.compact_interval, self.on_compact_timeout)
+
+    def shutdown(self):
+        # everything is already journalled, so there's nothing to write.
+        self.journal.close()
+
+    def browser_page(self, browser):
+        if browser.lazy:
+            single_session = browser.lazy_session
+            if isinstance(single_session, bytes):
+                # discarded tabs keep the state they had as bytes
+                single_session = InlineBlob(single_session)
+            uri = browser.lazy_uri
+        else:
+            state = browser.get_serialised_session_state()
+            if self.max_history:
+                state = truncate_back_forward_list(state, self.max_history)
+            single_session = InlineBlob(state)
+            uri = browser.webview.get_uri()
+
+        if uri in (None, 'about:blank', 'http:/'):
+            return None
+
+        return {
+            'uri': uri,
+            'title': browser.get_title() or 'No Title',
+            'session': single_session,
+            'last_active': browser.last_active,
+            'pinned': browser.pinned,
+        }
+
+    def session_id(self, browser):
+        """Return the id browser's tab has in the journal."""
+        try:
+            return self.ids[browser.tab_id]
+        except KeyError:
+            session_id = self.ids[browser.tab_id] = next(self.next_id)
+            return session_id
+
+    def tab_changed(self, browser):
+        if self.restoring:
+            return
+        page = self.browser_page(browser)
+        if page is not None:
+            self.journal.update(self.session_id(browser), **page)
+
+    def tab_loaded(self, browser):
+        if self.warmup is None:
+            return
+
+        self.warmup.finished(browser.tab_id)
+
+        # the first tab has painted, so the rest can start warming up.
+        if not self.warmup_started:
+            self.start_warmup()
+
+    def user_interacted(self):
+        if self.warmup is not None:
+            self.warmup.interacted()
+
+    def schedule_warmup(self, browsers):
+        """Load the most recently used of the restored lazy tabs in the
+        background, once the first tab has loaded."""
+        budget = getattr(self.roland.config, 'session_warmup_tabs', 3)
+        pages = [(b.tab_id, b.last_active) for b in browsers if b.lazy]
+        if not budget or not pages:
+            return
 
-    def on_shutdown(self, app):
-        self.save_session()
+        self.warmup = RestoreScheduler(
+            pages,
+            budget,
+            concurrency=getattr(self.roland.config, 'session_warmup_concurrency', 1),
+            idle=getattr(self.roland.config, 'session_warmup_idle', 2),
+        )
+
+        if all(b.lazy for b in browsers):
+            self.start_warmup()
+        else:
+            GLib.timeout_add_seconds(self.warmup_delay, self.start_warmup)
+
+    def start_warmup(self):
+        if self.warmup is not None and not self.warmup_started:
+            self.warmup_started = True
+            GLib.timeout_add(self.warmup_poll_interval, self.on_warmup_timeout)
+        return False
+
+    def on_warmup_timeout(self):
+        browsers = {b.tab_id: b for b in self.roland.get_browsers()}
+
+        for tab_id in self.warmup.ready():
+            browser = browsers.get(tab_id)
+            if browser is None or not browser.lazy:
+                # closed or opened by the user in the meantime
+                self.warmup.finished(tab_id)
+            else:
+                log.debug('Warming up restored tab {}', browser.lazy_uri)
+                browser.start()
+
+        if self.warmup.done:
+            self.warmup = None
+            return False
+        return True
+
+    def tab_closed(self, browser):
+        session_id = self.ids.pop(browser.tab_id, None)
+        if session_id is not None:
+            self.journal.close_tab(session_id)
+
+    def on_page_reordered(self, notebook, child, page_num):
+        self.journal.order([self.session_id(browser) for browser in self.roland.get_browsers()])
+
+    def on_compact_timeout(self):
+        if self.journal.records >= self.compact_threshold:
+            self.journal.compact()
+        return True
 
     def save_session(self):
-        session = []
+        pages = []
+        for browser in self.roland.get_browsers():
+            page = self.browser_page(browser)
+            if page is not None:
+                pages.append((self.session_id(browser), page))
+
+        self.journal.reset(pages)
+        return False
+
+
+class TabDiscarder(Extension):
+    """Discards tabs that haven't been looked at for a while, so that only
+    recently used tabs hold on to a web page.
+
+    Tabs idle for longer than tab_discard_timeout seconds are discarded, as
+    are the least recently used tabs beyond max_live_tabs. The current tab,
+    pinned tabs and tabs that are loading or playing audio are left alone.
+    """
+    # seconds between checks
+    check_interval = 60
+    deferred = True
+
+    def setup(self):
+        self.idle_timeout = getattr(self.roland.config, 'tab_discard_timeout', 30 * 60)
+        self.max_live = getattr(self.roland.config, 'max_live_tabs', None)
+
+        GLib.timeout_add_seconds(self.check_interval, self.on_check_timeout)
+
+    def on_check_timeout(self):
+        self.discard_idle()
+        return True
+
+    def live_tabs(self):
+        return [browser for browser in self.roland.get_browsers() if not browser.lazy]
+
+    def discard_idle(self):
+        browsers = {browser.tab_id: browser for browser in self.live_tabs()}
+        tabs = [(tab_id, browser.last_active, not browser.is_discardable())
+                for (tab_id, browser) in browsers.items()]
+
+        chosen = tabs_to_discard(tabs, time.time(), max_live=self.max_live, idle_timeout=self.idle_timeout)
+        for tab_id in chosen:
+            self.discard(browsers[tab_id])
+        return len(chosen)
+
+    def discard_all(self):
+        browsers = [browser for browser in self.live_tabs() if browser.is_discardable()]
+        for browser in browsers:
+            self.discard(browser)
+        return len(browsers)
+
+    def discard(self, browser):
+        log.info('Discarding tab {}', browser.webview.get_uri())
+
+        browser.discard()
+
+        session_manager = self.roland.get_extension('SessionManager')
+        if session_manager is not None:
+            session_manager.tab_changed(browser)
+
+
+class MemoryMonitor(Extension):
+    """Keeps track of how much memory each tab's web process uses, and
+    discards the largest idle tabs when memory is short.
+
+    Memory is short when the web processes' combined rss goes over
+    max_web_process_memory bytes, or when the system's available memory
+    drops below memory_pressure_ratio of the total.
+    """
+    # wait at least this long after reclaiming before doing it again, so the
+    # effect can show up in the next samples.
+    reclaim_cooldown = 60
+
+    def setup(self):
+        self.interval = getattr(self.roland.config, 'memory_monitor_interval', 30)
+        self.max_rss = getattr(self.roland.config, 'max_web_process_memory', None)
+        self.pressure_ratio = getattr(self.roland.config, 'memory_pressure_ratio', 0.1)
+
+        # page id -> web process pid, as reported by the web extension
+        self.pids = {}
+        # pid -> ProcessMemory from the latest sample
+        self.usage = {}
+        self.system = None
+        self.last_reclaim = 0
+        self.sampling = False
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='roland-memory')
+
+        GLib.timeout_add_seconds(self.interval, self.on_sample_timeout)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def add_page(self, page_id, pid):
+        self.pids[page_id] = pid
+
+    def tab_pids(self):
+        """Return {browser: pid} for live tabs with a known web process."""
+        pids = {}
         for browser in self.roland.get_browsers():
             if browser.lazy:
-                single_session = browser.lazy_session
-                uri = browser.lazy_uri
-            else:
-                single_session = browser.get_serialised_session_state()
-                uri = browser.webview.get_uri()
+                continue
+            pid = self.pids.get(browser.webview.get_page_id())
+            if pid is not None:
+                pids[browser] = pid
+        return pids
+
+    def tab_memory(self):
+        """Return {browser: bytes} for live tabs, splitting the pss of web
+        processes shared by several tabs between them."""
+        pids = self.tab_pids()
+        sharing = Counter(pids.values())
+
+        memory = {}
+        for browser, pid in pids.items():
+            usage = self.usage.get(pid)
+            if usage is not None:
+                memory[browser] = usage.pss // sharing[pid]
+        return memory
+
+    def on_sample_timeout(self):
+        if not self.sampling:
+            self.sampling = True
+            pids = set(self.tab_pids().values())
+            future = submit(self.executor, self.sample, pids)
+            future.add_done_callback(lambda f: GLib.idle_add(self.on_sampled, f))
+        return True
+
+    def sample(self, pids):
+        usage = {}
+        for pid in pids:
+            memory = process_memory(pid)
+            if memory is not None:
+                usage[pid] = memory
+
+        try:
+            system = system_memory()
+        except (OSError, KeyError):
+            system = None
+        return usage, system
+
+    def on_sampled(self, future):
+        self.sampling = False
+
+        try:
+            self.usage, self.system = future.result()
+        except Exception as e:
+            log.exception('Error sampling web process memory: {}', e)
+            return False
+
+        # forget pages that have gone away
+        live = {browser.webview.get_page_id() for browser in self.roland.get_browsers() if not browser.lazy}
+        self.pids = {page_id: pid for (page_id, pid) in self.pids.items() if page_id in live}
+
+        self.check_pressure()
+        return False
+
+    def check_pressure(self):
+        total_rss = sum(usage.rss for usage in self.usage.values())
+        excess = memory_excess(total_rss, self.system, max_rss=self.max_rss, min_available_ratio=self.pressure_ratio)
+        if excess <= 0 or time.monotonic() - self.last_reclaim < self.reclaim_cooldown:
+            return
+
+        self.last_reclaim = time.monotonic()
+        self.reclaim(excess)
 
-            if uri in (None, 'about:blank', 'http:/'):
+    def reclaim(self, excess):
+        memory = self.tab_memory()
+        tabs = [(browser.tab_id, size, browser.is_discardable()) for (browser, size) in memory.items()]
+        chosen = set(choose_reclaim(tabs, excess))
+
+        log.info('Memory is short by {} bytes, discarding {} tabs', excess, len(chosen))
+
+        discarder = self.roland.get_extension('TabDiscarder')
+        for browser in memory:
+            if browser.tab_id not in chosen:
                 continue
+            if discarder is not None:
+                discarder.discard(browser)
+            else:
+                browser.discard()
+
+        WebKit2.WebContext.get_default().clear_cache()
+
+
+class TaskManager(Extension):
+    """Serves roland://tasks/, a live view of what each tab is using."""
+    # seconds between updates of open tasks pages
+    refresh_interval = 2
+
+    handles = ('resource_started',)
+    deferred = True
+
+    def setup(self):
+        # pid -> (wall time, cpu time) when the page was last rendered, for
+        # working out CPU use since then. Only used on the worker thread.
+        self.cpu_samples = {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='roland-tasks')
+
+        self.refresh_source = None
+        self.roland.register_page('tasks', self.tasks_page, 'Tasks')
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def resource_started(self, browser, resource):
+        # what actually arrives, which Content-Length isn't for chunked,
+        # cached or aborted responses
+        resource.connect('received-data', self.on_received_data, browser)
+
+    def on_received_data(self, resource, length, browser):
+        browser.bytes_received += length
+
+    def on_refresh_timeout(self):
+        if not self.roland.update_pages('tasks'):
+            # none left open
+            self.refresh_source = None
+            return False
+        return True
+
+    def tasks_page(self, query):
+        if self.refresh_source is None:
+            self.refresh_source = GLib.timeout_add_seconds(self.refresh_interval, self.on_refresh_timeout)
 
-            session.append({
-                'uri': uri,
-                'title': browser.get_title() or 'No Title',
-                'session': single_session,
+        monitor = self.roland.get_extension('MemoryMonitor')
+        pids = monitor.tab_pids() if monitor is not None else {}
+
+        # everything to do with the browsers is read here on the main thread,
+        # the worker only reads /proc.
+        tabs = []
+        for browser in self.roland.get_browsers():
+            tabs.append({
+                'tab_id': browser.tab_id,
+                'title': browser.get_title(),
+                'uri': browser.lazy_uri if browser.lazy else browser.webview.get_uri(),
+                'pid': pids.get(browser),
+                'requests': browser.requests,
+                'bytes': browser.bytes_received,
             })
 
-        with open(config_path('session.json'), 'w') as f:
-            json.dump(session, f, indent=4)
+        return submit(self.executor, self.render, tabs, query.get('sort'))
 
+    def render(self, tabs, sort):
+        now = time.monotonic()
+        memory = {}
+        cpu = {}
+        for pid in {tab['pid'] for tab in tabs if tab['pid'] is not None}:
+            memory[pid] = process_memory(pid)
+
+            cpu_time = process_cpu_time(pid)
+            sample = (now, cpu_time) if cpu_time is not None else None
+            cpu[pid] = cpu_percent(self.cpu_samples.get(pid), sample)
+            self.cpu_samples[pid] = sample
+
+        tasks = []
+        for tab in tabs:
+            usage = memory.get(tab['pid'])
+            tasks.append(Task(
+                rss=usage.rss if usage is not None else None,
+                pss=usage.pss if usage is not None else None,
+                cpu=cpu.get(tab['pid']),
+                **tab
+            ))
+
+        return render_tasks_page(tasks, sort=sort)
+
+
+ClosedTab = namedtuple('ClosedTab', 'uri title session row_id')
+
+
+class ClosedTabs(Extension):
+    """History of closed tabs, for undoing closes.
+
+    Every closed tab is written to closed_tabs.db with its session state
+    compressed, keeping the last closed_tabs_history of them. Only the most
+    recent few are also kept in memory, so undoing a close doesn't need to
+    touch the disk.
+    """
+    in_memory = 10
+    deferred = True
 
-class TLSErrorByPassExtension(Extension):
     def setup(self):
+        self.max_entries = getattr(self.roland.config, 'closed_tabs_history', 100)
+        self.recent = deque(maxlen=self.in_memory)
+        # row ids popped from disk while the entries in memory for them
+        # didn't know their row id yet
+        self.popped = set()
+
+        self.db = open_database('closed_tabs.db', schema=[
+            'create table if not exists closed_tabs '
+            '(id integer primary key, closed timestamp, uri text, title text, session blob)',
+        ])
+
+    def add(self, uri, title, session):
+        row_id = self.db.write(self.insert, uri, title, session)
+        # the oldest entry drops out of memory, but is still on disk
+        self.recent.append(ClosedTab(uri, title, session, row_id))
+
+    def insert(self, conn, uri, title, session):
+        if session is not None:
+            session = zlib.compress(session)
+
+        row_id = conn.execute(
+            'insert into closed_tabs (closed, uri, title, session) values (?, ?, ?, ?)',
+            (datetime.datetime.now(), uri, title, session),
+        ).lastrowid
+        conn.execute('delete from closed_tabs where id <= ?', (row_id - self.max_entries,))
+        return row_id
+
+    def entries(self):
+        """Return a Future of (row id, title, uri) for each closed tab,
+        most recent first."""
+        # run on the writer, so tabs closed a moment ago are included
+        return self.db.write(
+            lambda conn: conn.execute('select id, title, uri from closed_tabs order by id desc').fetchall())
+
+    def pop(self, row_id=None):
+        """Remove a closed tab from the history, the most recent if row_id
+        isn't given, returning a Future of its (uri, session), or None if
+        there's no such tab."""
+        self.forget_popped()
+
+        for entry in reversed(self.recent):
+            # the row id is always known once the writer gets to the delete.
+            if row_id is None or (entry.row_id.done() and entry.row_id.result() == row_id):
+                self.recent.remove(entry)
+                self.db.write(lambda conn: conn.execute(
+                    'delete from closed_tabs where id = ?', (entry.row_id.result(),)))
+                return completed((entry.uri, entry.session))
+
+        if row_id is not None and any(not entry.row_id.done() for entry in self.recent):
+            # it may be one of those, which mustn't be popped again later
+            self.popped.add(row_id)
+
+        return self.db.write(self.pop_stored, row_id)
+
+    def forget_popped(self):
+        """Drop entries from memory that were already popped from disk."""
+        for entry in list(self.recent):
+            if entry.row_id.done() and entry.row_id.result() in self.popped:
+                self.recent.remove(entry)
+                self.popped.discard(entry.row_id.result())
+
+        if all(entry.row_id.done() for entry in self.recent):
+            self.popped.clear()
+
+    def pop_stored(self, conn, row_id):
+        if row_id is None:
+            row = conn.execute('select id, uri, session from closed_tabs order by id desc limit 1').fetchone()
+        else:
+            row = conn.execute('select id, uri, session from closed_tabs where id = ?', (row_id,)).fetchone()
+
+        if row is None:
+            return None
+
+        row_id, uri, session = row
+        conn.execute('delete from closed_tabs where id = ?', (row_id,))
+        return uri, zlib.decompress(session) if session is not None else None
+
+
+class TLSErrorByPassExtension(Extension):
+    def prepare(self):
         cert_bypass_path = config_path('tls/bypass/')
         try:
             os.makedirs(cert_bypass_path)
@@ -247,11 +995,15 @@ class TLSErrorByPassExtension(Extension):
         except FileExistsError:
             pass
 
-        context = WebKit2.WebContext.get_default()
+        # host -> PEM
+        self.bypassed = {}
         for host in os.listdir(cert_bypass_path):
             with open(os.path.join(cert_bypass_path, host)) as f:
-                certificate = f.read()
+                self.bypassed[host] = f.read()
 
+    def setup(self):
+        context = WebKit2.WebContext.get_default()
+        for host, certificate in self.bypassed.items():
             certificate = Gio.TlsCertificate.new_from_pem(certificate, len(certificate))
             context.allow_tls_certificate_for_host(certificate, host)
 
@@ -295,51 +1047,120 @@ class TLSErrorByPassExtension(Extension):
 
 
 class HSTSExtension(Extension):
-    def setup(self):
-        self.create_hsts_db()
-
-    def create_hsts_db(self):
-        conn = self.get_hsts_db()
+    """HSTS support, backed by the compiled preload list that ships with
+    roland, plus a small overlay database of entries learned from
+    Strict-Transport-Security headers.
+    """
+
+    # learned entries are written behind in batches, rather than one
+    # transaction per response.
+    flush_interval = 30
+    flush_batch_size = 50
+    purge_interval = 60 * 60
+
+    handles = ('resource_finished',)
+    web_process = True
+    web_process_config = ('hsts_preload_path',)
+    deferred = True
+
+    # seconds to wait for Chromium's list, when it has to be downloaded
+    preload_download_timeout = 30
+
+    def prepare(self):
+        self.preload_error = None
+
+        path = getattr(self.roland.config, 'hsts_preload_path', None)
+        if path is None:
+            path = DEFAULT_PRELOAD_PATH
+            if not os.path.exists(path):
+                # installed without a compiled list, so fetch Chromium's and
+                # compile it, as roland used to on first run. Web processes
+                # leave that to the UI process.
+                path = cache_path('hsts_preload.bin')
+                if not os.path.exists(path) and not self.roland.in_web_process:
+                    try:
+                        build_preload_list(CHROMIUM_PRELOAD_URL, path, timeout=self.preload_download_timeout)
+                    except Exception as e:
+                        self.preload_error = e
+
+        self.preload = PreloadList(path)
 
-        cursor = conn.cursor()
-        try:
-            cursor.execute('create table hsts '
-                           '(domain text unique, expiry timestamp)')
-        except Exception:
-            pass  # already exists
-        else:
-            self.create_initial_db()
-        conn.commit()
-        conn.close()
+    def setup(self):
+        # every web process has the same list, so only the UI process says so
+        if self.preload_error is not None:
+            log.error("Error downloading the HSTS preload list: {}", self.preload_error)
+            if not self.roland.in_web_process:
+                self.roland.notify("Couldn't download the HSTS preload list: {}".format(self.preload_error),
+                                   critical=True)
+        elif not len(self.preload):
+            log.warning("HSTS preload list {} is empty or missing", self.preload.path)
+            if not self.roland.in_web_process:
+                self.roland.notify("HSTS preload list is empty, preloaded sites won't be forced to HTTPS",
+                                   critical=True)
+
+        # host -> (header, expiry, max_age) of the last header seen, so
+        # repeated headers from the same host are dropped without parsing.
+        self.seen = {}
+        # domain -> expiry, waiting to be flushed to the overlay database
+        self.pending = {}
+        # domain -> expiry, in-memory copy of the overlay database so that
+        # checking a URL never touches SQLite.
+        self.overlay = {}
+        self.last_flush = self.last_purge = time.monotonic()
+
+        self.db = open_database('hsts.db', schema=[
+            'create table if not exists hsts '
+            '(domain text unique, expiry timestamp)',
+        ])
+        self.reload_overlay()
+        GLib.timeout_add_seconds(self.flush_interval, self.on_flush_timeout)
+
+    def shutdown(self):
+        self.flush()
+
+    def resource_finished(self, browser, response):
+        headers = response.get_http_headers()
+        if headers is None:
+            return
 
-    def create_initial_db(self):
-        self.roland.notify("You don't have any HSTS entries. Downloading Chromium's preload list.")
-        raw = request.urlopen('https://raw.githubusercontent.com/scheib/chromium/master/net/http/transport_security_state_static.json').read().decode('utf8')
+        hsts = headers.get_one('Strict-Transport-Security')
+        if hsts is not None:
+            self.add_entry(response.get_uri(), hsts)
 
-        # JSON with comments? wild
-        hsts = json.loads(re.sub(r'^ *?//.*$', '', raw, flags=re.MULTILINE))
+    def reload_overlay(self):
+        # run on the writer, so that it sees any flush queued before it, and
+        # entries learned by other processes get picked up too.
+        future = self.db.write(lambda conn: conn.execute('select domain, expiry from hsts').fetchall())
+        # pending is only touched on the main thread
+        future.add_done_callback(lambda future: GLib.idle_add(self.overlay_loaded, future))
 
-        entries = []
+    def overlay_loaded(self, future):
+        if future.exception() is not None:
+            log.error("Error loading HSTS entries: {}", future.exception())
+            return False
 
-        expiry = datetime.datetime.now() + datetime.timedelta(days=365)
-        for entry in hsts['entries']:
-            if entry.get('mode') == 'force-https':
-                domain = entry['name']
-                if entry.get('include_subdomains'):
-                    domain = '.' + domain
+        overlay = dict(future.result())
+        overlay.update(self.pending)
+        self.overlay = overlay
+        return False
 
-                entries.append((domain, expiry))
+    def add_entry(self, uri, hsts_header):
+        host = urlparse.urlparse(uri).netloc
+        now = datetime.datetime.now()
 
-        with self.get_hsts_db() as conn:
-            cursor = conn.cursor()
-            cursor.executemany('insert into hsts (domain, expiry) '
-                               'values (?, ?)', entries)
-            conn.commit()
+        try:
+            seen_header, seen_expiry, seen_max_age = self.seen[host]
+        except KeyError:
+            pass
+        else:
+            # same policy as last time, and it isn't close to expiring, so
+            # writing it again would change nothing.
+            half_life = datetime.timedelta(seconds=seen_max_age / 2)
+            if seen_header == hsts_header and seen_expiry - now > half_life:
+                return
 
-    def get_hsts_db(self):
-        return sqlite3.connect(config_path('hsts.db'), detect_types=sqlite3.PARSE_DECLTYPES)
+        from werkzeug import parse_dict_header
 
-    def add_entry(self, uri, hsts_header):
         parsed = parse_dict_header(hsts_header)
         max_age, *rest = parsed['max-age'].split(';', 1)
 
@@ -347,47 +1168,76 @@ class HSTSExtension(Extension):
         if rest:
             include_subdomains = 'includesubdomains' in rest[0].lower()
 
-        domain = urlparse.urlparse(uri).netloc
+        domain = host
         if include_subdomains:
             domain = '.' + domain
         max_age = int(max_age)
 
-        expiry = datetime.datetime.now() + datetime.timedelta(seconds=max_age)
+        expiry = now + datetime.timedelta(seconds=max_age)
 
-        with self.get_hsts_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute('insert or replace into hsts (domain, expiry) '
-                           'values (?, ?)', (domain, expiry))
-            conn.commit()
+        self.seen[host] = (hsts_header, expiry, max_age)
+        self.pending[domain] = expiry
+        self.overlay[domain] = expiry
+
+        if (len(self.pending) >= self.flush_batch_size or
+                time.monotonic() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def on_flush_timeout(self):
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+        self.reload_overlay()
+        return True
+
+    def flush(self):
+        now = time.monotonic()
+        self.last_flush = now
+
+        purge = now - self.last_purge >= self.purge_interval
+        if not self.pending and not purge:
+            return
+
+        entries, self.pending = list(self.pending.items()), {}
+
+        statements = [
+            ('insert or replace into hsts (domain, expiry) values (?, ?)', entry)
+            for entry in entries
+        ]
+        if purge:
+            self.last_purge = now
+            statements.append(('delete from hsts where expiry < ?', (datetime.datetime.now(),)))
+
+        self.db.batch(statements)
+        log.info("Flushing {} HSTS entries", len(entries))
 
     def check_url(self, uri):
-        domain = urlparse.urlparse(uri).netloc
+        parsed = urlparse.urlparse(uri)
 
-        with self.get_hsts_db() as conn:
-            cursor = conn.cursor()
+        if self.preload.check_host(parsed.hostname):
+            log.info("HSTS for {} is True (preloaded)", uri)
+            return True
 
-            domains = [
-                domain,   # straight domain match, e.g. lastpass.com
-            ]
+        domain = parsed.netloc
 
-            if '.' in domain:
-                subdomain, base = domain.split('.', 1)
+        domains = [
+            domain,   # straight domain match, e.g. lastpass.com
+        ]
 
-                domains.extend([
-                    '.' + base,  # subdomain match, e.g. foo.keyerror.com
-                    '.' + domain  # match base domain for a domain supportinb subdomains, e.g. keyerror.com
-                ])
+        if '.' in domain:
+            subdomain, base = domain.split('.', 1)
 
-            cursor.execute('select expiry from hsts '
-                           'where domain in ({})'.format(','.join('?' for i in domains)),
-                           domains)
-            expiries = [expiry for (expiry,) in cursor.fetchall()]
-            if expiries:
-                expiry = expiries[0]
+            domains.extend([
+                '.' + base,  # subdomain match, e.g. foo.keyerror.com
+                '.' + domain  # match base domain for a domain supportinb subdomains, e.g. keyerror.com
+            ])
 
-                if datetime.datetime.now() <= expiry:
-                    log.info("HSTS for {} is True", uri)
-                    return True
+        now = datetime.datetime.now()
+        overlay = self.overlay
+        for d in domains:
+            expiry = overlay.get(d)
+            if expiry is not None and now <= expiry:
+                log.info("HSTS for {} is True", uri)
+                return True
 
         log.info("HSTS for {} is False", uri)
         return False
@@ -430,6 +1280,13 @@ class DBusManager(Extension):
                 roland.new_window(url, background=True)
                 return 1
 
+            @dbus.service.method(name)
+            def web_process_started(self, page_id, pid):
+                monitor = roland.get_extension('MemoryMonitor')
+                if monitor is not None:
+                    monitor.add_page(int(page_id), int(pid))
+                return 1
+
             @dbus.service.method(name)
             def enter_insert(self, page_id):
                 window = roland.find_browser(page_id)
@@ -443,27 +1300,115 @@ class DBusManager(Extension):
         self.roland_api = DBusAPI()
 
 
+def zero(*secrets):
+    """Overwrite mutable key material in place."""
+    for secret in secrets:
+        if secret is not None:
+            secret[:] = bytes(len(secret))
+
+
 class PasswordManagerExtension(Extension):
+    """Encrypted form and credential store.
+
+    All key derivation, encryption and database work runs on a single worker
+    thread. Methods that do any of it return awaitable futures; the UI waits
+    on them with blocking_wait so it keeps responding in the meantime.
+    """
+
     FormFill = namedtuple('FormFill', 'id last_used description domain form_data')
-    BS = AES.block_size
+    # AES.block_size, without importing Crypto until it's needed
+    BS = 16
+    SENTINEL_DOMAIN = '!!frozen-brains-tell-no-tales!!'
+
+    # scrypt parameters for newly created stores, needing 16MiB per attempt.
+    # Stores created before there was a choice of KDF use plain SHA-256.
+    KDF_PARAMS = {'n': 2 ** 14, 'r': 8, 'p': 1}
+
+    deferred = True
 
     key = None
+    index_key = None
 
     def setup(self):
-        self.create_password_db()
+        # decrypted forms by domain, only populated while unlocked. Filled in
+        # on the worker thread, so it and the key change under cache_lock.
+        self.cache = {}
+        self.cache_lock = threading.Lock()
+        self.last_used = 0
+        self.lock_timeout = getattr(self.roland.config, 'password_manager_timeout', 5 * 60)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='roland-passwords')
+
+        self.db = open_database('passwords.db', schema=[
+            'create table if not exists managed '
+            '(id integer primary key, last_used timestamp, '
+            ' description text, domain text, data text, domain_hash text)',
+            'create table if not exists meta (name text primary key, value text)',
+        ])
+        self.db.write(self.migrate)
+
+    def migrate(self, conn):
+        columns = [column[1] for column in conn.execute('pragma table_info(managed)')]
+        if 'domain_hash' not in columns:
+            conn.execute('alter table managed add column domain_hash text')
+        conn.execute('create index if not exists managed_domain_hash on managed (domain_hash)')
+
+    def run(self, func, *args):
+        return submit(self.executor, func, *args)
+
+    def derive_keys(self, password, create=False):
+        """Derive the encryption key and the domain index key from the
+        master password. Runs on the worker thread."""
+        meta = dict(self.db.fetchall('select name, value from meta').result())
+
+        if create and 'kdf' not in meta:
+            meta = {'kdf': 'scrypt', 'salt': os.urandom(16).hex()}
+            self.db.executemany('insert or replace into meta (name, value) values (?, ?)',
+                                meta.items()).result()
+
+        if meta.get('kdf') == 'scrypt':
+            key = hashlib.scrypt(password.encode('utf8'), salt=bytes.fromhex(meta['salt']),
+                                 dklen=32, maxmem=64 * 1024 * 1024, **self.KDF_PARAMS)
+        else:
+            key = hashlib.sha256(password.encode('utf8')).digest()
+
+        key = bytearray(key)
+        # domains are looked up by a keyed hash, so the database doesn't
+        # reveal which sites have records.
+        index_key = bytearray(hmac.new(key, b'roland-domain-index', hashlib.sha256).digest())
+        return key, index_key
+
+    def lock(self):
+        """Forget the key and everything decrypted with it."""
+        with self.cache_lock:
+            key, index_key = self.key, self.index_key
+            self.key = self.index_key = None
+            self.cache.clear()
+        # scrub on the worker, after anything still using the key is done
+        self.run(zero, key, index_key)
+
+    def touch(self):
+        self.last_used = time.monotonic()
+
+    def shutdown(self):
+        self.lock()
+        self.executor.shutdown(wait=True)
+
+    def on_lock_timeout(self):
+        if self.key is None:
+            return False
 
-    def create_password_db(self):
-        conn = self.get_password_db()
+        idle = time.monotonic() - self.last_used
+        if idle < self.lock_timeout:
+            GLib.timeout_add_seconds(int(self.lock_timeout - idle) + 1, self.on_lock_timeout)
+        else:
+            log.info("Locking password manager after {} seconds idle", int(idle))
+            self.lock()
+        return False
 
-        cursor = conn.cursor()
-        try:
-            cursor.execute('create table managed '
-                           '(id integer primary key, last_used timestamp, '
-                           ' description text, domain text, data text)')
-        except Exception:
-            pass  # already exists
-        conn.commit()
-        conn.close()
+    def domain_hash(self, domain, index_key):
+        assert isinstance(domain, bytes)
+        return hmac.new(index_key, domain, hashlib.sha256).hexdigest()
 
     def pad(self, s):
         return s + ((self.BS - len(s) % self.BS) * chr(self.BS - len(s) % self.BS)).encode('ascii')
@@ -471,27 +1416,30 @@ class PasswordManagerExtension(Extension):
     def unpad(self, s):
         return s[:-s[-1]]
 
-    def encrypt(self, raw):
+    def encrypt(self, raw, key):
         assert isinstance(raw, bytes), "{!r} isn't a bytestring".format(raw)
+        from Crypto import Random
+        from Crypto.Cipher import AES
+
         raw = self.pad(raw)
         iv = Random.new().read(AES.block_size)
-        cipher = AES.new(self.key, AES.MODE_CBC, iv)
+        cipher = AES.new(key, AES.MODE_CBC, iv)
         return base64.b64encode(iv + cipher.encrypt(raw))
 
-    def decrypt(self, enc):
+    def decrypt(self, enc, key):
         assert isinstance(enc, bytes), "{!r} isn't a bytestring".format(enc)
+        from Crypto.Cipher import AES
+
         enc = base64.b64decode(enc)
         iv = enc[:self.BS]
-        cipher = AES.new(self.key, AES.MODE_CBC, iv)
+        cipher = AES.new(key, AES.MODE_CBC, iv)
         return self.unpad(cipher.decrypt(enc[self.BS:]))
 
     def attempt_initialise(self, window):
-        with self.get_password_db() as db:
-            curs = db.cursor()
-            curs.execute('select count(*) from managed')
-            # at least one record has been created, i.e. a password exists
-            if curs.fetchone()[0] > 0:
-                return True
+        (count,) = blocking_wait(self.db.fetchone('select count(*) from managed'))
+        # at least one record has been created, i.e. a password exists
+        if count > 0:
+            return True
 
         while True:
             password = window.entry_line.blocking_prompt(
@@ -506,9 +1454,9 @@ class PasswordManagerExtension(Extension):
             if password is None or confirm is None:
                 return False
             elif password == confirm:
-                self.key = hashlib.sha256(password.encode('utf8')).digest()
-                domain = '!!frozen-brains-tell-no-tales!!'
-                self.save_form(domain, {})
+                self.key, self.index_key = blocking_wait(self.run(self.derive_keys, password, True))
+                self.on_unlocked()
+                blocking_wait(self.save_form(self.SENTINEL_DOMAIN, {}))
                 return True
             else:
                 self.roland.notify("Password doesn't match confirmation")
@@ -518,6 +1466,7 @@ class PasswordManagerExtension(Extension):
             raise ValueError('Database not initialised')
 
         if self.key is not None:
+            self.touch()
             return
 
         for i in range(3):
@@ -530,55 +1479,123 @@ class PasswordManagerExtension(Extension):
                 break
 
             try:
-                self.test_password(password)
+                self.key, self.index_key = blocking_wait(self.test_password(password))
             except ValueError:
                 self.roland.notify('Incorrect password')
             else:
-                self.key = hashlib.sha256(password.encode('utf8')).digest()
+                self.on_unlocked()
+                self.run(self.add_missing_domain_hashes, self.key, self.index_key)
                 return
         raise ValueError('Could not unlock database')
 
+    def on_unlocked(self):
+        self.touch()
+        if self.lock_timeout:
+            GLib.timeout_add_seconds(self.lock_timeout, self.on_lock_timeout)
+
     def test_password(self, password):
-        self.key = hashlib.sha256(password.encode('utf8')).digest()
-        try:
-            if not self.get_for_domain(b'!!frozen-brains-tell-no-tales!!'):
+        """Check password against the store, resolving to the derived keys
+        if it's correct."""
+        def test():
+            key, index_key = self.derive_keys(password)
+            if not self.find_forms(self.SENTINEL_DOMAIN.encode('utf8'), key, index_key):
+                zero(key, index_key)
                 raise ValueError('Incorrect password')
-        finally:
-            self.key = None
+            return key, index_key
+        return self.run(test)
+
+    def add_missing_domain_hashes(self, key, index_key):
+        """Fill in the domain hash for records from before it existed, so
+        lookups can use the index from then on."""
+        records = self.db.fetchall(
+            'select id, domain from managed where domain_hash is null').result()
+
+        if records:
+            self.db.executemany(
+                'update managed set domain_hash = ? where id = ?',
+                [(self.domain_hash(self.decrypt(encrypted_domain, key), index_key), id)
+                 for (id, encrypted_domain) in records])
+
+    def find_forms(self, domain, key, index_key):
+        import msgpack
+
+        # records without a hash predate it, and are checked the slow way
+        # until add_missing_domain_hashes has filled them in.
+        records = self.db.fetchall(
+            'select id, last_used, description, domain, data from managed '
+            'where domain_hash = ? or domain_hash is null order by last_used desc',
+            (self.domain_hash(domain, index_key),)).result()
+
+        forms = []
+        for (id, last_used, encrypted_description, encrypted_domain, data) in records:
+            if self.decrypt(encrypted_domain, key) != domain:
+                continue
+            forms.append(self.FormFill(
+                id, last_used, self.decrypt(encrypted_description, key), domain,
+                msgpack.loads(self.decrypt(data, key))))
+        return forms
 
-    def get_for_domain(self, domain):
+    def get_for_domain_async(self, domain):
         assert isinstance(domain, bytes)
-        with self.get_password_db() as db:
-            curs = db.cursor()
-            curs.execute('select id, last_used, description, domain, data from managed order by last_used desc')
-            records = curs.fetchall()
-        return [
-            self.FormFill(id, last_used, self.decrypt(encrypted_description), self.decrypt(encrypted_domain), msgpack.loads(self.decrypt(data)))
-            for (id, last_used, encrypted_description, encrypted_domain, data) in records if self.decrypt(encrypted_domain) == domain
-        ]
+        self.touch()
+
+        key, index_key = self.key, self.index_key
+        if key is None:
+            raise ValueError('Password manager is locked')
+
+        try:
+            return completed(self.cache[domain])
+        except KeyError:
+            pass
+
+        def get():
+            forms = self.find_forms(domain, key, index_key)
+            # don't repopulate the cache if we were locked in the meantime
+            with self.cache_lock:
+                if self.key is key:
+                    self.cache[domain] = forms
+            return forms
+        return self.run(get)
+
+    def get_for_domain(self, domain):
+        return blocking_wait(self.get_for_domain_async(domain))
 
     def save_form(self, domain, form, description=None):
         if description is None:
             description = 'Form for {}'.format(domain)
 
-        encrypted_description = self.encrypt(description.encode('utf8'))
-        encrypted_domain = self.encrypt(domain.encode('utf8'))
-        encrypted_form = self.encrypt(msgpack.dumps(form))
+        self.touch()
 
-        record = (datetime.datetime.now(), encrypted_description, encrypted_domain, encrypted_form)
+        key, index_key = self.key, self.index_key
+        if key is None:
+            raise ValueError('Password manager is locked')
 
-        with self.get_password_db() as db:
-            cursor = db.cursor()
+        def save():
+            import msgpack
 
-            cursor.execute('insert into managed (last_used, description, domain, data) '
-                           'values (?, ?, ?, ?)', record)
-            db.commit()
+            encrypted_description = self.encrypt(description.encode('utf8'), key)
+            encrypted_domain = self.encrypt(domain.encode('utf8'), key)
+            encrypted_form = self.encrypt(msgpack.dumps(form), key)
+            domain_hash = self.domain_hash(domain.encode('utf8'), index_key)
 
-    def get_password_db(self):
-        return sqlite3.connect(config_path('passwords.db'), detect_types=sqlite3.PARSE_DECLTYPES)
+            record = (datetime.datetime.now(), encrypted_description, encrypted_domain, encrypted_form, domain_hash)
 
-    def update_last_used(self, record_id):
-        with self.get_password_db() as db:
-            cursor = db.cursor()
+            record_id = self.db.execute('insert into managed (last_used, description, domain, data, domain_hash) '
+                                        'values (?, ?, ?, ?, ?)', record).result()
+            with self.cache_lock:
+                self.cache.pop(domain.encode('utf8'), None)
+            return record_id
 
-            cursor.execute('update managed set last_used = ? where id = ?', (datetime.datetime.now(), record_id))
+        def saved(future):
+            if future.exception() is not None:
+                log.error("Error saving form for {}: {}", domain, future.exception())
+
+        future = self.run(save)
+        future.add_done_callback(saved)
+        return future
+
+    def update_last_used(self, record_id):
+        # ordering of cached forms depends on this
+        with self.cache_lock:
+            self.cache.clear()
+        self.db.execute('update managed set last_used = ? where id = ?', (datetime.datetime.now(), record_id))
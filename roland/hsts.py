@@ -0,0 +1,196 @@
+"""Compact, memory-mappable HSTS preload list.
+
+The preload list is compiled from Chromium's
+transport_security_state_static.json into a small binary file that ships with
+the package, so that nothing needs downloading at startup. setup.py does this
+when building, or it can be done by hand:
+
+    python -m roland.hsts path/to/transport_security_state_static.json
+
+File layout (all integers little-endian):
+
+    magic     8 bytes   b'RHSTS\\x00\\x01\\x00'
+    count     uint32    number of entries
+    offsets   uint32 * (count + 1)
+              start of each entry in the string table. The high bit of each
+              of the first count offsets is set when the entry includes
+              subdomains; the last offset is the end of the string table.
+    strings   ascii     domains, sorted bytewise, no separators
+
+Entries are sorted, so lookups are a binary search over the mmapped file and
+only touch the pages they need.
+"""
+
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+
+MAGIC = b'RHSTS\x00\x01\x00'
+HEADER = struct.Struct('<8sI')
+OFFSET = struct.Struct('<I')
+INCLUDE_SUBDOMAINS = 1 << 31
+
+DEFAULT_PRELOAD_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'data', 'hsts_preload.bin')
+
+# compiled when building the package, or at runtime when roland is
+# installed without a compiled list
+CHROMIUM_PRELOAD_URL = ('https://raw.githubusercontent.com/scheib/chromium/master/'
+                        'net/http/transport_security_state_static.json')
+
+
+def parse_chromium_json(raw):
+    """Parse Chromium's preload JSON into a {domain: include_subdomains}
+    mapping of force-https entries."""
+    # JSON with comments? wild
+    hsts = json.loads(re.sub(r'^ *?//.*$', '', raw, flags=re.MULTILINE))
+
+    entries = {}
+    for entry in hsts['entries']:
+        if entry.get('mode') == 'force-https':
+            entries[entry['name'].lower()] = bool(entry.get('include_subdomains'))
+    return entries
+
+
+def compile_preload_list(entries):
+    """Serialise a {domain: include_subdomains} mapping into the binary
+    format described above."""
+    domains = sorted((domain.encode('idna'), include_subdomains)
+                     for (domain, include_subdomains) in entries.items())
+
+    offsets = bytearray()
+    strings = bytearray()
+    for domain, include_subdomains in domains:
+        offset = len(strings)
+        if include_subdomains:
+            offset |= INCLUDE_SUBDOMAINS
+        offsets += OFFSET.pack(offset)
+        strings += domain
+    offsets += OFFSET.pack(len(strings))
+
+    if len(strings) >= INCLUDE_SUBDOMAINS:
+        raise ValueError('Preload list is too large')
+
+    return HEADER.pack(MAGIC, len(domains)) + bytes(offsets) + bytes(strings)
+
+
+class PreloadList:
+    """Read-only view of a compiled preload list.
+
+    The file is only opened on first lookup. A missing file behaves like an
+    empty list; HSTSExtension warns when that happens.
+    """
+
+    def __init__(self, path=DEFAULT_PRELOAD_PATH):
+        self.path = path
+        self.data = None
+        self.count = 0
+
+    def load(self):
+        if self.data is not None:
+            return
+
+        try:
+            with open(self.path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            # ValueError is raised for empty files, which can't be mapped
+            data = b''
+
+        if data:
+            magic, self.count = HEADER.unpack_from(data, 0)
+            if magic != MAGIC:
+                raise ValueError('{} is not an HSTS preload list'.format(self.path))
+
+        self.data = data
+        self.strings_start = HEADER.size + OFFSET.size * (self.count + 1)
+
+    def __len__(self):
+        self.load()
+        return self.count
+
+    def entry(self, i):
+        start = OFFSET.unpack_from(self.data, HEADER.size + OFFSET.size * i)[0]
+        end = OFFSET.unpack_from(self.data, HEADER.size + OFFSET.size * (i + 1))[0]
+        include_subdomains = bool(start & INCLUDE_SUBDOMAINS)
+        start &= ~INCLUDE_SUBDOMAINS
+        end &= ~INCLUDE_SUBDOMAINS
+        domain = self.data[self.strings_start + start:self.strings_start + end]
+        return domain, include_subdomains
+
+    def find(self, domain):
+        """Return whether domain is listed and whether it includes
+        subdomains, or None if it isn't listed."""
+        self.load()
+
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            candidate, include_subdomains = self.entry(mid)
+            if candidate < domain:
+                lo = mid + 1
+            elif candidate > domain:
+                hi = mid
+            else:
+                return include_subdomains
+        return None
+
+    def check_host(self, host):
+        """Return True if host must only be loaded over HTTPS."""
+        if not host:
+            return False
+
+        try:
+            labels = host.lower().rstrip('.').encode('idna').split(b'.')
+        except UnicodeError:
+            return False
+
+        if self.find(b'.'.join(labels)) is not None:
+            return True
+
+        for i in range(1, len(labels)):
+            if self.find(b'.'.join(labels[i:])):
+                return True
+        return False
+
+
+def build_preload_list(source, output, timeout=None):
+    """Compile Chromium's preload JSON, from a path or URL, into output,
+    returning the number of bytes written. timeout is in seconds, for
+    downloading it."""
+    if source.startswith(('http://', 'https://')):
+        from urllib import request
+        with request.urlopen(source, timeout=timeout) as response:
+            raw = response.read().decode('utf8')
+    else:
+        with open(source, encoding='utf8') as f:
+            raw = f.read()
+
+    compiled = compile_preload_list(parse_chromium_json(raw))
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    tmp = output + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(compiled)
+    os.replace(tmp, output)
+    return len(compiled)
+
+
+def main(argv):
+    if len(argv) not in (2, 3):
+        print('usage: python -m roland.hsts <chromium json path or url> [output path]', file=sys.stderr)
+        return 1
+
+    source = argv[1]
+    output = argv[2] if len(argv) == 3 else DEFAULT_PRELOAD_PATH
+
+    size = build_preload_list(source, output)
+    print('Wrote {} bytes to {}'.format(size, output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,165 @@
+"""Key bindings, compiled into a trie.
+
+Bindings map a key, as named by utils.get_keyname, or a sequence of keys to
+a command. Sequences are written as tuples or space separated names, e.g.
+'g t' or ('g', 't'), and can be mixed freely with single keys. Bindings to
+lazy.set_mode(Mode.SubCommand, ...) are compiled into sequences too, so
+configs written before sequences were supported keep working.
+
+Pressing keys walks down the trie one step per key. Digits pressed first
+are a count, passed to commands that take one. When a key is both a
+command and the start of a longer sequence, the command runs if nothing
+else is pressed before the timeout, or if the next key doesn't continue
+the sequence.
+"""
+
+from collections import namedtuple
+
+from .api import Mode
+
+# what feeding a key to a KeyDispatcher did
+NO_MATCH = 'no match'
+PENDING = 'pending'
+MATCH = 'match'
+
+# previous is the Result of a pending sequence the key interrupted, which
+# should run first, or None
+Result = namedtuple('Result', 'status command count previous', defaults=(None,))
+
+# longest count accepted, to stop typos running something thousands of times
+MAX_COUNT = 999
+
+
+class Node:
+    __slots__ = ('command', 'children')
+
+    def __init__(self):
+        self.command = None
+        self.children = {}
+
+
+def split_binding(binding):
+    if isinstance(binding, tuple):
+        return binding
+    return tuple(binding.split(' ')) if ' ' in binding else (binding,)
+
+
+def sub_command_bindings(command):
+    """Return the bindings of a lazy.set_mode(Mode.SubCommand, name,
+    bindings), or None for any other command."""
+    if getattr(command, 'name', None) != 'set_mode':
+        return None
+
+    args = command.args
+    if len(args) == 3 and args[0] == Mode.SubCommand and isinstance(args[2], dict):
+        return args[2]
+    return None
+
+
+def compile_keymap(bindings, root=None, prefix=()):
+    """Compile {binding: command} into a trie, returning its root Node."""
+    if root is None:
+        root = Node()
+
+    for binding, command in bindings.items():
+        keys = prefix + split_binding(binding)
+
+        sub_commands = sub_command_bindings(command)
+        if sub_commands is not None:
+            compile_keymap(sub_commands, root, keys)
+            continue
+
+        node = root
+        for key in keys:
+            node = node.children.setdefault(key, Node())
+        node.command = command
+    return root
+
+
+def compile_keymaps(config):
+    """Compile the keymap for each mode. Normal mode uses config.commands,
+    and other modes can have their own in config.keymaps, keyed by Mode."""
+    keymaps = {mode: Node() for mode in Mode}
+    compile_keymap(getattr(config, 'commands', {}), keymaps[Mode.Normal])
+
+    for mode, bindings in getattr(config, 'keymaps', {}).items():
+        compile_keymap(bindings, keymaps[mode])
+    return keymaps
+
+
+class KeyDispatcher:
+    """Where in a keymap the keys pressed so far have got to."""
+
+    def __init__(self):
+        self.root = None
+        self.node = None
+        self.count = ''
+        self.keys = []
+
+    def reset(self, root=None):
+        self.root = root
+        self.node = root
+        self.count = ''
+        self.keys = []
+
+    @property
+    def pending(self):
+        return bool(self.keys or self.count)
+
+    def pending_text(self):
+        return self.count + ''.join(self.keys)
+
+    def feed(self, root, key):
+        """Move on by key in keymap root, returning a Result."""
+        if root is not self.root:
+            self.reset(root)
+
+        node = self.node
+        if node is root and key.isdigit() and len(key) == 1 and key not in root.children:
+            if self.count or key != '0':
+                self.count += key
+                return Result(PENDING, None, None)
+
+        child = node.children.get(key)
+        if child is None:
+            if node is not root and node.command is not None:
+                # the key doesn't continue the sequence, so the sequence so
+                # far was a command of its own, and the key starts afresh
+                previous = self.timeout()
+                return self.feed(root, key)._replace(previous=previous)
+            self.reset(root)
+            return Result(NO_MATCH, None, None)
+
+        if child.children:
+            self.node = child
+            self.keys.append(key)
+            return Result(PENDING, None, None)
+
+        count = self.take_count()
+        self.reset(root)
+        return Result(MATCH, child.command, count)
+
+    def timeout(self):
+        """Give up waiting for more keys, returning the Result of the keys
+        pressed so far."""
+        node = self.node
+        count = self.take_count()
+        self.reset(self.root)
+
+        if node is not None and node.command is not None:
+            return Result(MATCH, node.command, count)
+        return Result(NO_MATCH, None, None)
+
+    def take_count(self):
+        return min(int(self.count), MAX_COUNT) if self.count else 1
+
+
+def accepts_count(func):
+    """Whether func takes a count argument, to be run once with it rather
+    than count times."""
+    import inspect
+
+    try:
+        return 'count' in inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return False
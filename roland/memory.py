@@ -0,0 +1,105 @@
+"""Memory and CPU accounting for web processes, read from /proc.
+
+Each tab's page runs in a WebKit web process, whose pid the web extension
+reports over DBus. Processes are sampled from /proc/<pid>/status and, where
+the kernel has it, the much cheaper-to-read /proc/<pid>/smaps_rollup, which
+also gives proportional set size (pss) for memory shared between processes.
+CPU time comes from /proc/<pid>/stat.
+"""
+
+import os
+from collections import namedtuple
+
+ProcessMemory = namedtuple('ProcessMemory', 'pid rss pss swap')
+SystemMemory = namedtuple('SystemMemory', 'total available')
+
+
+def parse_kb_fields(text):
+    """Parse the "Name:   1234 kB" lines of a /proc file into a {name: bytes}
+    mapping, ignoring lines in any other format."""
+    fields = {}
+    for line in text.splitlines():
+        name, sep, value = line.partition(':')
+        parts = value.split()
+        if not sep or len(parts) != 2 or parts[1] != 'kB':
+            continue
+        try:
+            fields[name] = int(parts[0]) * 1024
+        except ValueError:
+            continue
+    return fields
+
+
+def read_proc_file(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def process_memory(pid, proc='/proc'):
+    """Sample a process's memory use, returning None if it has exited."""
+    try:
+        status = parse_kb_fields(read_proc_file(os.path.join(proc, str(pid), 'status')))
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+
+    try:
+        rollup = parse_kb_fields(read_proc_file(os.path.join(proc, str(pid), 'smaps_rollup')))
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        # older kernels; rss is the best there is.
+        rollup = {}
+
+    rss = rollup.get('Rss', status.get('VmRSS', 0))
+    return ProcessMemory(
+        pid=pid,
+        rss=rss,
+        pss=rollup.get('Pss', rss),
+        swap=rollup.get('Swap', status.get('VmSwap', 0)),
+    )
+
+
+def process_cpu_time(pid, proc='/proc'):
+    """Return the user and system CPU time a process has used in seconds, or
+    None if it has exited."""
+    try:
+        stat = read_proc_file(os.path.join(proc, str(pid), 'stat'))
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+
+    # the command name is in parentheses and may contain spaces, so split
+    # after it. utime and stime are the 14th and 15th fields.
+    fields = stat[stat.rindex(')') + 2:].split()
+    ticks = int(fields[11]) + int(fields[12])
+    return ticks / os.sysconf('SC_CLK_TCK')
+
+
+def system_memory(proc='/proc'):
+    meminfo = parse_kb_fields(read_proc_file(os.path.join(proc, 'meminfo')))
+    return SystemMemory(total=meminfo['MemTotal'], available=meminfo['MemAvailable'])
+
+
+def memory_excess(total_rss, system, max_rss=None, min_available_ratio=None):
+    """Return how many bytes should be reclaimed: the larger of how far
+    total_rss is over max_rss, and how far available system memory is under
+    min_available_ratio of the total."""
+    excess = 0
+    if max_rss is not None:
+        excess = max(excess, total_rss - max_rss)
+    if system is not None and min_available_ratio is not None:
+        excess = max(excess, int(system.total * min_available_ratio) - system.available)
+    return excess
+
+
+def choose_reclaim(tabs, excess):
+    """Choose tabs to discard to free excess bytes, largest first.
+
+    tabs are (tab id, bytes, discardable) triples. Stops once enough memory
+    has been chosen, even if that's only an estimate of what will be freed.
+    """
+    chosen = []
+    for tab_id, size, discardable in sorted(tabs, key=lambda tab: tab[1], reverse=True):
+        if excess <= 0:
+            break
+        if discardable:
+            chosen.append(tab_id)
+            excess -= size
+    return chosen
@@ -0,0 +1,45 @@
+"""Layout shared by roland:// pages, and updating them in place.
+
+Page handlers render the content of a page; render_page wraps it in the
+layout when the page is loaded. Live pages are updated by replacing that
+content with script run from the UI process, rather than reloading, so they
+don't add history or session entries every time they change.
+"""
+
+import html
+import json
+
+STYLE = '''
+body { font-family: monospace; }
+table { border-collapse: collapse; width: 100%; }
+th, td { padding: 2px 8px; text-align: left; white-space: nowrap; }
+td:first-child { max-width: 40em; overflow: hidden; text-overflow: ellipsis; }
+td.number { text-align: right; }
+tr:nth-child(even) { background: #eee; }
+'''
+
+PAGE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>{style}</style>
+</head>
+<body>
+<div id="content">
+{content}
+</div>
+</body>
+</html>
+'''
+
+
+def render_page(title, content):
+    return PAGE.format(title=html.escape(title), style=STYLE, content=content)
+
+
+def replace_content_script(content):
+    """Return JavaScript that replaces a page's content with content."""
+    # JSON is a JavaScript string literal, and escapes anything that isn't
+    # ASCII, so no content can end it early
+    return 'document.getElementById("content").innerHTML = {};'.format(json.dumps(content))
@@ -0,0 +1,139 @@
+"""Work done on finished downloads, off the main thread.
+
+Finished downloads can be hashed with SHA-256, checked against a checksum
+the user gave or one in a .sha256 file next to them, and extracted if
+they're archives. Everything here reads files in chunks, so multi-gigabyte
+files never need to fit in memory.
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import tarfile
+from collections import namedtuple
+
+CHECKSUM_SUFFIX = '.sha256'
+
+Result = namedtuple('Result', 'path sha256 expected extracted')
+
+sha256_pattern = re.compile(r'\b([0-9a-fA-F]{64})\b')
+
+
+class ChecksumMismatch(Exception):
+    def __init__(self, path, expected, actual):
+        super().__init__('{} has SHA-256 {}, expected {}'.format(path, actual, expected))
+        self.path = path
+        self.expected = expected
+        self.actual = actual
+
+
+class UnsafeArchive(Exception):
+    pass
+
+
+def sha256_file(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parse_checksum(text, filename=None):
+    """Find the SHA-256 for filename in text, which is either a bare hex
+    digest or sha256sum output, possibly for several files.
+
+    Returns None if there isn't one.
+    """
+    found = []
+    for line in text.splitlines():
+        match = sha256_pattern.search(line)
+        if match is None:
+            continue
+
+        # sha256sum marks binary mode with a * before the name
+        name = line[match.end():].strip().lstrip('*')
+        if filename is not None and name and os.path.basename(name) == filename:
+            return match.group(1).lower()
+        found.append((name, match.group(1).lower()))
+
+    unnamed = [digest for (name, digest) in found if not name]
+    if unnamed:
+        return unnamed[0]
+    if len(found) == 1 and filename is None:
+        return found[0][1]
+    return None
+
+
+def sidecar_checksum(path):
+    """Return the checksum for path from path.sha256, or None if there's no
+    such file or it doesn't mention path."""
+    try:
+        with open(path + CHECKSUM_SUFFIX, 'r') as f:
+            text = f.read(64 * 1024)
+    except (FileNotFoundError, UnicodeDecodeError):
+        return None
+
+    return parse_checksum(text, os.path.basename(path))
+
+
+def archive_format(path):
+    """Return the name of the format shutil can unpack path as and the
+    extension it was recognised by, or (None, None)."""
+    for name, extensions, description in shutil.get_unpack_formats():
+        for extension in extensions:
+            if path.endswith(extension):
+                return name, extension
+    return None, None
+
+
+def extract_archive(path):
+    """Extract the archive at path into a directory next to it, named after
+    it without the extension. Returns the directory, or None if path isn't
+    an archive. Raises UnsafeArchive for tar files when this Python can't
+    keep their members inside the directory."""
+    name, extension = archive_format(path)
+    if extension is None:
+        return None
+
+    # tar members can write anywhere through absolute paths, .. or links.
+    # Extraction filters stop that, but older Pythons don't have them.
+    # shutil already skips zip members like that, and doesn't take a filter
+    # for them.
+    kwargs = {}
+    if name != 'zip':
+        if not hasattr(tarfile, 'data_filter'):
+            raise UnsafeArchive("Not extracting {}, this Python can't extract tar files safely".format(path))
+        kwargs['filter'] = 'data'
+
+    destination = path[:-len(extension)]
+    os.makedirs(destination, exist_ok=True)
+    shutil.unpack_archive(path, destination, format=name, **kwargs)
+    return destination
+
+
+def process_download(path, steps, expected=None):
+    """Run the steps of the pipeline that apply to path, returning a Result.
+
+    steps is a collection of 'hash', to always hash the file, 'verify', to
+    check it against its .sha256 file if there is one, and 'extract'. A
+    file is always checked against expected if it's given. Raises
+    ChecksumMismatch if the check fails, in which case nothing is extracted.
+    """
+    if expected is None and 'verify' in steps:
+        expected = sidecar_checksum(path)
+    expected = expected.lower() if expected else None
+
+    digest = None
+    if 'hash' in steps or expected is not None:
+        digest = sha256_file(path)
+
+    if expected is not None and digest != expected:
+        raise ChecksumMismatch(path, expected, digest)
+
+    extracted = None
+    if 'extract' in steps:
+        extracted = extract_archive(path)
+
+    return Result(path=path, sha256=digest, expected=expected, extracted=extracted)
@@ -0,0 +1,126 @@
+"""Startup profiling, enabled with roland --profile-startup.
+
+Startup is timed in phases: loading config, setting up each extension,
+creating the window, and from the first tab starting to its first commit.
+Once the first tab commits, the phases are written as a table and as a
+Chrome trace, which can be opened in chrome://tracing or Perfetto.
+
+When profiling isn't enabled, phase() and the rest do nothing, so they're
+free to leave in place.
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+
+# start is seconds since profiling was enabled
+Phase = namedtuple('Phase', 'name start duration thread')
+
+
+class StartupProfiler:
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.origin = clock()
+        self.phases = []
+        # name -> start, for phases begun but not yet ended
+        self.running = {}
+        self.finished = False
+
+    def now(self):
+        return self.clock() - self.origin
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.add(name, start)
+
+    def begin(self, name):
+        """Start a phase that ends somewhere else, e.g. in a callback. Only
+        the first begin of each name counts."""
+        if name not in self.running and not any(phase.name == name for phase in self.phases):
+            self.running[name] = self.now()
+
+    def end(self, name):
+        start = self.running.pop(name, None)
+        if start is not None:
+            self.add(name, start)
+
+    def add(self, name, start):
+        self.phases.append(Phase(name, start, self.now() - start, threading.current_thread().name))
+
+    def table(self):
+        width = max([len(phase.name) for phase in self.phases] + [len('phase')])
+        lines = ['{:<{width}}  {:>10}  {:>10}'.format('phase', 'start ms', 'took ms', width=width)]
+        for phase in sorted(self.phases, key=lambda phase: phase.start):
+            lines.append('{:<{width}}  {:>10.1f}  {:>10.1f}'.format(
+                phase.name, phase.start * 1000, phase.duration * 1000, width=width))
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        return {
+            'traceEvents': [
+                {
+                    'name': phase.name,
+                    'cat': 'startup',
+                    'ph': 'X',
+                    'ts': int(phase.start * 1000000),
+                    'dur': int(phase.duration * 1000000),
+                    'pid': os.getpid(),
+                    'tid': phase.thread,
+                }
+                for phase in self.phases
+            ],
+            'displayTimeUnit': 'ms',
+        }
+
+    def write(self, directory):
+        """Write the report to directory, returning the paths written."""
+        table_path = os.path.join(directory, 'startup-profile.txt')
+        trace_path = os.path.join(directory, 'startup-profile.json')
+
+        with open(table_path, 'w') as f:
+            f.write(self.table() + '\n')
+        with open(trace_path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        return table_path, trace_path
+
+
+profiler = None
+
+
+def enable(clock=time.perf_counter):
+    global profiler
+    profiler = StartupProfiler(clock)
+    return profiler
+
+
+def phase(name):
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.phase(name)
+
+
+def begin(name):
+    if profiler is not None:
+        profiler.begin(name)
+
+
+def end(name):
+    if profiler is not None:
+        profiler.end(name)
+
+
+def finish(directory):
+    """Write the report, the first time this is called, returning the paths
+    written or None."""
+    if profiler is None or profiler.finished:
+        return None
+
+    profiler.finished = True
+    return profiler.write(directory)
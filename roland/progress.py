@@ -0,0 +1,156 @@
+"""Download progress: throughput sampling and the roland://downloads page,
+which is updated in place on each sample while it's open.
+
+Downloads are sampled at a fixed tick rather than on every chunk, so the cost
+of watching them doesn't grow with how fast they're going. Each sample gives
+a download's instantaneous rate since the last tick, which is smoothed into
+an exponential moving average for the rate and ETA that are shown.
+"""
+
+import html
+import time
+from collections import namedtuple
+
+from .downloads import ACTIVE
+from .utils import get_pretty_size
+
+DownloadStatus = namedtuple('DownloadStatus', 'location state current total rate eta')
+
+
+def eta(current, total, rate):
+    """Return the seconds left to fetch the rest of total at rate bytes per
+    second, or None if it can't be known."""
+    if not total or not rate or current >= total:
+        return None
+    return (total - current) / rate
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return '-'
+
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return '{}h{:02d}m'.format(seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return '{}m{:02d}s'.format(seconds // 60, seconds % 60)
+    return '{}s'.format(seconds)
+
+
+def format_rate(rate):
+    if rate is None:
+        return '-'
+    return '{}/s'.format(get_pretty_size(int(rate)))
+
+
+class ProgressSampler:
+    """Keeps a moving average of each download's rate between calls to
+    sample().
+
+    smoothing is the weight given to the newest rate, so lower values give
+    steadier but slower to react averages.
+    """
+
+    def __init__(self, smoothing=0.3, clock=time.monotonic):
+        self.smoothing = smoothing
+        self.clock = clock
+        # location -> (time, bytes) of the last sample
+        self.last = {}
+        # location -> smoothed bytes per second
+        self.rates = {}
+
+    def sample(self, downloads):
+        """Sample {location: download}, returning a DownloadStatus for each,
+        sorted by location. Downloads no longer present are forgotten."""
+        now = self.clock()
+
+        statuses = []
+        for location, download in sorted(downloads.items()):
+            current = download.get_current_size()
+            total = download.get_total_size()
+            state = getattr(download, 'state', ACTIVE)
+
+            previous = self.last.get(location)
+            rate = self.rates.get(location)
+            if previous is not None and now > previous[0]:
+                instant = max(0, current - previous[1]) / (now - previous[0])
+                rate = instant if rate is None else self.smoothing * instant + (1 - self.smoothing) * rate
+            self.last[location] = (now, current)
+
+            if state != ACTIVE:
+                # only running downloads have a rate worth showing
+                rate = None
+            self.rates[location] = rate
+
+            statuses.append(DownloadStatus(
+                location=location, state=state, current=current, total=total,
+                rate=rate, eta=eta(current, total, rate)))
+
+        for location in set(self.last) - set(downloads):
+            del self.last[location]
+            self.rates.pop(location, None)
+
+        return statuses
+
+
+def aggregate(statuses):
+    """Return a DownloadStatus totalling every download in statuses. The ETA
+    is for all of them to finish at the combined rate."""
+    current = sum(status.current for status in statuses)
+    total = sum(status.total for status in statuses)
+    rates = [status.rate for status in statuses if status.rate is not None]
+    rate = sum(rates) if rates else None
+    return DownloadStatus(
+        location=None, state=None, current=current, total=total, rate=rate, eta=eta(current, total, rate))
+
+
+def status_text(statuses):
+    """Return a short summary of statuses for the status line, or '' if
+    there's nothing downloading."""
+    active = [status for status in statuses if status.state == ACTIVE]
+    if not active:
+        return ''
+
+    overall = aggregate(active)
+    text = ['↓{}'.format(len(active))]
+    if overall.total:
+        text.append('{}%'.format(int(overall.current * 100 / overall.total)))
+    text.append(format_rate(overall.rate))
+    if overall.eta is not None:
+        text.append(format_duration(overall.eta))
+    return ' '.join(text)
+
+
+def render_downloads_page(statuses):
+    """Return the content of the roland://downloads page."""
+    rows = []
+    for status in statuses:
+        percent = '{}%'.format(int(status.current * 100 / status.total)) if status.total else '-'
+        rows.append(DOWNLOAD_ROW.format(
+            location=html.escape(status.location),
+            state=html.escape(status.state),
+            current=get_pretty_size(status.current),
+            total=get_pretty_size(status.total) if status.total else '?',
+            percent=percent,
+            rate=format_rate(status.rate),
+            eta=format_duration(status.eta),
+        ))
+
+    overall = aggregate(statuses)
+    summary = '{} downloads, {} of {}, {}, {} left'.format(
+        len(statuses), get_pretty_size(overall.current), get_pretty_size(overall.total),
+        format_rate(overall.rate), format_duration(overall.eta))
+
+    return DOWNLOADS_TABLE.format(summary=summary if statuses else 'No downloads', rows='\n'.join(rows))
+
+
+DOWNLOAD_ROW = (
+    '<tr><td>{location}</td><td>{state}</td><td class="number">{current}</td><td class="number">{total}</td>'
+    '<td class="number">{percent}</td><td class="number">{rate}</td><td class="number">{eta}</td></tr>'
+)
+
+DOWNLOADS_TABLE = '''<p>{summary}</p>
+<table>
+<tr><th>File</th><th>State</th><th>Received</th><th>Size</th><th></th><th>Rate</th><th>ETA</th></tr>
+{rows}
+</table>'''
@@ -0,0 +1,459 @@
+"""Crash-safe, compact session persistence.
+
+The session is kept as a snapshot plus an append-only journal of per-tab
+changes. Recording a change is a single appended record, so checkpoints are
+cheap and nothing is lost if roland crashes. The journal is periodically
+folded into a fresh snapshot, which is written to a temporary file and
+atomically renamed into place.
+
+Replaying the journal is idempotent, so a crash between writing the snapshot
+and replacing the journal loses nothing either.
+
+Both files are binary. Each tab's WebKit session state is stored as a
+zlib-compressed blob, and only a small JSON index of tab ids, URIs and titles
+is parsed at startup. Blobs are read when a tab actually needs them, which
+for lazy tabs is when they're first shown.
+
+Snapshot layout:
+
+    magic   8 bytes
+    blobs   compressed session states, back to back
+    index   JSON list of {id, uri, title, ..., blob: [offset, length, digest]}
+    footer  uint64 index offset, uint32 index length, 8 byte magic
+
+Journal layout:
+
+    magic   8 bytes
+    records uint32 header length, uint32 blob length, uint32 crc32,
+            JSON header, compressed blob
+
+A blob's digest is the SHA-256 of the uncompressed state, which is how
+unchanged states are recognised and not written again.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import struct
+import time
+import zlib
+from collections import OrderedDict
+
+SNAPSHOT_MAGIC = b'RLSESS\x00\x01'
+JOURNAL_MAGIC = b'RLJRNL\x00\x01'
+FOOTER = struct.Struct('<QI8s')
+RECORD = struct.Struct('<III')
+
+
+class InlineBlob:
+    """Session state held in memory, e.g. straight from a WebView."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.digest = hashlib.sha256(raw).hexdigest()
+
+    def compressed(self):
+        return zlib.compress(self.raw)
+
+    def load(self):
+        return self.raw
+
+
+class StoredBlob:
+    """Compressed session state in a snapshot or journal, read on demand.
+
+    Holding the file open means the blob stays readable even after the file
+    has been replaced by compaction.
+    """
+
+    def __init__(self, f, offset, length, digest):
+        self.f = f
+        self.offset = offset
+        self.length = length
+        self.digest = digest
+
+    def compressed(self):
+        return os.pread(self.f.fileno(), self.length, self.offset)
+
+    def load(self):
+        return zlib.decompress(self.compressed())
+
+
+def same_blob(a, b):
+    if a is None or b is None:
+        return a is b
+    return a.digest == b.digest
+
+
+class SessionJournal:
+    def __init__(self, snapshot_path, journal_path, legacy_path=None):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        # session.json from before the binary format
+        self.legacy_path = legacy_path
+        # tab id -> {'uri': ..., 'title': ..., 'session': blob}, in tab order
+        self.tabs = OrderedDict()
+        self.journal = None
+        # end of the last complete record in an existing journal, which
+        # further records are appended after.
+        self.journal_end = None
+        self.records = 0
+
+    def load(self):
+        """Load the snapshot index and replay the journal over it, returning
+        the tabs in order. Session blobs aren't read until asked for."""
+        self.tabs = OrderedDict()
+        self.journal_end = None
+
+        try:
+            self.load_snapshot()
+        except FileNotFoundError:
+            if self.legacy_path is not None:
+                try:
+                    self.load_legacy()
+                except FileNotFoundError:
+                    pass
+
+        try:
+            self.replay_journal()
+        except FileNotFoundError:
+            pass
+
+        return list(self.tabs.values())
+
+    def load_snapshot(self):
+        f = open(self.snapshot_path, 'rb')
+
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError('{} is not a session snapshot'.format(self.snapshot_path))
+
+        f.seek(-FOOTER.size, os.SEEK_END)
+        index_offset, index_length, magic = FOOTER.unpack(f.read(FOOTER.size))
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError('{} is incomplete'.format(self.snapshot_path))
+
+        index = json.loads(os.pread(f.fileno(), index_length, index_offset).decode('utf8'))
+
+        for page in index:
+            tab_id = page.pop('id')
+            blob = page.pop('blob')
+            page['session'] = StoredBlob(f, *blob) if blob else None
+            self.tabs[tab_id] = page
+
+    def load_legacy(self):
+        with open(self.legacy_path, 'r') as f:
+            snapshot = json.load(f)
+
+        for i, page in enumerate(snapshot):
+            session = page.get('session')
+            if session is not None:
+                session = InlineBlob(base64.b64decode(session.encode('utf8')))
+            self.tabs[i] = {'uri': page['uri'], 'title': page.get('title'), 'session': session}
+
+    def replay_journal(self):
+        f = open(self.journal_path, 'rb')
+
+        if f.read(len(JOURNAL_MAGIC)) != JOURNAL_MAGIC:
+            return
+
+        offset = len(JOURNAL_MAGIC)
+        while True:
+            prefix = f.read(RECORD.size)
+            if len(prefix) < RECORD.size:
+                break
+
+            header_length, blob_length, crc = RECORD.unpack(prefix)
+            header = f.read(header_length)
+            blob_offset = offset + RECORD.size + header_length
+            f.seek(blob_length, os.SEEK_CUR)
+
+            # a partially written record from a crash, which can only ever
+            # be the last one.
+            if len(header) < header_length or f.tell() > os.fstat(f.fileno()).st_size:
+                break
+            if zlib.crc32(os.pread(f.fileno(), blob_length, blob_offset), zlib.crc32(header)) != crc:
+                break
+
+            record = json.loads(header.decode('utf8'))
+            # updates without a digest only changed the metadata
+            if record['op'] == 'update' and 'digest' in record['page']:
+                digest = record['page'].pop('digest')
+                if digest is not None:
+                    record['page']['session'] = StoredBlob(f, blob_offset, blob_length, digest)
+                else:
+                    record['page']['session'] = None
+            self.apply(record)
+            self.records += 1
+
+            offset = f.tell()
+
+        self.journal_end = offset
+
+    def apply(self, record):
+        op = record['op']
+        if op == 'update':
+            page = self.tabs.setdefault(record['id'], {})
+            page.update(record['page'])
+        elif op == 'close':
+            self.tabs.pop(record['id'], None)
+        elif op == 'order':
+            order = [i for i in record['ids'] if i in self.tabs]
+            rest = [i for i in self.tabs if i not in set(order)]
+            self.tabs = OrderedDict((i, self.tabs[i]) for i in order + rest)
+        else:
+            raise ValueError('Unknown session journal operation {!r}'.format(op))
+
+    def open_journal(self):
+        if self.journal_end is not None:
+            # carry on from the journal we replayed, dropping any partial
+            # record at the end.
+            self.journal = open(self.journal_path, 'r+b')
+            self.journal.truncate(self.journal_end)
+            self.journal.seek(self.journal_end)
+            return
+
+        tmp = self.journal_path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(JOURNAL_MAGIC)
+        # replaced rather than truncated, so blobs still referring to the
+        # old journal stay readable.
+        os.replace(tmp, self.journal_path)
+
+        self.journal = open(self.journal_path, 'r+b')
+        self.journal.seek(0, os.SEEK_END)
+        self.records = 0
+
+    def append(self, record, blob=None):
+        if self.journal is None:
+            self.open_journal()
+
+        header = dict(record)
+        compressed = b''
+        if record['op'] == 'update':
+            header['page'] = {k: v for (k, v) in record['page'].items() if k != 'session'}
+            if 'session' in record['page']:
+                header['page']['digest'] = None
+            if blob is not None:
+                compressed = blob.compressed()
+                header['page']['digest'] = blob.digest
+
+        header = json.dumps(header, separators=(',', ':')).encode('utf8')
+        crc = zlib.crc32(compressed, zlib.crc32(header))
+
+        offset = self.journal.tell()
+        self.journal.write(RECORD.pack(len(header), len(compressed), crc) + header + compressed)
+        self.journal.flush()
+        self.records += 1
+
+        if blob is not None:
+            # point at the journalled copy, rather than keeping the
+            # uncompressed state in memory.
+            blob_offset = offset + RECORD.size + len(header)
+            record['page']['session'] = StoredBlob(self.journal, blob_offset, len(compressed), blob.digest)
+
+        self.apply(record)
+
+    def update(self, tab_id, uri, title, session=None, **extra):
+        """Record a tab's current uri, title and session state, which is an
+        InlineBlob, StoredBlob or None. Tabs not seen before are added at the
+        end."""
+        page = dict(extra, uri=uri, title=title, session=session)
+
+        current = self.tabs.get(tab_id)
+        if current is not None:
+            changed = {k: v for (k, v) in page.items() if k != 'session' and current.get(k) != v}
+            if not changed and same_blob(current.get('session'), session):
+                return
+            if same_blob(current.get('session'), session):
+                # only the metadata changed, don't write the blob again
+                self.append({'op': 'update', 'id': tab_id, 'page': changed})
+                return
+
+        self.append({'op': 'update', 'id': tab_id, 'page': page}, blob=session)
+
+    def close_tab(self, tab_id):
+        if tab_id in self.tabs:
+            self.append({'op': 'close', 'id': tab_id})
+
+    def order(self, tab_ids):
+        tab_ids = [i for i in tab_ids if i in self.tabs]
+        if tab_ids != list(self.tabs)[:len(tab_ids)]:
+            self.append({'op': 'order', 'ids': tab_ids})
+
+    def reset(self, tabs):
+        """Replace the whole session with the given (tab id, page) pairs and
+        compact straight away."""
+        self.tabs = OrderedDict(tabs)
+        self.compact()
+
+    def compact(self):
+        """Write the current state as a new snapshot and start a new
+        journal."""
+        tmp = self.snapshot_path + '.tmp'
+        f = open(tmp, 'w+b')
+        f.write(SNAPSHOT_MAGIC)
+
+        index = []
+        tabs = OrderedDict()
+        for tab_id, page in self.tabs.items():
+            entry = {k: v for (k, v) in page.items() if k != 'session'}
+            page = dict(page)
+            blob = page.get('session')
+            if blob is not None:
+                compressed = blob.compressed()
+                offset = f.tell()
+                f.write(compressed)
+                entry['blob'] = [offset, len(compressed), blob.digest]
+                page['session'] = StoredBlob(f, offset, len(compressed), blob.digest)
+            else:
+                entry['blob'] = None
+            entry['id'] = tab_id
+            index.append(entry)
+            tabs[tab_id] = page
+
+        index = json.dumps(index, separators=(',', ':')).encode('utf8')
+        index_offset = f.tell()
+        f.write(index)
+        f.write(FOOTER.pack(index_offset, len(index), SNAPSHOT_MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+
+        self.tabs = tabs
+
+        # blobs may still refer to the old journal, which stays open until
+        # they're gone.
+        self.journal = None
+        self.journal_end = None
+        self.open_journal()
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.flush()
+            self.journal_end = self.journal.tell()
+            self.journal = None
+
+
+class RestoreScheduler:
+    """Decides when to load restored tabs in the background.
+
+    The budget most recently used tabs are loaded, at most concurrency at a
+    time, and only once there's been no user input for idle seconds. A load
+    that never reports finishing stops counting against the concurrency
+    after load_timeout seconds.
+    """
+
+    def __init__(self, pages, budget, concurrency=1, idle=2.0, load_timeout=30.0, clock=time.monotonic):
+        # pages are (tab id, last active) pairs in tab order; tabs without
+        # any recency keep their order, after the ones with it.
+        ranked = sorted(pages, key=lambda page: page[1] or 0, reverse=True)
+        self.queue = [tab_id for (tab_id, last_active) in ranked[:budget]]
+        self.loading = {}
+        self.concurrency = concurrency
+        self.idle = idle
+        self.load_timeout = load_timeout
+        self.clock = clock
+        self.last_input = None
+
+    @property
+    def done(self):
+        return not self.queue and not self.loading
+
+    def interacted(self):
+        self.last_input = self.clock()
+
+    def finished(self, tab_id):
+        """Mark a tab as loaded, or as no longer needing loading."""
+        self.loading.pop(tab_id, None)
+        if tab_id in self.queue:
+            self.queue.remove(tab_id)
+
+    def ready(self):
+        """Return the tabs to start loading now."""
+        now = self.clock()
+
+        for tab_id, started in list(self.loading.items()):
+            if now - started >= self.load_timeout:
+                del self.loading[tab_id]
+
+        if self.last_input is not None and now - self.last_input < self.idle:
+            return []
+
+        tab_ids = []
+        while self.queue and len(self.loading) < self.concurrency:
+            tab_id = self.queue.pop(0)
+            self.loading[tab_id] = now
+            tab_ids.append(tab_id)
+        return tab_ids
+
+
+def tabs_to_discard(tabs, now, max_live=None, idle_timeout=None):
+    """Choose which live tabs to discard, least recently used first.
+
+    tabs are (tab id, last active, exempt) triples for every live tab,
+    including exempt ones, which count towards max_live but are never chosen.
+    """
+    candidates = sorted((tab for tab in tabs if not tab[2]), key=lambda tab: tab[1] or 0)
+
+    discard = []
+    if idle_timeout is not None:
+        discard = [tab_id for (tab_id, last_active, exempt) in candidates
+                   if now - (last_active or 0) >= idle_timeout]
+
+    if max_live is not None:
+        excess = len(tabs) - len(discard) - max_live
+        rest = [tab_id for (tab_id, last_active, exempt) in candidates if tab_id not in discard]
+        discard += rest[:max(0, excess)]
+
+    return discard
+
+
+def truncate_back_forward_list(state, max_entries):
+    """Drop all but max_entries of the back-forward list around the current
+    item from serialised WebKit session state.
+
+    The serialisation format is WebKit's private GVariant encoding. If it
+    isn't one we recognise, the state is returned unchanged.
+    """
+    from gi.repository import GLib
+
+    for type_string in SESSION_STATE_TYPES:
+        try:
+            return _truncate(GLib, type_string, state, max_entries)
+        except ValueError:
+            continue
+
+    return state
+
+
+def _truncate(GLib, type_string, state, max_entries):
+    variant = GLib.Variant.new_from_bytes(GLib.VariantType(type_string), GLib.Bytes(state), False)
+    if not variant.is_normal_form():
+        raise ValueError('Not a {} session state'.format(type_string))
+
+    children = [variant.get_child_value(i) for i in range(variant.n_children())]
+    items, current = children[1], children[2]
+
+    count = items.n_children()
+    if count <= max_entries:
+        return state
+
+    index = current.get_maybe()
+    index = count - 1 if index is None else index.get_uint32()
+
+    start = max(0, min(index - max_entries // 2, count - max_entries))
+    kept = [items.get_child_value(i) for i in range(start, start + max_entries)]
+
+    children[1] = GLib.Variant.new_array(items.get_type().element(), kept)
+    children[2] = GLib.Variant.new_maybe(GLib.VariantType('u'), GLib.Variant('u', index - start))
+    return GLib.Variant.new_tuple(*children).get_data_as_bytes().get_data()
+
+
+# WebKit's session state encodings, from WebKitWebViewSessionState.cpp.
+_HTTP_BODY = 'm(sa(uaysxmxds))'
+_FRAME_STATE = '(ssssasmayxx(ii)d' + _HTTP_BODY + 'av)'
+SESSION_STATE_TYPES = [
+    '(qa(ts' + _FRAME_STATE + 'u)mu)',
+    '(qa(ts' + _FRAME_STATE + 'ub)mu)',
+]
@@ -0,0 +1,159 @@
+"""Shared SQLite storage for extensions.
+
+Each database is opened once per process and owned by a dedicated writer
+thread, with a small pool of reader threads alongside it. Connections use
+WAL journaling, so readers never wait on the writer. Nothing here runs a
+query on the calling thread; every call returns a Future that can be waited
+on, given a callback or awaited from a coroutine.
+"""
+
+import asyncio
+import concurrent.futures
+import sqlite3
+import threading
+
+from .utils import config_path
+
+
+class Future(concurrent.futures.Future):
+    """concurrent.futures.Future that can also be awaited from whatever
+    asyncio loop is running."""
+
+    def __await__(self):
+        return asyncio.wrap_future(self).__await__()
+
+
+def submit(executor, func, *args):
+    """Run func(*args) on executor, returning an awaitable Future."""
+    future = Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+
+        try:
+            result = func(*args)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    executor.submit(run)
+    return future
+
+
+def completed(result):
+    """Return a Future that has already finished with result."""
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class Database:
+    def __init__(self, path, schema=(), readers=2):
+        self.path = path
+        self.schema = list(schema)
+        self.local = threading.local()
+        self.ready = threading.Event()
+
+        name = path.rsplit('/', 1)[-1]
+        self.writer = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='roland-db-writer-{}'.format(name))
+        self.readers = concurrent.futures.ThreadPoolExecutor(
+            max_workers=readers, thread_name_prefix='roland-db-reader-{}'.format(name))
+
+        # the schema is created before anything else runs on the writer, and
+        # readers wait for it, so callers never see a missing table.
+        self.submit(self.writer, self.create_schema)
+
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES)
+            conn.execute('pragma journal_mode=wal')
+            conn.execute('pragma synchronous=normal')
+            self.local.conn = conn
+        return conn
+
+    def create_schema(self, conn):
+        try:
+            with conn:
+                for statement in self.schema:
+                    conn.execute(statement)
+        finally:
+            self.ready.set()
+
+    def submit(self, executor, func, *args):
+        def run():
+            if executor is self.readers:
+                self.ready.wait()
+            return func(self.connect(), *args)
+        return submit(executor, run)
+
+    def read(self, func, *args):
+        """Run func(connection, *args) on a reader thread."""
+        return self.submit(self.readers, func, *args)
+
+    def write(self, func, *args):
+        """Run func(connection, *args) on the writer thread, inside a
+        transaction."""
+        def transaction(conn, *args):
+            with conn:
+                return func(conn, *args)
+        return self.submit(self.writer, transaction, *args)
+
+    def fetchall(self, sql, params=()):
+        return self.read(lambda conn: conn.execute(sql, params).fetchall())
+
+    def fetchone(self, sql, params=()):
+        return self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+    def execute(self, sql, params=()):
+        """Execute a single write, returning the new row id."""
+        return self.write(lambda conn: conn.execute(sql, params).lastrowid)
+
+    def executemany(self, sql, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        return self.write(lambda conn: conn.executemany(sql, seq_of_params).rowcount)
+
+    def batch(self, statements):
+        """Execute a list of (sql, params) pairs in a single transaction."""
+        statements = list(statements)
+
+        def run(conn):
+            for sql, params in statements:
+                conn.execute(sql, params)
+        return self.write(run)
+
+    def close(self):
+        """Wait for outstanding queries to finish and shut down the
+        database's threads."""
+        self.readers.shutdown(wait=True)
+        self.writer.shutdown(wait=True)
+
+
+databases = {}
+databases_lock = threading.Lock()
+
+
+def open_database(name, schema=()):
+    """Return the process-wide Database for the given file in roland's
+    config directory, opening it if need be."""
+    with databases_lock:
+        try:
+            db = databases[name]
+        except KeyError:
+            db = databases[name] = Database(config_path(name), schema=schema)
+        else:
+            if schema:
+                db.write(lambda conn: [conn.execute(s) for s in schema])
+    return db
+
+
+def close_all():
+    with databases_lock:
+        dbs = list(databases.values())
+        databases.clear()
+
+    for db in dbs:
+        db.close()
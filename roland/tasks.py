@@ -0,0 +1,83 @@
+"""The roland://tasks page, listing what each tab is using.
+
+It's updated in place every few seconds while it's open, see pages.
+"""
+
+import html
+from collections import namedtuple
+
+from .utils import get_pretty_size
+
+Task = namedtuple('Task', 'tab_id title uri pid rss pss cpu requests bytes')
+
+# column name, heading, and whether it sorts largest first
+COLUMNS = [
+    ('title', 'Tab', False),
+    ('pid', 'PID', False),
+    ('rss', 'RSS', True),
+    ('pss', 'PSS', True),
+    ('cpu', 'CPU', True),
+    ('requests', 'Requests', True),
+    ('bytes', 'Received', True),
+]
+DEFAULT_SORT = 'pss'
+
+
+def cpu_percent(previous, current):
+    """Return the CPU use between two (wall time, cpu time) samples as a
+    percentage of one core, or None without a previous sample."""
+    if previous is None or current is None:
+        return None
+
+    elapsed = current[0] - previous[0]
+    if elapsed <= 0:
+        return None
+    return max(0.0, (current[1] - previous[1]) / elapsed * 100)
+
+
+def sort_tasks(tasks, sort=DEFAULT_SORT):
+    columns = {name: descending for (name, heading, descending) in COLUMNS}
+    if sort not in columns:
+        sort = DEFAULT_SORT
+
+    # unloaded tabs have no process, and always go last
+    present = [task for task in tasks if getattr(task, sort) is not None]
+    missing = [task for task in tasks if getattr(task, sort) is None]
+    return sorted(present, key=lambda task: getattr(task, sort), reverse=columns[sort]) + missing
+
+
+def format_value(name, value):
+    if value is None:
+        return '-'
+    if name in ('rss', 'pss', 'bytes'):
+        return get_pretty_size(value)
+    if name == 'cpu':
+        return '{:.1f}%'.format(value)
+    return str(value)
+
+
+def render_tasks_page(tasks, sort=DEFAULT_SORT):
+    """Return the content of the page, a table of tasks sorted by sort."""
+    if sort not in [name for (name, heading, descending) in COLUMNS]:
+        sort = DEFAULT_SORT
+
+    rows = []
+    for task in sort_tasks(tasks, sort):
+        cells = ['<td title="{}">{}</td>'.format(html.escape(task.uri or ''), html.escape(task.title or ''))]
+        cells += ['<td class="number">{}</td>'.format(format_value(name, getattr(task, name)))
+                  for (name, heading, descending) in COLUMNS[1:]]
+        rows.append('<tr>{}</tr>'.format(''.join(cells)))
+
+    headings = ''.join(
+        '<th><a href="roland://tasks/?sort={}">{}</a>{}</th>'.format(
+            name, heading, ' &#9662;' if name == sort else '')
+        for (name, heading, descending) in COLUMNS
+    )
+
+    return TASKS_TABLE.format(headings=headings, rows='\n'.join(rows))
+
+
+TASKS_TABLE = '''<table>
+<tr>{headings}</tr>
+{rows}
+</table>'''
@@ -1,4 +1,7 @@
+import importlib
+import json
 import os
+import types
 
 
 def get_pretty_size(bytecount):
@@ -26,36 +29,63 @@ def cache_path(t):
     return os.path.join(GLib.get_user_cache_dir(), 'roland', t)
 
 
+# Gdk's names for keys that have shorter ones
+KEY_NAMES = {
+    'slash': '/',
+    'question': '?',
+    'plus': '+',
+    'minus': '-',
+    'equal': '=',
+    'colon': ':',
+    'dollar': '$',
+    'asciicircum': '^',
+}
+
+ACCEPTABLE_FOR_SHIFT = ('space',)
+
+# (keyval, modifiers) -> name, since every key press is looked up here
+keyname_cache = {}
+
+
 def get_keyname(event):
     from gi.repository import Gdk
     if event is None:
         return None
 
-    acceptable_for_shift = ['space']
+    modifiers = event.state & (
+        Gdk.ModifierType.CONTROL_MASK | Gdk.ModifierType.SHIFT_MASK |
+        Gdk.ModifierType.SUPER_MASK | Gdk.ModifierType.MOD1_MASK)
+    try:
+        return keyname_cache[event.keyval, modifiers]
+    except KeyError:
+        pass
+
     keyname = Gdk.keyval_name(event.keyval)
     fields = []
-    if event.state & Gdk.ModifierType.CONTROL_MASK:
+    if modifiers & Gdk.ModifierType.CONTROL_MASK:
         fields.append('C')
-    if keyname in acceptable_for_shift and event.state & Gdk.ModifierType.SHIFT_MASK:
+    if keyname in ACCEPTABLE_FOR_SHIFT and modifiers & Gdk.ModifierType.SHIFT_MASK:
         fields.append('S')
-    if event.state & Gdk.ModifierType.SUPER_MASK:
+    if modifiers & Gdk.ModifierType.SUPER_MASK:
         fields.append('L')
-    if event.state & Gdk.ModifierType.MOD1_MASK:
+    if modifiers & Gdk.ModifierType.MOD1_MASK:
         fields.append('A')
 
-    keyname = {
-        'slash': '/',
-        'question': '?',
-        'plus': '+',
-        'minus': '-',
-        'equal': '=',
-        'colon': ':',
-        'dollar': '$',
-        'asciicircum': '^',
-    }.get(keyname, keyname)
+    fields.append(KEY_NAMES.get(keyname, keyname))
+    name = keyname_cache[event.keyval, modifiers] = '-'.join(fields)
+    return name
+
 
-    fields.append(keyname)
-    return '-'.join(fields)
+def blocking_wait(future):
+    """Wait for a concurrent.futures.Future while still running the main
+    loop, the same way EntryLine.blocking_prompt waits for input, so the UI
+    keeps responding while work happens elsewhere."""
+    if not future.done():
+        import gbulb
+        loop = gbulb.get_event_loop()
+        future.add_done_callback(lambda f: loop.call_soon_threadsafe(loop.stop))
+        loop.run()
+    return future.result()
 
 
 def init_logging():
@@ -84,13 +114,71 @@ def default_config():
     return config
 
 
+# hooks that config can define as functions of the same name
+CONFIG_HOOKS = (
+    'user_agent_choices',
+    'search_url',
+    'should_display_notification',
+    'should_open_popup',
+)
+
+
 class RolandConfigBase:
+    in_web_process = False
+
     def load_config(self):
         self.config = load_config()
         self.extensions = sorted([ext(self) for ext in self.config.extensions], key=lambda ext: ext.sort_order)
+        self.index_extensions()
 
         self.make_config_directories()
 
+    def load_settings(self, settings):
+        """Load the snapshot made by web_process_settings, instead of running
+        config.py and creating every extension."""
+        settings = json.loads(settings)
+        self.config = types.SimpleNamespace(**settings['config'])
+
+        self.extensions = []
+        for module, name in settings['extensions']:
+            try:
+                extension = getattr(importlib.import_module(module), name)
+            except (ImportError, AttributeError) as e:
+                # e.g. defined in config.py
+                import logbook
+                logbook.Logger('roland').error("Can't load extension {}.{} in the web process: {}", module, name, e)
+                continue
+            self.extensions.append(extension(self))
+
+        self.extensions.sort(key=lambda ext: ext.sort_order)
+        self.index_extensions()
+
+    def index_extensions(self):
+        """Index extensions by name and type, and build the list of
+        subscribers for each hook, so neither is searched for later."""
+        self.extension_index = {}
+        for ext in reversed(self.extensions):
+            # the first of any duplicates wins, as it did when searching
+            self.extension_index[ext.__class__.__name__] = ext
+            self.extension_index[ext.__class__] = ext
+
+        self.config_hooks = {}
+        for name in CONFIG_HOOKS:
+            func = getattr(self.config, name, None)
+            if func is not None:
+                self.config_hooks[name] = func
+
+        self.hook_table = {}
+
+        # deferred extensions subscribe once they're set up
+        for ext in self.extensions:
+            if not ext.deferred or ext.ready:
+                self.add_hooks(ext)
+
+    def add_hooks(self, ext):
+        for name in ext.handles:
+            self.hook_table.setdefault(name, []).append(getattr(ext, name))
+
     def make_config_directories(self):
         for p in cache_path, config_path, runtime_path:
             p = p('')
@@ -105,10 +193,38 @@ class RolandConfigBase:
     def get_extension(self, extensiontype):
         if not isinstance(extensiontype, str):
             extensiontype = extensiontype.__name__
-
-        for ext in self.extensions:
-            if ext.__class__.__name__ == extensiontype:
-                return ext
+        ext = self.extension_index.get(extensiontype)
+        if ext is not None and ext.deferred and not ext.ready:
+            # not set up yet, or setting it up failed
+            return None
+        return ext
+
+    def has_hook(self, name):
+        return name in self.config_hooks or name in self.hook_table
+
+    def hooks(self, name, *args, default=None):
+        """Ask the hook for an answer. When config defines it, its result is
+        returned as is, None included. Otherwise it's the first result from
+        subscribed extensions that isn't None, or default."""
+        func = self.config_hooks.get(name)
+        if func is not None:
+            return func(*args)
+
+        for func in self.hook_table.get(name, ()):
+            result = func(*args)
+            if result is not None:
+                return result
+        return default
+
+    def broadcast(self, name, *args):
+        """Tell every subscriber to the hook, config first and then
+        extensions, ignoring their results."""
+        func = self.config_hooks.get(name)
+        if func is not None:
+            func(*args)
+
+        for func in self.hook_table.get(name, ()):
+            func(*args)
 
     def notify(self, message, critical=False, header=''):
         ext = self.get_extension('NotificationManager')
@@ -126,22 +242,120 @@ class RolandConfigBase:
                 self.notify("Set clipboard to '{}'".format(text))
 
 
+def same_value(a, b):
+    """Whether a and b, from two runs of config.py, are the same setting.
+    Functions and classes are recreated by each run, so they're compared by
+    their code and name instead of identity."""
+    if type(a) is not type(b) and not same_value(type(a), type(b)):
+        return False
+
+    if isinstance(a, types.FunctionType):
+        return (a.__code__ == b.__code__ and
+                same_value(a.__defaults__, b.__defaults__) and
+                same_value(a.__kwdefaults__, b.__kwdefaults__))
+    if isinstance(a, type):
+        return (a.__module__, a.__qualname__) == (b.__module__, b.__qualname__)
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(same_value(x, y) for x, y in zip(a, b))
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(same_value(a[key], b[key]) for key in a)
+    if type(a).__eq__ is object.__eq__ and hasattr(a, '__dict__'):
+        # e.g. lazy commands
+        return same_value(vars(a), vars(b))
+    return a == b
+
+
+def config_settings(config):
+    """Return the settings in config, by name."""
+    return {
+        name: value for name, value in vars(config).items()
+        if not name.startswith('_') and not isinstance(value, types.ModuleType)
+    }
+
+
+def diff_config(old, new):
+    """Return the names of the settings that differ between two results of
+    config_settings, including any only one of them has."""
+    return {
+        name for name in old.keys() | new.keys()
+        if name not in old or name not in new or not same_value(old[name], new[name])
+    }
+
+
+def dependencies_settled(ext, settled, enabled):
+    """Whether every extension ext depends on has been set up (or failed
+    to), ignoring any that aren't in enabled. All are names."""
+    return all(name in settled or name not in enabled for name in ext.depends)
+
+
+def importable(cls):
+    """Return whether cls can be imported by its module and name, as web
+    processes do for extensions. Classes defined in config.py can't."""
+    import sys
+    if cls.__module__ in ('__main__', 'roland.config'):
+        return False
+    return getattr(sys.modules.get(cls.__module__), cls.__name__, None) is cls
+
+
+def web_process_settings(extensions, config):
+    """Return a snapshot of what web processes need, to be passed to them as
+    JSON: which of extensions they run, and the config those use.
+
+    Returns None if an extension can't be imported by web processes, or that
+    config can't be represented as JSON, in which case web processes have to
+    load config.py themselves.
+    """
+    extensions = [ext for ext in extensions if ext.web_process]
+
+    for ext in extensions:
+        if not importable(ext.__class__):
+            import logbook
+            logbook.Logger('roland').info("Web processes will load config.py, they can't import {}", ext.__class__.__name__)
+            return None
+
+    web_config = {}
+    for ext in extensions:
+        for name in ext.web_process_config:
+            if hasattr(config, name):
+                web_config[name] = getattr(config, name)
+
+    try:
+        return json.dumps({
+            'extensions': [[ext.__class__.__module__, ext.__class__.__name__] for ext in extensions],
+            'config': web_config,
+        })
+    except (TypeError, ValueError) as e:
+        import logbook
+        logbook.Logger('roland').warning("Web processes will load config.py, config can't be passed to them: {}", e)
+        return None
+
+
 def load_config():
-    import imp
+    import importlib.util
+    import sys
+
+    # always a fresh module, so that anything removed from config.py since
+    # it was last loaded is gone
+    spec = importlib.util.spec_from_file_location('roland.config', config_path('config.py'))
+    config = importlib.util.module_from_spec(spec)
     try:
-        config = imp.load_source('roland.config', config_path('config.py'))
+        spec.loader.exec_module(config)
     except FileNotFoundError:
         config = default_config()
+    else:
+        sys.modules['roland.config'] = config
 
     from roland.extensions import (
         CookieManager, DBusManager, DownloadManager, HistoryManager,
         SessionManager, TLSErrorByPassExtension, HSTSExtension,
-        PasswordManagerExtension, NotificationManager, ClipboardManager)
+        PasswordManagerExtension, NotificationManager, ClipboardManager,
+        TabDiscarder, MemoryMonitor, TaskManager, ClosedTabs)
 
     default_extensions = [
         CookieManager, DBusManager, DownloadManager, HistoryManager,
         SessionManager, TLSErrorByPassExtension, HSTSExtension,
-        PasswordManagerExtension, NotificationManager, ClipboardManager]
+        PasswordManagerExtension, NotificationManager, ClipboardManager,
+        TabDiscarder, MemoryMonitor, TaskManager, ClosedTabs]
     config.extensions = getattr(config, 'extensions', default_extensions)
 
     # DBusManager, as of the WebKit2 port, is essentially required
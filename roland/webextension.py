@@ -19,7 +19,9 @@ Highlight = namedtuple('Highlight', 'nodes node_lists')
 
 
 class RolandWebExtension(RolandConfigBase):
-    def __init__(self):
+    in_web_process = True
+
+    def __init__(self, settings=None):
         gbulb.install(gtk=False)
 
         try:
@@ -29,28 +31,31 @@ class RolandWebExtension(RolandConfigBase):
             self.loop = asyncio.new_event_loop()
             asyncio.set_event_loop(self.loop)
 
-        self.load_config()
+        if settings is None:
+            # started by a roland that doesn't pass settings, or whose config
+            # couldn't be passed
+            self.load_config()
+        else:
+            self.load_settings(settings)
         self.pages = {}
         self.highlight_matches = {}
 
     def run(self):
-        def ignore(ext):
-            return ext.__class__.__name__ not in [
-                'HistoryManager',
-                'HSTSExtension',
-                'NotificationManager',
-                'ClipboardManager',
-            ]
-
         for ext in self.extensions:
-            if ignore(ext):
+            if not ext.web_process:
                 continue
 
+            # there's no window to show first here, so nothing is deferred
             try:
+                ext.prepare()
                 ext.setup()
             except Exception as e:
                 log.exception("Failure setting up {}: {}".format(ext.name, e))
                 self.notify("Failure setting up {}: {}".format(ext.name, e), critical=True)
+            else:
+                ext.ready = True
+                if ext.deferred:
+                    self.add_hooks(ext)
 
         self.loop.run_forever()
 
@@ -301,6 +306,17 @@ class RolandWebExtension(RolandConfigBase):
         web_page.connect("document-loaded", self.on_document_loaded)
         web_page.connect("send-request", self.on_send_request)
 
+        self.report_web_process(page_id)
+
+    def report_web_process(self, page_id):
+        """Tell the UI process which web process is running page_id, for
+        monitoring its memory."""
+        from roland.api import dbus_execute
+        try:
+            dbus_execute('web_process_started', page_id, os.getpid(), ignore_reply=True)
+        except Exception:
+            log.exception("Error reporting web process for {}", page_id)
+
     def on_send_request(self, webpage, request, redirected_response):
         uri = request.get_uri()
 
@@ -342,7 +358,8 @@ def initialize(extension, arguments):
     init_logging()
     log.info("Plugin initialized")
 
-    roland = RolandWebExtension()
+    settings = arguments.unpack() if arguments is not None else None
+    roland = RolandWebExtension(settings)
 
     extension.connect('page-created', roland.on_page_created)
 
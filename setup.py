@@ -1,6 +1,40 @@
 #!/usr/bin/env python2
 
+import os
+import runpy
+
 from setuptools import setup
+from setuptools.command.build_py import build_py as _build_py
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+class build_py(_build_py):
+    """Compile Chromium's HSTS preload list into the package, unless
+    roland/data/hsts_preload.bin was built already.
+
+    Set ROLAND_HSTS_PRELOAD_SOURCE to a copy of
+    transport_security_state_static.json to build without downloading it.
+    """
+    def run(self):
+        super().run()
+
+        if os.path.exists(os.path.join(here, 'roland', 'data', 'hsts_preload.bin')):
+            # copied in as package data
+            return
+
+        if getattr(self, 'editable_mode', False):
+            output = os.path.join(here, 'roland', 'data', 'hsts_preload.bin')
+        else:
+            output = os.path.join(self.build_lib, 'roland', 'data', 'hsts_preload.bin')
+
+        # only the standard library is needed for this, not roland's
+        # dependencies
+        hsts = runpy.run_path(os.path.join(here, 'roland', 'hsts.py'))
+        source = os.environ.get('ROLAND_HSTS_PRELOAD_SOURCE', hsts['CHROMIUM_PRELOAD_URL'])
+        size = hsts['build_preload_list'](source, output, timeout=60)
+        self.announce('compiled HSTS preload list into {} ({} bytes)'.format(output, size), level=2)
+
 
 settings = {
     'name': 'roland',
@@ -19,7 +53,9 @@ settings = {
     ),
     'zip_safe': False,
     'packages': ['roland'],
+    'package_data': {'roland': ['data/hsts_preload.bin']},
     'scripts': ['bin/roland'],
+    'cmdclass': {'build_py': build_py},
 }
 
 setup(**settings)
@@ -138,3 +138,36 @@ class TestBrowserWindow:
         browser_window.failed_to_find_text(finder)
 
         assert not browser_window.roland.notify.mock_calls
+
+
+class TestCommandRegistry:
+    def test_commands(self):
+        from roland.core import BrowserCommands
+
+        command = BrowserCommands.commands['tab-bar-width']
+        assert command.attribute == 'tab_bar_width'
+        assert 'tab_bar_width' not in BrowserCommands.commands
+
+        assert BrowserCommands.commands['save-session'].extensions == ('SessionManager',)
+        assert BrowserCommands.commands['list_downloads'].private
+        assert not any(name.startswith('_') for name in BrowserCommands.commands)
+
+    def test_get_commands(self):
+        from roland.core import BrowserCommands, Roland
+
+        roland = MagicMock()
+        roland.available_commands = None
+        roland.is_enabled.return_value = False
+
+        commands = Roland.get_commands(roland)
+        assert 'tab-bar-width' in commands
+        assert 'save-session' not in commands
+        assert 'list_downloads' not in commands
+        assert Roland.get_commands(roland) is commands
+
+        Roland.register_command(roland, 'hello', lambda browser: None, help='Say hello')
+        try:
+            assert 'hello' in Roland.get_commands(roland)
+            assert Roland.get_help(roland, 'hello') == 'Say hello'
+        finally:
+            del BrowserCommands.commands['hello']
@@ -0,0 +1,316 @@
+import http.server
+import threading
+
+import pytest
+
+PAYLOAD = bytes(range(256)) * 1024
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/missing':
+            self.send_error(404)
+            return
+
+        start, end = 0, len(PAYLOAD)
+        if self.server.ranges and 'Range' in self.headers:
+            first, last = self.headers['Range'][len('bytes='):].split('-')
+            start = int(first)
+            end = int(last) + 1 if last else len(PAYLOAD)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end - 1, len(PAYLOAD)))
+        else:
+            self.send_response(200)
+
+        self.server.requests.append(dict(self.headers))
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+
+        self.server.release.wait(5)
+        self.wfile.write(PAYLOAD[start:end])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.ranges = True
+    server.requests = []
+    server.release = threading.Event()
+    server.release.set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.release.set()
+    server.shutdown()
+    server.server_close()
+
+
+def url(server, path='/file'):
+    return 'http://127.0.0.1:{}{}'.format(server.server_address[1], path)
+
+
+class Collector:
+    def __init__(self):
+        self.done = []
+        self.event = threading.Event()
+
+    def __call__(self, download):
+        self.done.append(download)
+        self.event.set()
+
+    def wait(self, count=1):
+        for i in range(50):
+            if len(self.done) >= count:
+                return
+            self.event.wait(0.1)
+            self.event.clear()
+        raise AssertionError('downloads did not finish')
+
+
+def test_token_bucket():
+    from roland.downloads import TokenBucket
+
+    now = [0]
+    bucket = TokenBucket(100, clock=lambda: now[0])
+    assert bucket.reserve(100) == 0
+    assert bucket.reserve(50) == 0.5
+
+    now[0] = 2
+    assert bucket.reserve(50) == 0
+
+
+def test_reservations(tmpdir):
+    from roland.downloads import Reservations
+
+    tmpdir.join('foo').write('')
+    tmpdir.join('foo.1').write('existing')
+
+    reservations = Reservations()
+    directory = str(tmpdir.join('downloads'))
+    assert reservations.reserve(directory, 'foo') == str(tmpdir.join('downloads', 'foo'))
+
+    paths = [reservations.reserve(str(tmpdir), 'foo') for i in range(3)]
+    assert paths == [str(tmpdir.join(name)) for name in ('foo.2', 'foo.3', 'foo.4')]
+    assert tmpdir.join('foo.1').read() == 'existing'
+    assert reservations.counters[str(tmpdir.join('foo'))] == 5
+
+
+def test_reservation_gives_up(tmpdir):
+    from roland.downloads import Reservations
+
+    # creating the directory doesn't help, as the file is in another one
+    with pytest.raises(FileNotFoundError):
+        Reservations().reserve(str(tmpdir.join('downloads')), 'missing/foo')
+    assert tmpdir.join('downloads').check(dir=True)
+
+
+def test_download(server, tmpdir):
+    from roland.downloads import DownloadScheduler, FINISHED
+
+    collector = Collector()
+    scheduler = DownloadScheduler(callback=collector)
+    download = scheduler.add(
+        url(server), str(tmpdir.join('file')), headers={'User-Agent': 'roland'}, cookies='a=b')
+    collector.wait()
+
+    assert download.state == FINISHED
+    assert download.get_progress() == 1.0
+    assert download.get_total_size() == len(PAYLOAD)
+    assert tmpdir.join('file').read_binary() == PAYLOAD
+    assert not tmpdir.join('file.part').exists()
+    assert server.requests[0]['User-Agent'] == 'roland'
+    assert server.requests[0]['Cookie'] == 'a=b'
+
+
+def test_failed_download(server, tmpdir):
+    from roland.downloads import DownloadScheduler, FAILED
+
+    collector = Collector()
+    scheduler = DownloadScheduler(callback=collector)
+    download = scheduler.add(url(server, '/missing'), str(tmpdir.join('file')))
+    collector.wait()
+
+    assert download.state == FAILED
+    assert download.error is not None
+
+
+def test_max_active_and_priority(server, tmpdir):
+    from roland.downloads import DownloadScheduler, QUEUED
+
+    server.release.clear()
+
+    collector = Collector()
+    scheduler = DownloadScheduler(max_active=1, callback=collector)
+    first = scheduler.add(url(server), str(tmpdir.join('first')))
+    low = scheduler.add(url(server), str(tmpdir.join('low')))
+    high = scheduler.add(url(server), str(tmpdir.join('high')), priority=1)
+
+    assert scheduler.active() == [first]
+    assert low.state == high.state == QUEUED
+    assert scheduler.queued() == [high, low]
+
+    server.release.set()
+    collector.wait(3)
+    assert collector.done == [first, high, low]
+
+
+def test_pause_queued_download(server, tmpdir):
+    from roland.downloads import DownloadScheduler, FINISHED, PAUSED
+
+    server.release.clear()
+
+    collector = Collector()
+    scheduler = DownloadScheduler(max_active=1, callback=collector)
+    first = scheduler.add(url(server), str(tmpdir.join('first')))
+    second = scheduler.add(url(server), str(tmpdir.join('second')))
+    second.pause()
+
+    server.release.set()
+    collector.wait()
+    assert collector.done == [first]
+    assert second.state == PAUSED
+
+    second.resume()
+    collector.wait(2)
+    assert second.state == FINISHED
+    assert tmpdir.join('second').read_binary() == PAYLOAD
+
+
+def test_split_ranges():
+    from roland.downloads import split_ranges
+
+    assert split_ranges(10, 3) == [(0, 4), (4, 8), (8, 10)]
+    assert split_ranges(10, 1) == [(0, 10)]
+    assert split_ranges(2, 4) == [(0, 1), (1, 2)]
+
+
+def test_parse_content_range():
+    from roland.downloads import parse_content_range
+
+    assert parse_content_range('bytes 0-99/1000') == 1000
+    assert parse_content_range('bytes 0-99/*') is None
+    assert parse_content_range(None) is None
+
+
+def test_segmented_download(server, tmpdir):
+    from roland.downloads import DownloadScheduler, FINISHED
+
+    collector = Collector()
+    scheduler = DownloadScheduler(callback=collector, segments=4, segment_min_size=1024)
+    download = scheduler.add(url(server), str(tmpdir.join('file')))
+    collector.wait()
+
+    assert download.state == FINISHED
+    assert tmpdir.join('file').read_binary() == PAYLOAD
+    assert sorted(r['Range'] for r in server.requests) == [
+        'bytes=0-', 'bytes=131072-196607', 'bytes=196608-262143', 'bytes=65536-131071']
+    assert not tmpdir.join('file.roland-download').exists()
+
+
+def test_download_without_range_support(server, tmpdir):
+    from roland.downloads import DownloadScheduler, FINISHED
+
+    server.ranges = False
+
+    collector = Collector()
+    scheduler = DownloadScheduler(callback=collector, segments=4, segment_min_size=1024)
+    download = scheduler.add(url(server), str(tmpdir.join('file')))
+    collector.wait()
+
+    assert download.state == FINISHED
+    assert len(server.requests) == 1
+    assert tmpdir.join('file').read_binary() == PAYLOAD
+
+
+def test_resume_after_restart(server, tmpdir):
+    import json
+    from roland.downloads import DownloadScheduler, FINISHED, PAUSED, find_partial_downloads
+
+    # what's left behind by a roland that stopped part way through
+    half = len(PAYLOAD) // 2
+    partial = bytearray(len(PAYLOAD))
+    partial[:1000] = PAYLOAD[:1000]
+    partial[half:half + 500] = PAYLOAD[half:half + 500]
+    tmpdir.join('file').write_binary(b'')
+    tmpdir.join('file.part').write_binary(bytes(partial))
+    tmpdir.join('file.roland-download').write(json.dumps({
+        'url': url(server),
+        'headers': {'User-Agent': 'roland'},
+        'total': len(PAYLOAD),
+        'segments': [[0, half, 1000], [half, len(PAYLOAD), half + 500]],
+    }))
+
+    [(found_url, path, headers)] = find_partial_downloads(str(tmpdir))
+    assert found_url == url(server)
+
+    collector = Collector()
+    scheduler = DownloadScheduler(callback=collector)
+    download = scheduler.add(found_url, path, headers=headers, paused=True)
+    assert download.state == PAUSED
+
+    download.resume()
+    collector.wait()
+
+    assert download.state == FINISHED
+    assert sorted(r['Range'] for r in server.requests) == [
+        'bytes=1000-{}'.format(half - 1), 'bytes={}-{}'.format(half + 500, len(PAYLOAD) - 1)]
+    assert tmpdir.join('file').read_binary() == PAYLOAD
+    assert not tmpdir.join('file.part').exists()
+    assert find_partial_downloads(str(tmpdir)) == []
+
+
+def test_state_file_has_no_credentials(tmpdir):
+    import json
+    from roland.downloads import DownloadScheduler
+
+    scheduler = DownloadScheduler()
+    download = scheduler.add('https://keyerror.com/file', str(tmpdir.join('file')), headers={
+        'User-Agent': 'roland', 'Authorization': 'Basic aHVudGVyMg==', 'Referer': 'https://keyerror.com/'},
+        cookies='a=b', paused=True)
+    scheduler.save_state(download, force=True)
+
+    state = json.loads(tmpdir.join('file.roland-download').read())
+    assert state['headers'] == {'User-Agent': 'roland'}
+    assert 'a=b' not in tmpdir.join('file.roland-download').read()
+
+
+def test_cancel_removes_partial_file(server, tmpdir):
+    from roland.downloads import CANCELLED, DownloadScheduler
+
+    server.release.clear()
+
+    collector = Collector()
+    scheduler = DownloadScheduler(callback=collector)
+    download = scheduler.add(url(server), str(tmpdir.join('file')))
+    download.cancel()
+    server.release.set()
+    collector.wait()
+
+    assert download.state == CANCELLED
+    assert not tmpdir.join('file').exists()
+    assert not tmpdir.join('file.part').exists()
+    assert scheduler.downloads == []
+
+
+def test_rate_limit(server, tmpdir):
+    from roland.downloads import DownloadScheduler
+
+    collector = Collector()
+    # half the payload per second, after the initial burst
+    scheduler = DownloadScheduler(rate=len(PAYLOAD) // 2, callback=collector)
+    scheduler.chunk_size = 16 * 1024
+    reserved = []
+    limiter_reserve = scheduler.limiter.reserve
+
+    def reserve(amount):
+        wait = limiter_reserve(amount)
+        reserved.append(wait)
+        return wait
+
+    scheduler.limiter.reserve = reserve
+    scheduler.add(url(server), str(tmpdir.join('file')))
+    collector.wait()
+
+    assert sum(reserved) > 0
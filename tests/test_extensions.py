@@ -21,11 +21,283 @@ class TestDownloadManager:
 
         dm = self.download_manager()
 
-        def path_exists(p):
-            return exists_list.pop(0)
+        def reserve(p, flags, mode):
+            if exists_list.pop(0):
+                raise FileExistsError(p)
+            return -1
 
         download = MagicMock(WebKit2.Download())
-        with patch('os.path.exists', path_exists):
+        with patch('os.open', reserve), patch('os.close'):
             dm.decide_destination(download, 'foo')
 
-        download.set_destination.assert_any_call('file:///path/to/downloads/' + expected_filepath)
+        download.set_destination.assert_any_call('file:///path/to/downloads/' + expected_filepath + '.part')
+
+    def test_finished_after_failed(self, tmpdir):
+        dm = self.download_manager()
+        dm.post_process = MagicMock()
+
+        location = str(tmpdir.join('foo'))
+        tmpdir.join('foo').write('')
+        tmpdir.join('foo.part').write('half')
+
+        download = MagicMock()
+        download.get_destination.return_value = 'file://' + location + '.part'
+        dm.roland.downloads = {location: download}
+
+        with patch('roland.extensions.WebKit2'):
+            dm.failed(download, 'network error')
+            dm.finished(download)
+
+        assert not tmpdir.join('foo').exists()
+        assert not dm.post_process.called
+        assert dm.roland.notify.call_count == 1
+
+
+class TestSessionManager:
+    class Browser:
+        tab_ids = None
+
+        def __init__(self, url, title=None, session=None, lazy=False, **kwargs):
+            self.tab_id = next(self.tab_ids)
+            self.lazy = lazy
+            self.lazy_uri = url
+            self.lazy_session = session
+            self.title = title
+            self.last_active = 0
+            self.pinned = False
+            self.webview = MagicMock()
+            self.webview.get_uri.return_value = url
+
+        def get_title(self):
+            return self.title
+
+        def get_serialised_session_state(self):
+            return b'state'
+
+    @pytest.fixture
+    def restore(self, tmpdir):
+        import itertools
+        from roland.extensions import SessionManager
+
+        def restore(current=()):
+            roland = MagicMock()
+            roland.config.session_warmup_tabs = 0
+            roland.config.session_max_history = None
+            browsers = []
+            roland.get_browsers = lambda: list(browsers)
+            ext = SessionManager(roland=roland)
+
+            # tab ids start again at 1 for every process
+            self.Browser.tab_ids = itertools.count(1)
+            for url in current:
+                browsers.append(self.Browser(url))
+
+            def new_window(**kwargs):
+                browsers.append(self.Browser(**kwargs))
+                # the first tab is switched to as soon as it's added
+                if len(browsers) == 1:
+                    ext.tab_changed(browsers[0])
+            roland.new_window.side_effect = new_window
+
+            with patch('roland.extensions.config_path', lambda p: str(tmpdir.join(p))), \
+                    patch('roland.extensions.GLib'):
+                ext.prepare()
+                ext.setup()
+            return ext, browsers
+
+        yield restore
+
+    def saved(self, ext):
+        from roland.session import SessionJournal
+        ext.shutdown()
+        journal = SessionJournal(
+            ext.journal.snapshot_path, ext.journal.journal_path, legacy_path=ext.journal.legacy_path)
+        return [page['uri'] for page in journal.load()]
+
+    def test_restore_legacy_session(self, restore, tmpdir):
+        import json
+        tmpdir.join('session.json').write(json.dumps([
+            {'uri': 'https://keyerror.com/'},
+            {'uri': 'https://lastpass.com/'},
+            {'uri': 'https://example.com/'},
+        ]))
+
+        ext, browsers = restore()
+        assert [b.lazy_uri for b in browsers] == [
+            'https://keyerror.com/', 'https://lastpass.com/', 'https://example.com/']
+
+        browsers[0].webview.get_uri.return_value = 'https://keyerror.com/about'
+        ext.tab_changed(browsers[0])
+        ext.tab_closed(browsers[2])
+
+        assert self.saved(ext) == ['https://keyerror.com/about', 'https://lastpass.com/']
+
+    def test_restore_reordered_session(self, restore, tmpdir):
+        from roland.session import SessionJournal
+        journal = SessionJournal(str(tmpdir.join('session.bin')), str(tmpdir.join('session.journal')))
+        journal.load()
+        for i, uri in enumerate(['https://keyerror.com/', 'https://lastpass.com/', 'https://example.com/'], 1):
+            journal.update(i, uri=uri, title=None)
+        journal.order([3, 1, 2])
+        journal.close()
+
+        ext, browsers = restore()
+        assert self.saved(ext) == ['https://example.com/', 'https://keyerror.com/', 'https://lastpass.com/']
+
+        # and again, now that tabs have new ids in the journal
+        ext, browsers = restore(current=['https://example.org/'])
+        assert self.saved(ext) == [
+            'https://example.com/', 'https://keyerror.com/', 'https://lastpass.com/', 'https://example.org/']
+
+
+class TestHSTSExtension:
+    @pytest.fixture
+    def hsts(self, tmpdir):
+        from roland.extensions import HSTSExtension
+        ext = HSTSExtension(roland=MagicMock())
+        ext.roland.config.hsts_preload_path = str(tmpdir.join('missing.bin'))
+
+        with patch('roland.storage.config_path', lambda p: str(tmpdir.join(p))), \
+                patch('roland.extensions.GLib'):
+            ext.prepare()
+            ext.setup()
+            yield ext
+
+        from roland.storage import close_all
+        close_all()
+
+    def test_repeated_header_written_once(self, hsts):
+        with patch.object(hsts, 'flush') as flush:
+            for i in range(200):
+                hsts.add_entry('https://keyerror.com/{}.png'.format(i), 'max-age=31536000')
+
+        assert list(hsts.pending) == ['keyerror.com']
+        assert not flush.called
+
+    def test_changed_header_is_written(self, hsts):
+        hsts.add_entry('https://keyerror.com/', 'max-age=31536000')
+        hsts.add_entry('https://keyerror.com/', 'max-age=31536000; includeSubDomains')
+
+        assert set(hsts.pending) == {'keyerror.com', '.keyerror.com'}
+
+    def test_flush_batches(self, hsts):
+        hsts.flush_batch_size = 2
+        hsts.add_entry('https://keyerror.com/', 'max-age=31536000')
+        assert hsts.pending
+
+        hsts.add_entry('https://lastpass.com/', 'max-age=31536000')
+        assert not hsts.pending
+
+        rows = hsts.db.fetchall('select domain from hsts order by domain').result()
+        assert rows == [('keyerror.com',), ('lastpass.com',)]
+
+        assert hsts.check_url('http://keyerror.com/')
+        assert hsts.check_url('http://lastpass.com/')
+        assert not hsts.check_url('http://example.com/')
+
+
+class TestPasswordManagerExtension:
+    @pytest.fixture
+    def password_manager(self, tmpdir):
+        from roland.extensions import PasswordManagerExtension
+        ext = PasswordManagerExtension(roland=MagicMock())
+        ext.roland.config.password_manager_timeout = 0
+
+        with patch('roland.storage.config_path', lambda p: str(tmpdir.join(p))), \
+                patch('roland.extensions.blocking_wait', lambda f: f.result()):
+            ext.setup()
+            ext.key, ext.index_key = ext.derive_keys('hunter2', create=True)
+            yield ext
+            ext.executor.shutdown(wait=True)
+
+        from roland.storage import close_all
+        close_all()
+
+    def test_lookup_by_domain(self, password_manager):
+        password_manager.save_form('keyerror.com', {'username': 'roland'}).result()
+        password_manager.save_form('lastpass.com', {'username': 'walter'}).result()
+
+        forms = password_manager.get_for_domain(b'keyerror.com')
+        assert [f.form_data for f in forms] == [{b'username': b'roland'}]
+
+        rows = password_manager.db.fetchall('select domain_hash from managed').result()
+        assert b'keyerror.com' not in {h for (h,) in rows}
+
+    def test_test_password(self, password_manager):
+        password_manager.save_form(password_manager.SENTINEL_DOMAIN, {}).result()
+
+        key, index_key = password_manager.test_password('hunter2').result()
+        assert key == password_manager.key
+
+        with pytest.raises(ValueError):
+            password_manager.test_password('hunter3').result()
+
+    def test_lock_clears_key_and_cache(self, password_manager):
+        password_manager.save_form('keyerror.com', {}).result()
+        password_manager.get_for_domain(b'keyerror.com')
+        key = password_manager.key
+
+        password_manager.lock()
+        password_manager.executor.submit(lambda: None).result()
+
+        assert password_manager.key is None
+        assert not password_manager.cache
+        assert key == bytes(len(key))
+
+
+class TestClosedTabs:
+    @pytest.fixture
+    def closed_tabs(self, tmpdir):
+        from roland.extensions import ClosedTabs
+        ext = ClosedTabs(roland=MagicMock())
+        ext.roland.config.closed_tabs_history = 3
+
+        with patch('roland.storage.config_path', lambda p: str(tmpdir.join(p))):
+            ext.setup()
+            yield ext
+
+        from roland.storage import close_all
+        close_all()
+
+    def test_pop_most_recent(self, closed_tabs):
+        closed_tabs.add('https://keyerror.com/', 'keyerror', b'abc')
+        closed_tabs.add('https://lastpass.com/', 'lastpass', None)
+
+        assert closed_tabs.pop().result() == ('https://lastpass.com/', None)
+        assert closed_tabs.pop().result() == ('https://keyerror.com/', b'abc')
+        assert closed_tabs.pop().result() is None
+
+    def test_spills_to_disk(self, closed_tabs):
+        closed_tabs.in_memory = 1
+        closed_tabs.setup()
+
+        for i in range(5):
+            closed_tabs.add('https://keyerror.com/{}'.format(i), str(i), b'state')
+
+        assert [title for (row_id, title, uri) in closed_tabs.entries().result()] == ['4', '3', '2']
+
+        assert closed_tabs.pop().result() == ('https://keyerror.com/4', b'state')
+        assert closed_tabs.pop().result() == ('https://keyerror.com/3', b'state')
+
+    def test_pop_by_id(self, closed_tabs):
+        closed_tabs.add('https://keyerror.com/', 'keyerror', b'abc')
+        closed_tabs.add('https://lastpass.com/', 'lastpass', b'def')
+
+        [(last_id, _, _), (first_id, _, _)] = closed_tabs.entries().result()
+        assert closed_tabs.pop(first_id).result() == ('https://keyerror.com/', b'abc')
+        assert closed_tabs.pop().result() == ('https://lastpass.com/', b'def')
+
+    def test_pop_by_id_before_row_id_known(self, closed_tabs):
+        import concurrent.futures
+        from roland.extensions import ClosedTab
+
+        closed_tabs.add('https://keyerror.com/', 'keyerror', b'abc')
+        [(row_id, _, _)] = closed_tabs.entries().result()
+
+        # as if the writer hadn't got back to us with the row id yet
+        pending = concurrent.futures.Future()
+        closed_tabs.recent[0] = ClosedTab('https://keyerror.com/', 'keyerror', b'abc', pending)
+
+        assert closed_tabs.pop(row_id).result() == ('https://keyerror.com/', b'abc')
+        pending.set_result(row_id)
+        assert closed_tabs.pop().result() is None
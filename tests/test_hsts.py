@@ -0,0 +1,83 @@
+import json
+
+import pytest
+
+
+@pytest.fixture
+def preload_list(tmpdir):
+    from roland.hsts import PreloadList, compile_preload_list
+
+    path = tmpdir.join('hsts_preload.bin')
+    path.write_binary(compile_preload_list({
+        'keyerror.com': True,
+        'lastpass.com': False,
+        'dev': True,
+        'example.org': False,
+    }))
+    return PreloadList(str(path))
+
+
+@pytest.mark.parametrize('host,expected', [
+    ('keyerror.com', True),
+    ('foo.keyerror.com', True),
+    ('a.b.keyerror.com', True),
+    ('lastpass.com', True),
+    ('www.lastpass.com', False),
+    ('KeyError.com.', True),
+    ('roland.dev', True),
+    ('example.org', True),
+    ('example.com', False),
+    ('org', False),
+    ('', False),
+    (None, False),
+])
+def test_check_host(preload_list, host, expected):
+    assert preload_list.check_host(host) == expected
+
+
+def test_missing_file_is_empty(tmpdir):
+    from roland.hsts import PreloadList
+
+    preload = PreloadList(str(tmpdir.join('missing.bin')))
+    assert len(preload) == 0
+    assert not preload.check_host('keyerror.com')
+
+
+def test_parse_chromium_json():
+    from roland.hsts import parse_chromium_json
+
+    raw = '\n'.join([
+        '// This file is full of comments',
+        json.dumps({'entries': [
+            {'name': 'keyerror.com', 'mode': 'force-https', 'include_subdomains': True},
+            {'name': 'Lastpass.com', 'mode': 'force-https'},
+            {'name': 'pinned.com', 'pins': 'google'},
+        ]}),
+    ])
+
+    assert parse_chromium_json(raw) == {'keyerror.com': True, 'lastpass.com': False}
+
+
+def test_build_preload_list(tmpdir):
+    from roland.hsts import PreloadList, build_preload_list
+
+    source = tmpdir.join('transport_security_state_static.json')
+    source.write(json.dumps({'entries': [
+        {'name': 'keyerror.com', 'mode': 'force-https', 'include_subdomains': True},
+    ]}))
+    output = str(tmpdir.join('cache', 'hsts_preload.bin'))
+
+    assert build_preload_list(str(source), output) > 0
+    assert PreloadList(output).check_host('www.keyerror.com')
+
+
+def test_build_preload_list_download_timeout(tmpdir):
+    import io
+    from unittest.mock import patch
+    from roland.hsts import build_preload_list
+
+    raw = json.dumps({'entries': [{'name': 'keyerror.com', 'mode': 'force-https'}]}).encode('utf8')
+    with patch('urllib.request.urlopen', return_value=io.BytesIO(raw)) as urlopen:
+        build_preload_list('https://example.com/hsts.json', str(tmpdir.join('hsts_preload.bin')), timeout=5)
+
+    assert urlopen.call_args[1]['timeout'] == 5
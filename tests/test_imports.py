@@ -0,0 +1,35 @@
+import subprocess
+import sys
+
+import pytest
+
+# only needed by features that might never be used, so they're imported
+# when first used rather than at startup
+DEFERRED = ['Crypto', 'werkzeug', 'msgpack', 'code', 'urllib.request']
+
+
+def imported_modules(module):
+    """Import module in a fresh interpreter, returning the names of every
+    module that was imported along with it, from python -X importtime."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+    modules = set()
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            modules.add(line.rsplit('|', 1)[1].strip())
+    return modules
+
+
+@pytest.mark.parametrize('module', [
+    'roland.core',
+    'roland.extensions',
+    'roland.downloads',
+    'roland.session',
+    'roland.utils',
+])
+def test_startup_imports(module):
+    modules = imported_modules(module)
+    assert module in modules
+    assert not modules & set(DEFERRED)
@@ -0,0 +1,106 @@
+from unittest.mock import MagicMock
+
+
+def keymap(bindings):
+    from roland.keys import compile_keymap
+    return compile_keymap(bindings)
+
+
+def feed(dispatcher, root, keys):
+    return [dispatcher.feed(root, key) for key in keys]
+
+
+def test_single_keys():
+    from roland.keys import KeyDispatcher, MATCH, NO_MATCH, Result
+
+    j = MagicMock()
+    root = keymap({'j': j, 'C-f': MagicMock()})
+    dispatcher = KeyDispatcher()
+
+    assert dispatcher.feed(root, 'j') == Result(MATCH, j, 1)
+    assert dispatcher.feed(root, 'x').status == NO_MATCH
+    assert not dispatcher.pending
+
+
+def test_sequences_and_counts():
+    from roland.keys import KeyDispatcher, MATCH, NO_MATCH, PENDING, Result
+
+    gt, one = MagicMock(), MagicMock()
+    root = keymap({'g t': gt, ('g', '1'): one, '0': MagicMock()})
+    dispatcher = KeyDispatcher()
+
+    [first, second] = feed(dispatcher, root, ['g', 't'])
+    assert first.status == PENDING
+    assert second == Result(MATCH, gt, 1)
+
+    # digits in a sequence are keys, not counts
+    assert feed(dispatcher, root, ['1', '2', 'g', '1'])[-1] == Result(MATCH, one, 12)
+    assert feed(dispatcher, root, ['5', 'g'])[-1].status == PENDING
+    assert dispatcher.pending_text() == '5g'
+
+    assert dispatcher.feed(root, 'x').status == NO_MATCH
+    assert dispatcher.pending_text() == ''
+
+
+def test_sub_command_bindings():
+    from roland.api import lazy, Mode
+    from roland.keys import KeyDispatcher, MATCH, Result
+
+    top = lazy.javascript('window.scrollTo(0, 0);')
+    root = keymap({'g': lazy.set_mode(Mode.SubCommand, 'g', {'g': top})})
+
+    assert feed(KeyDispatcher(), root, ['g', 'g'])[-1] == Result(MATCH, top, 1)
+
+
+def test_ambiguous_prefix_timeout():
+    from roland.keys import KeyDispatcher, MATCH, PENDING, Result
+
+    d, dd = MagicMock(), MagicMock()
+    root = keymap({'d': d, 'd d': dd})
+    dispatcher = KeyDispatcher()
+
+    assert feed(dispatcher, root, ['3', 'd'])[-1].status == PENDING
+    assert dispatcher.timeout() == Result(MATCH, d, 3)
+    assert not dispatcher.pending
+
+    assert feed(dispatcher, root, ['d', 'd'])[-1] == Result(MATCH, dd, 1)
+
+
+def test_interrupted_sequence_runs_its_command():
+    from roland.keys import KeyDispatcher, MATCH, NO_MATCH, PENDING, Result
+
+    g, gt, j = MagicMock(), MagicMock(), MagicMock()
+    root = keymap({'g': g, 'g t': gt, 'j': j})
+    dispatcher = KeyDispatcher()
+
+    assert feed(dispatcher, root, ['2', 'g'])[-1].status == PENDING
+    assert dispatcher.feed(root, 'j') == Result(MATCH, j, 1, Result(MATCH, g, 2))
+    assert not dispatcher.pending
+
+    # the new key can start a sequence of its own
+    assert dispatcher.feed(root, 'g').status == PENDING
+    result = dispatcher.feed(root, 'g')
+    assert result.status == PENDING and result.previous == Result(MATCH, g, 1)
+    assert dispatcher.feed(root, 'x') == Result(NO_MATCH, None, None, Result(MATCH, g, 1))
+
+
+def test_accepts_count():
+    from roland.keys import accepts_count
+
+    assert accepts_count(lambda browser, count=1: None)
+    assert not accepts_count(lambda browser: None)
+    assert not accepts_count(None)
+
+
+def test_keymaps_per_mode():
+    from roland.api import Mode
+    from roland.keys import compile_keymaps
+
+    class config:
+        commands = {'j': MagicMock()}
+        keymaps = {Mode.Insert: {'C-e': MagicMock()}}
+
+    keymaps = compile_keymaps(config)
+    assert set(keymaps[Mode.Normal].children) == {'j'}
+    assert set(keymaps[Mode.Insert].children) == {'C-e'}
+    assert not keymaps[Mode.PassThrough].children
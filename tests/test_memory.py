@@ -0,0 +1,93 @@
+STATUS = '''Name:	WebKitWebProces
+VmPeak:	 3348000 kB
+VmRSS:	  204800 kB
+RssAnon:	  102400 kB
+VmSwap:	      16 kB
+Threads:	25
+'''
+
+SMAPS_ROLLUP = '''5591b4fa0000-7ffcb2187000 ---p 00000000 00:00 0                          [rollup]
+Rss:              204800 kB
+Pss:              153600 kB
+Private_Dirty:    100000 kB
+Swap:                 16 kB
+'''
+
+MEMINFO = '''MemTotal:        8000000 kB
+MemFree:          100000 kB
+MemAvailable:     500000 kB
+'''
+
+
+def write_proc(tmpdir, pid, rollup=True):
+    tmpdir.join(str(pid)).ensure(dir=True)
+    tmpdir.join(str(pid), 'status').write(STATUS)
+    if rollup:
+        tmpdir.join(str(pid), 'smaps_rollup').write(SMAPS_ROLLUP)
+    tmpdir.join('meminfo').write(MEMINFO)
+
+
+def test_parse_kb_fields():
+    from roland.memory import parse_kb_fields
+
+    fields = parse_kb_fields(STATUS)
+    assert fields['VmRSS'] == 204800 * 1024
+    assert fields['VmSwap'] == 16 * 1024
+    assert 'Threads' not in fields
+    assert 'Name' not in fields
+
+
+def test_process_memory(tmpdir):
+    from roland.memory import ProcessMemory, process_memory
+
+    write_proc(tmpdir, 1234)
+    assert process_memory(1234, proc=str(tmpdir)) == ProcessMemory(
+        pid=1234, rss=204800 * 1024, pss=153600 * 1024, swap=16 * 1024)
+
+
+def test_process_memory_without_smaps_rollup(tmpdir):
+    from roland.memory import process_memory
+
+    write_proc(tmpdir, 1234, rollup=False)
+    memory = process_memory(1234, proc=str(tmpdir))
+    assert memory.rss == memory.pss == 204800 * 1024
+
+
+def test_process_memory_exited(tmpdir):
+    from roland.memory import process_memory
+    assert process_memory(1234, proc=str(tmpdir)) is None
+
+
+def test_memory_excess(tmpdir):
+    from roland.memory import memory_excess, system_memory
+
+    write_proc(tmpdir, 1234)
+    system = system_memory(proc=str(tmpdir))
+    assert system.available == 500000 * 1024
+
+    assert memory_excess(1000, system) == 0
+    assert memory_excess(1000, system, max_rss=600) == 400
+    assert memory_excess(1000, system, min_available_ratio=0.1) == 300000 * 1024
+    assert memory_excess(1000, system, max_rss=2000, min_available_ratio=0.05) == 0
+
+
+def test_choose_reclaim():
+    from roland.memory import choose_reclaim
+
+    tabs = [(1, 100, True), (2, 500, False), (3, 300, True), (4, 200, True)]
+    assert choose_reclaim(tabs, 0) == []
+    assert choose_reclaim(tabs, 250) == [3]
+    assert choose_reclaim(tabs, 350) == [3, 4]
+    assert choose_reclaim(tabs, 10000) == [3, 4, 1]
+
+
+def test_process_cpu_time(tmpdir):
+    import os
+    from roland.memory import process_cpu_time
+
+    tmpdir.join('1234').ensure(dir=True)
+    tmpdir.join('1234', 'stat').write(
+        '1234 (WebKit Web (Proc)) S 1 1234 1234 0 -1 4194304 85 0 0 0 250 50 0 0 20 0 1 0 100980\n')
+
+    assert process_cpu_time(1234, proc=str(tmpdir)) == 300 / os.sysconf('SC_CLK_TCK')
+    assert process_cpu_time(4321, proc=str(tmpdir)) is None
@@ -0,0 +1,22 @@
+import json
+
+
+def test_render_page():
+    from roland.pages import render_page
+
+    page = render_page('Tasks & co', '<table></table>')
+    assert '<title>Tasks &amp; co</title>' in page
+    assert '<div id="content">\n<table></table>\n</div>' in page
+    assert 'http-equiv="refresh"' not in page
+
+
+def test_replace_content_script():
+    from roland.pages import replace_content_script
+
+    content = '<td>"quoted"   </script></td>'
+    script = replace_content_script(content)
+
+    prefix = 'document.getElementById("content").innerHTML = '
+    assert script.startswith(prefix) and script.endswith(';')
+    assert json.loads(script[len(prefix):-1]) == content
+    assert ' ' not in script
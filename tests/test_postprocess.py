@@ -0,0 +1,101 @@
+import hashlib
+import tarfile
+
+import pytest
+
+DATA = b'roland' * 1000
+DIGEST = hashlib.sha256(DATA).hexdigest()
+
+
+def test_sha256_file(tmpdir):
+    from roland.postprocess import sha256_file
+
+    tmpdir.join('file').write_binary(DATA)
+    assert sha256_file(str(tmpdir.join('file')), chunk_size=7) == DIGEST
+
+
+def test_parse_checksum():
+    from roland.postprocess import parse_checksum
+
+    other = '0' * 64
+    assert parse_checksum(DIGEST.upper()) == DIGEST
+    assert parse_checksum('{}  foo.iso'.format(DIGEST)) == DIGEST
+    assert parse_checksum('{}  bar.iso\n{} *foo.iso\n'.format(other, DIGEST), 'foo.iso') == DIGEST
+    assert parse_checksum('{}  bar.iso\n'.format(other), 'foo.iso') is None
+    assert parse_checksum('not a checksum') is None
+
+
+def test_verify_with_sidecar(tmpdir):
+    from roland.postprocess import ChecksumMismatch, process_download
+
+    path = str(tmpdir.join('foo.iso'))
+    tmpdir.join('foo.iso').write_binary(DATA)
+
+    result = process_download(path, ['verify'])
+    assert result.sha256 is None
+
+    tmpdir.join('foo.iso.sha256').write('{}  foo.iso\n'.format(DIGEST))
+    result = process_download(path, ['verify'])
+    assert result.sha256 == result.expected == DIGEST
+
+    with pytest.raises(ChecksumMismatch):
+        process_download(path, [], expected='0' * 64)
+
+
+def test_extract(tmpdir):
+    from roland.postprocess import process_download
+
+    tmpdir.join('file').write_binary(DATA)
+    with tarfile.open(str(tmpdir.join('archive.tar.gz')), 'w:gz') as tar:
+        tar.add(str(tmpdir.join('file')), arcname='file')
+
+    result = process_download(str(tmpdir.join('archive.tar.gz')), ['hash', 'extract'])
+    assert result.extracted == str(tmpdir.join('archive'))
+    assert tmpdir.join('archive', 'file').read_binary() == DATA
+    assert result.sha256 is not None
+
+
+def test_extract_zip(tmpdir):
+    import zipfile
+    from roland.postprocess import process_download
+
+    with zipfile.ZipFile(str(tmpdir.join('archive.zip')), 'w') as archive:
+        archive.writestr('dir/file', DATA)
+
+    result = process_download(str(tmpdir.join('archive.zip')), ['extract'])
+    assert result.extracted == str(tmpdir.join('archive'))
+    assert tmpdir.join('archive', 'dir', 'file').read_binary() == DATA
+
+
+def test_extract_zip_stays_in_destination(tmpdir):
+    import zipfile
+    from roland.postprocess import extract_archive
+
+    path = str(tmpdir.join('evil.zip'))
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('../escaped', DATA)
+        archive.writestr('file', DATA)
+
+    assert extract_archive(path) == str(tmpdir.join('evil'))
+    assert not tmpdir.join('escaped').exists()
+    assert tmpdir.join('evil', 'file').read_binary() == DATA
+
+
+def test_extract_stays_in_destination(tmpdir, monkeypatch):
+    import io
+    from roland.postprocess import UnsafeArchive, extract_archive
+
+    path = str(tmpdir.join('evil.tar'))
+    with tarfile.open(path, 'w') as tar:
+        member = tarfile.TarInfo('../escaped')
+        member.size = len(DATA)
+        tar.addfile(member, io.BytesIO(DATA))
+
+    with pytest.raises(tarfile.TarError):
+        extract_archive(path)
+    assert not tmpdir.join('escaped').exists()
+
+    # without extraction filters, tar files aren't extracted at all
+    monkeypatch.delattr(tarfile, 'data_filter')
+    with pytest.raises(UnsafeArchive):
+        extract_archive(path)
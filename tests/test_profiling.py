@@ -0,0 +1,40 @@
+import json
+
+
+def test_phases_and_report(tmpdir):
+    from roland.profiling import StartupProfiler
+
+    now = [0.0]
+    profiler = StartupProfiler(clock=lambda: now[0])
+
+    with profiler.phase('load_config'):
+        now[0] = 0.25
+
+    profiler.begin('first tab')
+    now[0] = 0.5
+    profiler.begin('first tab')
+    now[0] = 1.0
+    profiler.end('first tab')
+    profiler.end('first tab')
+
+    assert [(phase.name, phase.start, phase.duration) for phase in profiler.phases] == [
+        ('load_config', 0, 0.25), ('first tab', 0.25, 0.75)]
+
+    table_path, trace_path = profiler.write(str(tmpdir))
+    lines = open(table_path).read().splitlines()
+    assert lines[1].split() == ['load_config', '0.0', '250.0']
+    assert lines[2].split() == ['first', 'tab', '250.0', '750.0']
+
+    events = json.load(open(trace_path))['traceEvents']
+    assert [(e['name'], e['ph'], e['ts'], e['dur']) for e in events] == [
+        ('load_config', 'X', 0, 250000), ('first tab', 'X', 250000, 750000)]
+
+
+def test_disabled(tmpdir):
+    from roland import profiling
+
+    with profiling.phase('nothing'):
+        pass
+    profiling.begin('first tab')
+    assert profiling.finish(str(tmpdir)) is None
+    assert tmpdir.listdir() == []
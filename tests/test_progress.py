@@ -0,0 +1,65 @@
+from unittest.mock import MagicMock
+
+
+def download(current, total, state='active'):
+    d = MagicMock()
+    d.get_current_size.return_value = current
+    d.get_total_size.return_value = total
+    d.state = state
+    return d
+
+
+def test_sampler_moving_average():
+    from roland.progress import ProgressSampler
+
+    now = [0]
+    sampler = ProgressSampler(smoothing=0.5, clock=lambda: now[0])
+
+    [status] = sampler.sample({'/a': download(0, 1000)})
+    assert status.rate is None
+    assert status.eta is None
+
+    now[0] = 1
+    [status] = sampler.sample({'/a': download(100, 1000)})
+    assert status.rate == 100
+    assert status.eta == 9
+
+    now[0] = 2
+    [status] = sampler.sample({'/a': download(400, 1000)})
+    assert status.rate == 200
+    assert status.eta == 3
+
+    sampler.sample({})
+    assert sampler.last == {}
+    assert sampler.rates == {}
+
+
+def test_paused_downloads_have_no_rate():
+    from roland.progress import ProgressSampler
+
+    now = [0]
+    sampler = ProgressSampler(clock=lambda: now[0])
+    sampler.sample({'/a': download(0, 1000, state='paused')})
+
+    now[0] = 1
+    [status] = sampler.sample({'/a': download(0, 1000, state='paused')})
+    assert status.rate is None
+    assert status.eta is None
+
+
+def test_status_text_and_page():
+    from roland.progress import DownloadStatus, render_downloads_page, status_text
+
+    statuses = [
+        DownloadStatus('/a', 'active', 512, 1024, 64, 8),
+        DownloadStatus('/b', 'active', 0, 1024, 64, 16),
+        DownloadStatus('/c<', 'paused', 0, 0, None, None),
+    ]
+
+    assert status_text(statuses) == '↓2 25% 128b/s 12s'
+    assert status_text(statuses[2:]) == ''
+
+    page = render_downloads_page(statuses)
+    assert '3 downloads, 512b of 2kb, 128b/s, 12s left' in page
+    assert '/c&lt;' in page
+    assert render_downloads_page([]).count('<tr>') == 1
@@ -0,0 +1,220 @@
+import base64
+import json
+
+import pytest
+
+
+@pytest.fixture
+def journal(tmpdir):
+    from roland.session import SessionJournal
+    return SessionJournal(
+        str(tmpdir.join('session.bin')),
+        str(tmpdir.join('session.journal')),
+        legacy_path=str(tmpdir.join('session.json')),
+    )
+
+
+def reopen(journal):
+    from roland.session import SessionJournal
+    journal.close()
+    return SessionJournal(journal.snapshot_path, journal.journal_path, legacy_path=journal.legacy_path)
+
+
+def blob(raw):
+    from roland.session import InlineBlob
+    return InlineBlob(raw)
+
+
+def test_replay(journal):
+    journal.load()
+    journal.update(1, uri='https://keyerror.com/', title='keyerror', session=blob(b'abc'))
+    journal.update(2, uri='https://lastpass.com/', title='lastpass', session=blob(b'def'))
+    journal.update(3, uri='https://example.com/', title='example', session=blob(b'ghi'))
+    journal.update(1, uri='https://keyerror.com/about', title='about', session=blob(b'jkl'))
+    journal.close_tab(2)
+    journal.order([3, 1])
+
+    journal = reopen(journal)
+    pages = journal.load()
+    assert [page['uri'] for page in pages] == [
+        'https://example.com/',
+        'https://keyerror.com/about',
+    ]
+    assert [page['session'].load() for page in pages] == [b'ghi', b'jkl']
+
+
+def test_unchanged_update_not_journalled(journal):
+    journal.load()
+    journal.update(1, uri='https://keyerror.com/', title='keyerror', session=blob(b'abc'))
+    journal.update(1, uri='https://keyerror.com/', title='keyerror', session=blob(b'abc'))
+    assert journal.records == 1
+
+
+def test_title_change_does_not_rewrite_session(journal):
+    journal.load()
+    journal.update(1, uri='https://keyerror.com/', title='keyerror', session=blob(b'abc' * 1000))
+    size = journal.journal.tell()
+
+    journal.update(1, uri='https://keyerror.com/', title='KeyError', session=blob(b'abc' * 1000))
+    assert journal.journal.tell() - size < 100
+
+    journal = reopen(journal)
+    [page] = journal.load()
+    assert page['title'] == 'KeyError'
+    assert page['session'].load() == b'abc' * 1000
+
+
+def test_truncated_record_ignored(journal):
+    journal.load()
+    journal.update(1, uri='https://keyerror.com/', title='keyerror', session=blob(b'abc'))
+    journal.close()
+
+    with open(journal.journal_path, 'ab') as f:
+        f.write(b'\x40\x00\x00\x00\x00\x00\x00\x00{"op":"update","id":2,"pa')
+
+    journal = reopen(journal)
+    assert [page['uri'] for page in journal.load()] == ['https://keyerror.com/']
+
+    # the partial record is overwritten rather than hiding later ones.
+    journal.update(2, uri='https://lastpass.com/', title='lastpass', session=None)
+
+    journal = reopen(journal)
+    assert [page['uri'] for page in journal.load()] == [
+        'https://keyerror.com/',
+        'https://lastpass.com/',
+    ]
+
+
+def test_compact(journal):
+    from roland.session import StoredBlob
+
+    journal.load()
+    journal.update(1, uri='https://keyerror.com/', title='keyerror', session=blob(b'abc'))
+    journal.compact()
+
+    assert journal.records == 0
+    with open(journal.journal_path, 'rb') as f:
+        assert f.read() == b'RLJRNL\x00\x01'
+
+    journal.update(2, uri='https://lastpass.com/', title='lastpass', session=None)
+
+    journal = reopen(journal)
+    pages = journal.load()
+    assert [page['uri'] for page in pages] == [
+        'https://keyerror.com/',
+        'https://lastpass.com/',
+    ]
+
+    # session state isn't read until it's needed.
+    assert isinstance(pages[0]['session'], StoredBlob)
+    assert pages[0]['session'].load() == b'abc'
+    assert pages[1]['session'] is None
+
+
+def test_blobs_survive_compaction(journal):
+    journal.load()
+    journal.update(1, uri='https://keyerror.com/', title='keyerror', session=blob(b'abc'))
+    session = journal.tabs[1]['session']
+
+    journal.compact()
+    journal.compact()
+
+    assert session.load() == b'abc'
+    assert journal.tabs[1]['session'].load() == b'abc'
+
+
+def test_loads_old_session_format(journal):
+    with open(journal.legacy_path, 'w') as f:
+        json.dump([{
+            'uri': 'https://keyerror.com/',
+            'title': 'keyerror',
+            'session': base64.b64encode(b'abc').decode('utf8'),
+        }], f, indent=4)
+
+    [page] = journal.load()
+    assert page['uri'] == 'https://keyerror.com/'
+    assert page['title'] == 'keyerror'
+    assert page['session'].load() == b'abc'
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_restore_scheduler_prefers_recent_tabs():
+    from roland.session import RestoreScheduler
+
+    scheduler = RestoreScheduler([(1, 10), (2, 30), (3, None), (4, 20)], budget=2, concurrency=2)
+    assert scheduler.ready() == [2, 4]
+    assert scheduler.ready() == []
+
+    scheduler.finished(2)
+    scheduler.finished(4)
+    assert scheduler.done
+
+
+def test_restore_scheduler_bounds_concurrency():
+    from roland.session import RestoreScheduler
+
+    clock = FakeClock()
+    scheduler = RestoreScheduler([(1, 3), (2, 2), (3, 1)], budget=3, concurrency=1, load_timeout=30, clock=clock)
+    assert scheduler.ready() == [1]
+    assert scheduler.ready() == []
+
+    scheduler.finished(1)
+    assert scheduler.ready() == [2]
+
+    # a load that never finishes doesn't hold up the rest forever
+    clock.now = 30
+    assert scheduler.ready() == [3]
+
+
+def test_restore_scheduler_pauses_for_input():
+    from roland.session import RestoreScheduler
+
+    clock = FakeClock()
+    scheduler = RestoreScheduler([(1, 1), (2, 2)], budget=2, idle=2, clock=clock)
+    scheduler.interacted()
+    assert scheduler.ready() == []
+
+    clock.now = 2
+    assert scheduler.ready() == [2]
+
+
+def test_restore_scheduler_skips_tabs_already_loaded():
+    from roland.session import RestoreScheduler
+
+    scheduler = RestoreScheduler([(1, 1), (2, 2)], budget=2)
+    scheduler.finished(2)
+    assert scheduler.ready() == [1]
+
+
+def test_tabs_to_discard_idle():
+    from roland.session import tabs_to_discard
+
+    tabs = [(1, 100, False), (2, 500, False), (3, 50, True)]
+    assert tabs_to_discard(tabs, now=1000, idle_timeout=600) == [1]
+    assert tabs_to_discard(tabs, now=1000) == []
+
+
+def test_tabs_to_discard_max_live():
+    from roland.session import tabs_to_discard
+
+    # exempt tabs count towards the limit, but are never discarded
+    tabs = [(1, 300, False), (2, 100, False), (3, 50, True), (4, 200, False)]
+    assert tabs_to_discard(tabs, now=1000, max_live=2) == [2, 4]
+    assert tabs_to_discard(tabs, now=1000, max_live=2, idle_timeout=850) == [2, 4]
+    assert tabs_to_discard(tabs, now=1000, max_live=1) == [2, 4, 1]
+    assert tabs_to_discard(tabs, now=1000, max_live=10) == []
+
+
+def test_same_blob_compares_contents():
+    from roland.session import same_blob
+
+    assert same_blob(blob(b'abc'), blob(b'abc'))
+    assert not same_blob(blob(b'abc'), blob(b'abd'))
+    assert len(blob(b'abc').digest) == 64
@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def db(tmpdir):
+    from roland.storage import Database
+    db = Database(str(tmpdir.join('test.db')), schema=[
+        'create table if not exists things (name text, count integer)',
+    ])
+    yield db
+    db.close()
+
+
+def test_write_then_read(db):
+    db.executemany('insert into things (name, count) values (?, ?)',
+                   [('a', 1), ('b', 2)]).result()
+    assert db.fetchall('select name, count from things order by name').result() == [('a', 1), ('b', 2)]
+    assert db.fetchone('select count(*) from things').result() == (2,)
+
+
+def test_batch_is_a_single_transaction(db):
+    future = db.batch([
+        ('insert into things (name, count) values (?, ?)', ('a', 1)),
+        ('insert into nonexistent values (?)', (1,)),
+    ])
+
+    with pytest.raises(Exception):
+        future.result()
+
+    assert db.fetchall('select * from things').result() == []
+
+
+def test_wal_mode(db):
+    assert db.fetchone('pragma journal_mode').result() == ('wal',)
+
+
+def test_awaitable(db):
+    async def run():
+        await db.execute('insert into things (name, count) values (?, ?)', ('a', 1))
+        return await db.fetchall('select name from things')
+
+    assert asyncio.run(run()) == [('a',)]
+
+
+def test_open_database_is_shared(tmpdir, monkeypatch):
+    from roland import storage
+    monkeypatch.setattr(storage, 'config_path', lambda p: str(tmpdir.join(p)))
+
+    try:
+        assert storage.open_database('shared.db') is storage.open_database('shared.db')
+    finally:
+        storage.close_all()
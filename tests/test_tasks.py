@@ -0,0 +1,46 @@
+def task(tab_id, **kwargs):
+    from roland.tasks import Task
+    fields = dict(tab_id=tab_id, title='tab {}'.format(tab_id), uri='https://keyerror.com/',
+                  pid=None, rss=None, pss=None, cpu=None, requests=0, bytes=0)
+    fields.update(kwargs)
+    return Task(**fields)
+
+
+def test_cpu_percent():
+    from roland.tasks import cpu_percent
+
+    assert cpu_percent(None, (10, 5)) is None
+    assert cpu_percent((10, 5), None) is None
+    assert cpu_percent((10, 5), (10, 5)) is None
+    assert cpu_percent((10, 5), (12, 6)) == 50.0
+    assert cpu_percent((10, 5), (11, 7)) == 200.0
+
+
+def test_sort_tasks():
+    from roland.tasks import sort_tasks
+
+    tasks = [
+        task(1, pid=100, pss=10, cpu=80.0),
+        task(2),
+        task(3, pid=101, pss=30, cpu=1.0),
+    ]
+
+    assert [t.tab_id for t in sort_tasks(tasks)] == [3, 1, 2]
+    assert [t.tab_id for t in sort_tasks(tasks, 'cpu')] == [1, 3, 2]
+    assert [t.tab_id for t in sort_tasks(tasks, 'title')] == [1, 2, 3]
+    assert [t.tab_id for t in sort_tasks(tasks, 'nonsense')] == [3, 1, 2]
+
+
+def test_render_tasks_page():
+    from roland.tasks import render_tasks_page
+
+    page = render_tasks_page([
+        task(1, title='<script>', pid=100, rss=2048, pss=1024, cpu=12.5, requests=3, bytes=4096),
+        task(2),
+    ], sort='cpu')
+
+    assert '&lt;script&gt;' in page
+    assert '<script>' not in page
+    assert '12.5%' in page
+    assert '2kb' in page
+    assert 'href="roland://tasks/?sort=pss"' in page
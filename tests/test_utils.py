@@ -15,3 +15,201 @@ import pytest
 def test_pretty_size(bytecount, expected_output):
     from roland.utils import get_pretty_size
     assert get_pretty_size(bytecount) == expected_output
+
+
+def test_extension_index_and_hooks():
+    from unittest.mock import MagicMock, patch
+    from roland.utils import RolandConfigBase
+
+    class First:
+        sort_order = 0
+        handles = ('search_url',)
+        deferred = False
+        ready = False
+
+        def __init__(self, roland):
+            pass
+
+        def search_url(self, text):
+            return None
+
+    class Second(First):
+        sort_order = 1
+
+        def search_url(self, text):
+            return 'https://example.com/?q=' + text
+
+    class Deferred(First):
+        handles = ('resource_finished',)
+        deferred = True
+
+        def resource_finished(self, browser, response):
+            finished.append(self)
+            return True
+
+    finished = []
+
+    class config:
+        extensions = [Second, First, Deferred, Deferred]
+
+        def should_open_popup(uri):
+            return False
+
+        def should_display_notification(notification):
+            return None
+
+    roland = RolandConfigBase()
+    with patch('roland.utils.load_config', lambda: config), \
+            patch.object(RolandConfigBase, 'make_config_directories', MagicMock()):
+        roland.load_config()
+
+    assert isinstance(roland.get_extension('Second'), Second)
+    assert roland.get_extension(First) is roland.extensions[0]
+    assert not roland.is_enabled('Third')
+
+    assert roland.hooks('search_url', 'roland') == 'https://example.com/?q=roland'
+    assert roland.hooks('should_open_popup', 'about:blank', default=True) is False
+    # config's answer is used as is, even None
+    assert roland.hooks('should_display_notification', 'hi', default=True) is None
+    assert roland.hooks('user_agent_choices', default=[]) == []
+
+    # deferred extensions only subscribe, and are only found, once they're
+    # set up
+    assert not roland.has_hook('resource_finished')
+    assert not roland.is_enabled('Deferred')
+    deferred = [ext for ext in roland.extensions if isinstance(ext, Deferred)]
+    for ext in deferred:
+        ext.ready = True
+        roland.add_hooks(ext)
+    assert roland.get_extension(Deferred) is deferred[0]
+    assert roland.has_hook('resource_finished')
+
+    # every subscriber hears about broadcasts
+    roland.broadcast('resource_finished', 'browser', 'response')
+    assert finished == deferred
+
+
+def test_dependencies_settled():
+    from roland.utils import dependencies_settled
+
+    class ext:
+        depends = ('SessionManager', 'Missing')
+
+    enabled = {'SessionManager', 'HSTSExtension'}
+    assert not dependencies_settled(ext, set(), enabled)
+    assert dependencies_settled(ext, {'SessionManager'}, enabled)
+
+
+class WebProcessExtension:
+    sort_order = 0
+    handles = ()
+    deferred = False
+    ready = False
+    web_process = True
+    web_process_config = ('preload_path', 'missing')
+
+    def __init__(self, roland):
+        self.roland = roland
+
+
+class UIExtension(WebProcessExtension):
+    web_process = False
+    web_process_config = ('secret',)
+
+
+def test_web_process_settings():
+    from unittest.mock import patch
+    from roland.utils import RolandConfigBase, web_process_settings
+
+    class config:
+        preload_path = '/tmp/preload.bin'
+        secret = 'not for web processes'
+
+    extensions = [WebProcessExtension(None), UIExtension(None)]
+    settings = web_process_settings(extensions, config)
+
+    roland = RolandConfigBase()
+    with patch('roland.utils.load_config') as load_config:
+        roland.load_settings(settings)
+    assert not load_config.called
+
+    assert vars(roland.config) == {'preload_path': '/tmp/preload.bin'}
+    assert [type(ext) for ext in roland.extensions] == [WebProcessExtension]
+    assert roland.get_extension('WebProcessExtension').roland is roland
+
+
+def test_web_process_settings_not_json():
+    import pathlib
+    from roland.utils import web_process_settings
+
+    class config:
+        preload_path = pathlib.Path('/tmp/preload.bin')
+
+    # web processes fall back to loading config.py
+    assert web_process_settings([WebProcessExtension(None)], config) is None
+
+
+def test_web_process_settings_config_extension():
+    import types
+    from roland.utils import web_process_settings
+
+    # extensions defined in config.py can't be imported by web processes,
+    # which fall back to loading config.py
+    config = types.ModuleType('roland.config')
+    exec('''
+class ConfigExtension:
+    web_process = True
+    web_process_config = ()
+
+    def __init__(self, roland):
+        pass
+''', vars(config))
+
+    assert web_process_settings([config.ConfigExtension(None)], config) is None
+
+
+def test_diff_config():
+    import types
+    from roland.utils import config_settings, diff_config
+
+    def run(source):
+        config = types.ModuleType('roland.config')
+        exec(source, vars(config))
+        return config_settings(config)
+
+    old = run('''
+from roland.api import lazy, Mode
+font = 'Anonymous Pro'
+commands = {'j': lazy.javascript('window.scrollBy(0, 50);'), 'i': lazy.set_mode(Mode.Insert)}
+def search_url(text):
+    return None
+''')
+    assert diff_config(old, old) == set()
+
+    new = run('''
+from roland.api import lazy, Mode
+font = 'Hack'
+commands = {'j': lazy.javascript('window.scrollBy(0, 100);'), 'i': lazy.set_mode(Mode.Insert)}
+def search_url(text):
+    return None
+enable_webgl = True
+''')
+    assert diff_config(old, new) == {'font', 'commands', 'enable_webgl'}
+
+
+def test_reloaded_config_forgets_removed_settings(tmpdir):
+    from unittest.mock import patch
+    from roland.utils import config_settings, diff_config, load_config
+
+    tmpdir.join('config.py').write('font = "Hack"\nenable_webgl = True\n')
+    with patch('roland.utils.config_path', lambda p: str(tmpdir.join(p))):
+        old = config_settings(load_config())
+
+        tmpdir.join('config.py').write('font = "Hack"\n')
+        config = load_config()
+        new = config_settings(config)
+
+    assert not hasattr(config, 'enable_webgl')
+    # only the removed setting has changed
+    assert new['font'] == old['font'] == 'Hack'
+    assert diff_config(old, new) == {'enable_webgl'}